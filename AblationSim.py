@@ -1,36 +1,42 @@
+import time
+processStart = time.perf_counter()
 import numpy as np
 import customtkinter as ctk
-from CTkMessagebox import CTkMessagebox
-from tktooltip import ToolTip
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
-from util import load_data, generateImage, generateBeamProfile, simulateAblation
-from CTkSpinbox import *
+from util import load_data, generateImage, generateBeamProfile, previewDeviation
+from workers import SimulationPool
+from jobs import SimulationJobs
+from startup import StartupTimer
+from plotting import BlittedFigure, ImagePane, dataLimits
 import multiprocessing
+import threading
 import math
-from tkinter import PhotoImage
+from tkinter import PhotoImage, TclError
 
-# Wrapper for multiprocessing
-def simulateAblationWrapper(inputImage, craterProfile, washoutProfilesAll, nuclideNames, repetitionRate, W, C_sample, fluence, dosage, scanningSpeed, flickerNoise, useRR, resultQueue):
-    result = simulateAblation(inputImage, craterProfile, washoutProfilesAll, nuclideNames, repetitionRate=repetitionRate, W=W, C_sample=C_sample, fluence=fluence, dosage=dosage, scanningSpeed=scanningSpeed, flickerNoise=flickerNoise, useRR=useRR)
-    resultQueue.put(result)
+# matplotlib, CTkSpinbox, tktooltip and CTkMessagebox are imported where they are first needed,
+# matplotlib on the loading thread while the window is already shown
+startupTimer = StartupTimer(processStart)
+startupTimer.record("import", "AblationSim module imports", time.perf_counter() - processStart)
 
 class WashoutApp(ctk.CTk):
     def __init__(self):
         super().__init__()
 
+        self.startupTimer = startupTimer
+
+        # Assets are loaded on first access (see load_data)
         self.data = load_data()
+        self.simulationPool = None
+        self.simulationJobs = None
 
         # Initialize the variables
 
-        self.RRs, self.nuclideNames, self.fluenceLabels, self.numericArray, self.washoutProfilesAll, self.reshaped_array, self.mappingVector, self.mappingVectorRR, self.inputImage, self.craterProfile = self.unpack_data()
-
         self.currentElement = 0 # W in the simulateAblation function
         self.currentFluence = 0 # fluence in the simulateAblation function
         self.currentRR = 0 # repetition rate in the simulateAblation function
 
         self.switch_var = ctk.StringVar(value="off")
         self.colormapCurrent = ctk.StringVar(value=" Gray ")
+        self.colormaps = {" Gray ": 'gray', " Inferno ": 'inferno', " Viridis ": 'viridis'}
         self.useCustomBeamProfile_var = ctk.StringVar(value="off")
 
         self.useRR = ctk.BooleanVar(value = True)
@@ -42,13 +48,44 @@ class WashoutApp(ctk.CTk):
         self.scanningSpeed = ctk.IntVar(value=2000) # Scanning speed in um/s
         self.previousScanningSpeed = ctk.IntVar(value=2000)
         self.flickerNoise = ctk.IntVar(value=5) # Flicker noise in %, advanced setting
+
+        # Live mode: a parameter change starts a new simulation (replacing the running one) once
+        # the parameters have been left alone for liveDelay ms
+        self.liveMode = ctk.StringVar(value="off")
+        self.liveDelay = 300
+        self.liveAfterId = None
+
+        # Every run starts with a preview on the input downsampled by previewFactor, shown until the full run finishes
+        self.previewFactor = 4
+        self.previewJobId = None
+        self.previewResult = None
+        # Preview SSIM and its deviation from the full run, kept on the SSIM label until the next run
+        self.previewNote = ""
+
+        # After the full run, the SSIM spread is estimated from ensembleSize noise draws of the same noise-free image
+        self.ensembleSize = 32
+        self.ensembleJobId = None
+        self.simulationParameters = None
+
+        # Worker messages wake the Tk loop through a virtual event generated on the listener thread, which
+        # needs a Tcl built with threads. Otherwise (or once generating the event fails) the messages are
+        # polled every simulationPollInterval ms; with the event, the poll only runs as a slow safety net.
+        self.simulationPollInterval = 20
+        self.simulationSafetyInterval = 250
+        self.wakeByEvent = False
+
+        # While the performance panel is open, the full run is profiled and its stages are listed there
+        self.performanceMode = ctk.StringVar(value="off")
+        self.lastProfile = None
+
+        # Instant SSIM estimate of the current parameters, shown while no simulation is running (None without an SSIM surface)
+        self.ssimSurrogate = None
         
         # Hard coded min and max for scanning speed
         self.minSS=int(10)
         self.maxSS=int(10000)
 
-        # Save the default crater profile
-        self.craterProfileDefault = self.craterProfile
+        self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
         # Supergaussian order n
         self.n = ctk.DoubleVar(value=10)
@@ -58,36 +95,106 @@ class WashoutApp(ctk.CTk):
         self.configure(bg_color='#2b2b2b')  # Set the background color of the main window to gray
         self.iconbitmap('icon.ico') # Set the icon of the window
 
+        # Loading indicator, shown until the data is loaded and the tabs are built
+        self.loadingFrame = ctk.CTkFrame(self, fg_color='#2b2b2b')
+        self.loadingFrame.pack(fill=ctk.BOTH, expand=1)
+        ctk.CTkLabel(self.loadingFrame, text="Loading data...", font=("Helvetica", 18)).pack(side='top', pady=(320, 10))
+        self.loadingBar = ctk.CTkProgressBar(self.loadingFrame, orientation="horizontal", mode='indeterminate')
+        self.loadingBar.pack(side='top', padx=300, pady=10, fill='x')
+        self.loadingBar.start()
 
-        main_frame = ctk.CTkFrame(self, fg_color='#2b2b2b')
-        main_frame.pack(fill=ctk.BOTH, expand=1)
-
-        # Create a tab view (tabbed interface)
-        self.tabview = ctk.CTkTabview(master=main_frame, anchor=ctk.NW, corner_radius=10, fg_color="#2b2b2b", bg_color="#2b2b2b")
-        self.tabview.pack(fill=ctk.BOTH, expand=1, padx=10, pady=10)
+        # Load the data and import matplotlib on a background thread. Tk widgets can only be
+        # created on the main thread, so the tabs are built there once loading has finished.
+        self.loadingResult = None
+        threading.Thread(target=self.loadInBackground, name="loader", daemon=True).start()
+        self.after(20, self.checkLoading)
 
-        # Add tabs to the tab view
-        self.tabview.add("SPR Profiles")
-        self.tabview.add("Image Quality")
-        #self.tabview.add("Test tab")
-
-        # Create frames for each tab
-        self.tab1 = self.tabview.tab("SPR Profiles")
-        self.tab2 = self.tabview.tab("Image Quality")
+        #from util import simulateAblation
 
-        # Add content to the first tab
-        self.setup_tab1()
+    def loadInBackground(self):
+        try:
+            for module in ("matplotlib.figure", "matplotlib.backends.backend_tkagg"):
+                self.startupTimer.importModule(module)
+            with self.startupTimer.step("load data"):
+                values = self.unpack_data()
+            # The response curves must be on disk before the worker looks them up
+            with self.startupTimer.step("response bank"):
+                self.data["responseBank"]
+            with self.startupTimer.step("SSIM surface"):
+                self.ssimSurrogate = self.data["ssimSurrogate"]
+            self.loadingResult = values
+        except Exception as e:
+            self.loadingResult = e
+
+    def checkLoading(self):
+        if self.loadingResult is None:
+            self.after(20, self.checkLoading)
+            return
+        if isinstance(self.loadingResult, Exception):
+            print(f"Loading the data failed: {self.loadingResult}")
+            self.loadingBar.stop()
+            from CTkMessagebox import CTkMessagebox
+            CTkMessagebox(title="Error", message=f"Loading the data failed:\n{self.loadingResult}", icon="cancel.png")
+            return
+
+        self.RRs, self.nuclideNames, self.fluenceLabels, self.numericArray, self.washoutProfilesAll, self.mappingVector, self.mappingVectorRR, self.inputImage, self.craterProfile = self.loadingResult
 
-        # Add content to the second tab
-        self.setup_tab2()
+        # Save the default crater profile
+        self.craterProfileDefault = self.craterProfile
 
-        #from util import simulateAblation
+        # Start the simulation worker now, so that it is warm by the time the first simulation runs
+        with self.startupTimer.step("start simulation worker"):
+            self.simulationPool = SimulationPool(self.inputImage, self.washoutProfilesAll, self.nuclideNames)
+        # Messages from the worker wake the Tk loop through a virtual event (generated on the listener thread)
+        # if Tcl is thread-safe, and are polled on the Tk thread otherwise
+        self.simulationJobs = SimulationJobs(self.simulationPool, self.simulationFinished, self.simulationProgress)
+        self.wakeByEvent = bool(self.tk.call('info', 'exists', 'tcl_platform(threaded)'))
+        if self.wakeByEvent:
+            self.bind("<<SimulationEvent>>", lambda event: self.simulationJobs.handleEvents())
+            self.simulationPool.listen(self.wakeSimulationEvents)
+        self.pollSimulationEvents()
+
+        self.loadingBar.stop()
+        self.loadingFrame.destroy()
+
+        with self.startupTimer.step("build tab 1"):
+            main_frame = ctk.CTkFrame(self, fg_color='#2b2b2b')
+            main_frame.pack(fill=ctk.BOTH, expand=1)
+
+            # Create a tab view (tabbed interface)
+            self.tabview = ctk.CTkTabview(master=main_frame, anchor=ctk.NW, corner_radius=10, fg_color="#2b2b2b", bg_color="#2b2b2b")
+            self.tabview.pack(fill=ctk.BOTH, expand=1, padx=10, pady=10)
+
+            # Add tabs to the tab view
+            self.tabview.add("SPR Profiles")
+            self.tabview.add("Image Quality")
+            #self.tabview.add("Test tab")
+
+            # Create frames for each tab
+            self.tab1 = self.tabview.tab("SPR Profiles")
+            self.tab2 = self.tabview.tab("Image Quality")
+
+            # Add content to the first tab
+            self.setup_tab1()
+
+        # The second tab is built after the first one has been drawn
+        self.after_idle(self.finishStartup)
+
+    def finishStartup(self):
+        with self.startupTimer.step("build tab 2"):
+            # Add content to the second tab
+            self.setup_tab2()
+        print(self.startupTimer.report(self.data))
 
     def unpack_data(self):
-        keys = ["RRs", "nuclideNames", "fluenceLabels", "numericArray", "washoutProfilesAll", "reshaped_array", "mappingVector", "mappingVectorRR", "inputImage", "craterProfile"]
+        # Only the assets used by the GUI; the others stay on disk until they are needed
+        keys = ["RRs", "nuclideNames", "fluenceLabels", "numericArray", "washoutProfilesAll", "mappingVector", "mappingVectorRR", "inputImage", "craterProfile"]
         return [self.data[key] for key in keys]
 
     def setup_tab1(self):
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
+
         # Create a left frame for controls and a right frame for the plot
         left_frame = ctk.CTkFrame(self.tab1, width=200, fg_color='#2b2b2b')
         left_frame.pack(side=ctk.LEFT, fill=ctk.Y, padx=10, pady=10)
@@ -102,8 +209,26 @@ class WashoutApp(ctk.CTk):
         self.canvas = FigureCanvasTkAgg(self.figure, master=right_frame)
         self.axes = self.figure.add_subplot(111, facecolor='#2b2b2b')  # Match the axes' background color
 
-        self.axes.set_xlabel("Signal (cps)")
-        self.axes.set_ylabel("Time (ms)")
+        # Set labels and title
+        self.axes.set_xlabel('Time (ms)', color='#ffffff')
+        self.axes.set_ylabel('Signal (cps)', color='#ffffff')
+        self.axes.set_title('SPR Profiles', color='#ffffff')
+        self.axes.tick_params(axis='x', colors='#ffffff')
+        self.axes.tick_params(axis='y', colors='#ffffff')
+
+        # Change the edge color of the plot area to white if needed
+        for spine in self.axes.spines.values():
+            spine.set_edgecolor('#ffffff')
+
+        # The curve is created once and updated by plot_data; only the curve is redrawn (blitted)
+        data = self.washoutProfilesAll[:, self.currentElement, self.currentFluence]
+        # Set the x-axis values spaced out every 3 ms
+        time = np.arange(0, data.shape[0] * 3, 3)
+        # Define a color for the plot that matches customtkinter's theme
+        plot_color = '#0a84ff'  # A shade of blue that complements customtkinter's default theme
+        self.profileBlitter = BlittedFigure(self.canvas)
+        self.profileLine = self.profileBlitter.add(self.axes.plot(time, data, color=plot_color)[0])
+        self.profileElement = None # nuclide the y axis is scaled for
         self.canvas.get_tk_widget().pack(fill=ctk.BOTH, expand=True)
 
         # Add a title above the combo box
@@ -141,6 +266,11 @@ class WashoutApp(ctk.CTk):
         self.plot_data(self.currentElement, self.currentFluence)
 
     def setup_tab2(self):
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
+        from tktooltip import ToolTip
+        from CTkSpinbox import CTkSpinbox
+
         # Step 1: Create a Frame for the Second Tab
         tab2_frame1 = ctk.CTkFrame(master=self.tab2, width=167, fg_color='#2b2b2b')
         tab2_frame1.pack(side='left', padx=5, pady=5, fill='y', expand=False)
@@ -165,6 +295,10 @@ class WashoutApp(ctk.CTk):
         self.frame2_progressBar.pack(side='top', padx=5, pady=0, fill='x', expand=False)
         self.frame2_progressBar.pack_propagate(False)
 
+        # Progress bar that follows the finished scan lines, with the estimated time left next to it (shown while running)
+        self.progressBar = ctk.CTkProgressBar(self.frame2_progressBar, orientation="horizontal", mode='determinate')
+        self.progressLabel = ctk.CTkLabel(self.frame2_progressBar, text="", font=("Helvetica", 12), height=20)
+
         frame2_upper = ctk.CTkFrame(tab2_frame2, height=40, fg_color='#2b2b2b')
         frame2_upper.pack(side='top', padx=5, pady=0, fill='x', expand=False)
         frame2_upper.pack_propagate(False)
@@ -198,6 +332,7 @@ class WashoutApp(ctk.CTk):
 
         self.SSIMLabel = ctk.CTkLabel(subframe3, text="Structural Similarity Index:     ", font=("Helvetica", 18), text_color="#FFFFFF",  anchor="center")
         self.MappingTimeLabel = ctk.CTkLabel(subframe3, text="Mapping Time:     ", font=("Helvetica", 18), text_color="#FFFFFF",  anchor="center")
+        self.SSIMLabel.configure(text=self.ssimEstimateText())
         self.SSIMLabel.grid(row=0, column=1, padx=5, pady=5, sticky='nsew')
         self.MappingTimeLabel.grid(row=0, column=0, padx=5, pady=5, sticky='nsew')
 
@@ -225,6 +360,25 @@ class WashoutApp(ctk.CTk):
         self.runSimulationButton = ctk.CTkButton(frame2_lower, text="Run Simulation", font=("Helvetica", 16), command=self.executeSimulation)
         self.runSimulationButton.pack(side='right', padx=(8, 5), pady=16)
 
+        # Live mode switch
+        self.liveSwitch = ctk.CTkSwitch(frame2_lower, text="Live", font=("Helvetica", 16), command=self.toggleLiveMode,
+                                        variable=self.liveMode, onvalue="on", offvalue="off")
+        self.liveSwitch.pack(side='right', padx=(8, 5), pady=16)
+
+        # Performance panel switch
+        self.performanceSwitch = ctk.CTkSwitch(frame2_lower, text="Performance", font=("Helvetica", 16), command=self.togglePerformancePanel,
+                                               variable=self.performanceMode, onvalue="on", offvalue="off")
+        self.performanceSwitch.pack(side='right', padx=(8, 5), pady=16)
+
+        # Performance panel: time, CPU time, peak memory and shapes of every stage of the last profiled run (hidden until switched on)
+        self.performanceFrame = ctk.CTkFrame(tab2_frame2, fg_color='#333333')
+        self.performanceText = ctk.CTkTextbox(self.performanceFrame, height=140, font=("Courier", 12), wrap='none')
+        self.performanceText.pack(side='left', padx=5, pady=5, fill='both', expand=True)
+        self.performanceText.insert("end", "Run a simulation to profile it.")
+        self.performanceText.configure(state='disabled')
+        self.exportProfileButton = ctk.CTkButton(self.performanceFrame, text="Export", font=("Helvetica", 16), width=80, command=self.exportProfile, state='disabled')
+        self.exportProfileButton.pack(side='right', padx=5, pady=5, anchor='s')
+
         # Use grid layout for the frames that will contain the figures
         frame2_mid.grid_columnconfigure(0, weight=1)
         frame2_mid.grid_columnconfigure(1, weight=1)
@@ -241,22 +395,18 @@ class WashoutApp(ctk.CTk):
         #img = generateImage()
         img = np.ones((100, 100))
 
-        # Create the first figure
+        # Create the first figure; the image is updated in place by update_image
         self.fig1 = Figure(facecolor='#2b2b2b')
-        ax1 = self.fig1.add_subplot()  # Create a single plot for the first figure
-        ax1.imshow(img, cmap='gray')
-        ax1.axis('off')
         self.canvas1 = FigureCanvasTkAgg(self.fig1, master=figure1_frame)
+        self.imagePane1 = ImagePane(self.canvas1, img, cmap=self.colormaps[self.colormapCurrent.get()])
         self.canvas1.draw()
         self.canvas1.get_tk_widget().pack(fill='both', expand=True)
         self.canvas1.get_tk_widget().pack_propagate(True)
 
         # Create the second figure
         self.fig2 = Figure(facecolor='#2b2b2b')
-        ax2 = self.fig2.add_subplot()  # Create a single plot for the second figure
-        ax2.imshow(img, cmap='gray')
-        ax2.axis('off')
         self.canvas2 = FigureCanvasTkAgg(self.fig2, master=figure2_frame)
+        self.imagePane2 = ImagePane(self.canvas2, img, cmap=self.colormaps[self.colormapCurrent.get()])
         self.canvas2.draw()
         self.canvas2.get_tk_widget().pack(fill='both', expand=True)
         self.canvas2.get_tk_widget().pack_propagate(True)
@@ -430,6 +580,10 @@ class WashoutApp(ctk.CTk):
                       variable=self.switch_var, onvalue="on", offvalue="off")
         #self.switchAdvanced.pack(pady=16)
 
+        # Any change of the simulation parameters restarts the simulation in live mode
+        for variable in (self.repetitionRate, self.scanningSpeed, self.C_sample, self.dosage, self.flickerNoise):
+            variable.trace_add("write", self.parametersChanged)
+
     def changeRepetitionRate(self, value):
         D = self.dosage.get()
         SS = self.scanningSpeed.get()
@@ -608,105 +762,209 @@ class WashoutApp(ctk.CTk):
             self.spinboxRepetitionRateLabel.configure(text_color='#888888')
 
     def update_image(self, image, figure_number):
-        if self.colormapCurrent.get() == " Gray ":
-            print(self.colormapCurrent.get())
-            cmap = 'gray'
-        elif self.colormapCurrent.get() == " Inferno ":
-            print(self.colormapCurrent.get())
-            cmap = 'inferno'
-        else:
-            print(self.colormapCurrent.get())
-            cmap = 'viridis'
-
+        # The image is replaced in place and redrawn in the next frame (see plotting.ImagePane)
         if figure_number == 1:
-            # Clear the existing axes for figure 1
-            self.fig1.clf()
-            # Add a new subplot to fig1
-            ax1 = self.fig1.add_subplot()
-            # Display the new image on ax1
-            ax1.imshow(image, cmap=cmap)
-            ax1.axis('off')
-            self.fig1.tight_layout(pad=0)
-            # Redraw the canvas
-            self.canvas1.draw()
+            self.imagePane1.show(image)
         elif figure_number == 2:
-            # Clear the existing axes for figure 2
-            self.fig2.clf()
-            # Add a new subplot to fig2
-            ax2 = self.fig2.add_subplot()
-            # Display the new image on ax2
-            ax2.imshow(image, cmap=cmap)
-            ax2.axis('off')
-            self.fig2.tight_layout(pad=0)
-            # Redraw the canvas
-            self.canvas2.draw()
+            self.imagePane2.show(image)
 
     def executeSimulation(self):
+        # The run button cancels the simulation while one is running
+        if self.simulationRunning():
+            self.cancelSimulation()
+        else:
+            self.startSimulation()
+
+    def simulationRunning(self):
+        # A preview or full run is in flight; the noise ensemble after a run only updates the SSIM label
+        return any(jobId != self.ensembleJobId for jobId in self.simulationJobs.startTimes)
+
+    def startSimulation(self):
         print("Executing simulation")
+        if self.liveAfterId is not None:
+            self.after_cancel(self.liveAfterId)
+            self.liveAfterId = None
 
-        # Disable the button to prevent multiple executions
-        self.runSimulationButton.configure(state="disabled", text="Running")
+        # The button cancels the run from now on
+        self.runSimulationButton.configure(text="Cancel")
 
-        # Create a progress bar and start it
-        progressbar = ctk.CTkProgressBar(self.frame2_progressBar, orientation="horizontal", mode='indeterminate', determinate_speed=2)
-        progressbar.pack(side='bottom', padx=5, pady=0, fill='x', expand=False)
-        progressbar.start()
+        # Reset and show the progress bar
+        self.progressBar.set(0)
+        self.progressLabel.configure(text="")
+        self.progressLabel.pack(side='right', padx=5, pady=0)
+        self.progressBar.pack(side='left', padx=5, pady=0, fill='x', expand=True)
 
         # Update the SSIM and Mapping Time labels
-        self.SSIMLabel.configure(text="Structural Similarity Index:     ")
+        self.SSIMLabel.configure(text=self.ssimEstimateText())
         self.MappingTimeLabel.configure(text="Mapping Time:     ")
 
-        # Create a queue for communication
-        resultQueue = multiprocessing.Queue()
-
-        # Create and start a separate process
-        simulationProcess = multiprocessing.Process(target=simulateAblationWrapper, args=(self.inputImage, 
-                                                                                          self.craterProfile, 
-                                                                                          self.washoutProfilesAll,
-                                                                                          self.nuclideNames, 
-                                                                                          self.repetitionRate.get(),
-                                                                                          self.currentElement, 
-                                                                                          self.C_sample.get(), 
-                                                                                          self.currentFluence, 
-                                                                                          self.dosage.get(), 
-                                                                                          self.scanningSpeed.get(),
-                                                                                          self.flickerNoise.get(),
-                                                                                          self.useRR.get(), 
-                                                                                          resultQueue))
-        simulationProcess.start()
-
-        # Check for the result in a non-blocking way
-        def checkProcess():
-            if not resultQueue.empty():
-                result = resultQueue.get()
-                # Check if the simulation was successful
-                if all(item is not None for item in result):
-                    referenceImage, SmearedImagePFNoiseNormFinal, max_ssim, nuclide, mapTime = result
-                    self.update_image(referenceImage, 1)
-                    self.update_image(SmearedImagePFNoiseNormFinal, 2)
-                    # Update button text
-                    self.runSimulationButton.configure(state="normal", text="Run Simulation")
-                    # Remove the progress bar
-                    progressbar.stop()
-                    progressbar.pack_forget()
-                    # Update SSIM and Mapping Time labels
-                    self.SSIMLabel.configure(text="Structural Similarity Index: {:.3f}".format(max_ssim))
-                    self.MappingTimeLabel.configure(text="Mapping Time: {:.2f} s".format(mapTime))
-                else:
-                    # Handle the error case
-                    self.runSimulationButton.configure(state="normal", text="Run Simulation")
-                    progressbar.stop()
-                    progressbar.pack_forget()
-                    # Schedule the error display on the UI thread
-                    self.after(0, self.show_error)
+        # Hand the simulation to the (already running) worker, replacing the one in flight: first a quick
+        # low-resolution preview, then the full run. The full map is simulated line by line in bands of a
+        # few lines, so the progress is updated about progressUpdates times per run.
+        parameters = dict(repetitionRate=self.repetitionRate.get(),
+                          W=self.currentElement,
+                          C_sample=self.C_sample.get(),
+                          fluence=self.currentFluence,
+                          dosage=self.dosage.get(),
+                          scanningSpeed=self.scanningSpeed.get(),
+                          flickerNoise=self.flickerNoise.get(),
+                          useRR=self.useRR.get())
+        progressUpdates = 30
+        numLines = math.ceil(self.inputImage.shape[0] / 20)
+        self.previewResult = None
+        self.previewNote = ""
+        self.simulationParameters = parameters
+        self.previewJobId = self.simulationJobs.submit(self.craterProfile, previewFactor=self.previewFactor, **parameters)
+        self.simulationJobs.submit(self.craterProfile, supersede=False, progressive=True, profile=self.performanceMode.get() == "on",
+                                   bandLines=max(1, math.ceil(numLines / progressUpdates)), **parameters)
+
+    def cancelSimulation(self):
+        self.simulationJobs.cancelAll()
+        self.simulationStopped()
+
+    def simulationStopped(self):
+        # Remove the progress bar and restore the button
+        self.progressBar.pack_forget()
+        self.progressLabel.pack_forget()
+        self.runSimulationButton.configure(text="Run Simulation")
+
+    def simulationProgress(self, jobId, linesDone, numLines):
+        self.progressBar.set(linesDone / numLines)
+        remaining = self.simulationJobs.elapsed(jobId) * (numLines - linesDone) / linesDone
+        self.progressLabel.configure(text="{}/{} lines, {:.0f} s left".format(linesDone, numLines, remaining))
+        # Draw the lines finished since the last update, unless the preview is shown
+        if self.previewResult is None:
+            referencePreview, simulatedPreview = self.simulationPool.preview(jobId)
+            self.update_image(simulatedPreview, 2)
+
+    def simulationFinished(self, jobId, result):
+        if jobId == self.ensembleJobId:
+            self.ensembleJobId = None
+            if result[2] is not None:
+                statistics = result[2]
+                low, high = statistics["percentiles"][2.5], statistics["percentiles"][97.5]
+                self.SSIMLabel.configure(text="Structural Similarity Index: {:.3f} \u00B1 {:.3f} (95%: {:.3f}\u2013{:.3f})".format(statistics["mean"], statistics["std"], low, high) + self.previewNote)
+            return
+
+        if jobId == self.previewJobId:
+            # Show the preview until the full run is done; a failed preview is left to the full run
+            if all(item is not None for item in result):
+                self.previewResult = result
+                referenceImage, SmearedImagePFNoiseNormFinal, max_ssim, nuclide, mapTime = result
+                self.update_image(referenceImage, 1)
+                self.update_image(SmearedImagePFNoiseNormFinal, 2)
+                self.SSIMLabel.configure(text="Structural Similarity Index: {:.3f} (preview)".format(max_ssim))
+                self.MappingTimeLabel.configure(text="Mapping Time: {:.2f} s".format(mapTime))
+            return
+
+        profile = self.simulationPool.profile(jobId)
+        if profile is not None:
+            self.showProfile(profile)
+
+        # Check if the simulation was successful
+        if all(item is not None for item in result):
+            # The run is done; the SSIM spread over noise draws is estimated in the background. The full run
+            # left its noise-free image in the worker's stage cache, so the ensemble only draws the noise.
+            self.simulationStopped()
+            self.ensembleJobId = self.simulationJobs.submit(self.craterProfile, supersede=False, ensemble=True,
+                                                            numRealizations=self.ensembleSize, **self.simulationParameters)
+            referenceImage, SmearedImagePFNoiseNormFinal, max_ssim, nuclide, mapTime = result
+            self.update_image(referenceImage, 1)
+            self.update_image(SmearedImagePFNoiseNormFinal, 2)
+            # Update SSIM and Mapping Time labels, with the deviation of the preview if there was one
+            if self.previewResult is not None:
+                previewSSIM = self.previewResult[2]
+                deviation = previewDeviation(self.previewResult[1], SmearedImagePFNoiseNormFinal)
+                self.previewNote = " (preview {:.3f}, {:+.3f}; RMS {:.3f})".format(previewSSIM, previewSSIM - max_ssim, deviation)
             else:
-                # Re-check after some delay
-                self.after(100, checkProcess)  # Assuming you're using Tkinter
-
-        checkProcess()
+                self.previewNote = ""
+            self.SSIMLabel.configure(text="Structural Similarity Index: {:.3f}".format(max_ssim) + self.previewNote)
+            self.MappingTimeLabel.configure(text="Mapping Time: {:.2f} s".format(mapTime))
+        else:
+            self.simulationStopped()
+            # Schedule the error display on the UI thread
+            self.after(0, self.show_error)
+
+    def wakeSimulationEvents(self):
+        # Called on the listener thread. If the event cannot be generated (the window is gone or Tcl
+        # refuses calls from other threads), the messages stay in the pool's queue and the Tk thread
+        # switches to polling them.
+        try:
+            self.event_generate("<<SimulationEvent>>", when="tail")
+        except (RuntimeError, TclError):
+            self.wakeByEvent = False
+
+    def pollSimulationEvents(self):
+        # Runs on the Tk thread for the lifetime of the window
+        self.simulationJobs.handleEvents()
+        self.after(self.simulationSafetyInterval if self.wakeByEvent else self.simulationPollInterval, self.pollSimulationEvents)
+
+    def togglePerformancePanel(self):
+        if self.performanceMode.get() == "on":
+            self.performanceFrame.pack(side='bottom', padx=5, pady=0, fill='x', expand=False)
+        else:
+            self.performanceFrame.pack_forget()
+
+    def showProfile(self, profile):
+        self.lastProfile = profile
+        self.performanceText.configure(state='normal')
+        self.performanceText.delete("1.0", "end")
+        self.performanceText.insert("end", profile.report())
+        self.performanceText.configure(state='disabled')
+        self.exportProfileButton.configure(state='normal')
+
+    def exportProfile(self):
+        # The records as JSON (profiling.Profile.toDict) or in the Chrome trace format (chrome://tracing, Perfetto)
+        from tkinter import filedialog
+        path = filedialog.asksaveasfilename(title="Export profile", defaultextension=".json",
+                                            filetypes=[("Profile", "*.json"), ("Chrome trace", "*.trace.json")])
+        if not path:
+            return
+        self.lastProfile.save(path, format="chrome" if path.endswith(".trace.json") else "json")
+        print(f"Profile written to {path}")
+
+    def toggleLiveMode(self):
+        self.parametersChanged()
+
+    def ssimEstimateText(self):
+        # SSIM label text with the estimate of the current parameters from the SSIM surface, if there is one
+        estimate = None
+        if self.ssimSurrogate is not None:
+            try:
+                estimate = self.ssimSurrogate.estimate(self.currentElement, self.currentFluence, self.dosage.get(), self.repetitionRate.get(), self.C_sample.get())
+            except TclError:
+                # A spinbox is being edited and does not hold a number
+                pass
+        if estimate is None:
+            return "Structural Similarity Index:     "
+        return "Structural Similarity Index: \u2248{:.2f} (estimate)".format(estimate)
+
+    def parametersChanged(self, *args):
+        # Show the estimate for the new parameters, unless a simulation is updating the label; the noise
+        # ensemble of the previous parameters is dropped
+        if self.simulationJobs is not None and not self.simulationRunning() and hasattr(self, "SSIMLabel"):
+            self.simulationJobs.cancel(self.ensembleJobId)
+            self.SSIMLabel.configure(text=self.ssimEstimateText())
+        # In live mode, (re)start the debounce timer; the simulation starts when it runs out
+        if self.liveMode.get() != "on" or self.simulationJobs is None:
+            return
+        if self.liveAfterId is not None:
+            self.after_cancel(self.liveAfterId)
+        self.liveAfterId = self.after(self.liveDelay, self.startSimulation)
     
+    def on_closing(self):
+        # Stop the worker and release the shared memory before closing the window
+        if self.liveAfterId is not None:
+            self.after_cancel(self.liveAfterId)
+        if self.simulationPool is not None:
+            self.simulationPool.shutdown()
+        print("Assets used in this session:")
+        print(self.data.report())
+        self.destroy()
+
     def show_error(self):
         # Show some error message
+        from CTkMessagebox import CTkMessagebox
         CTkMessagebox(title="Error", message="The selected conditions failed to produce an output image.\nPlease select different input parameters.", icon="cancel.png")
 
     def switchShowAdvanced(self, container):
@@ -723,28 +981,8 @@ class WashoutApp(ctk.CTk):
                 self.craterProfile = self.craterProfileDefault
 
     def change_colormap(self,value):
-        # Check if the switch is on or off
-        if value == " Gray ":
-            # Change the colormap to 'gray'
-            #self.colormap_switch.configure(text="Colormap: Inferno")
-            self.fig1.get_axes()[0].images[0].set_cmap('gray')
-            self.fig2.get_axes()[0].images[0].set_cmap('gray')
-            self.canvas1.draw()
-            self.canvas2.draw()
-        elif value == " Inferno ":
-            # Change the colormap to 'inferno'
-            #self.colormap_switch.configure(text="Colormap: Inferno")
-            self.fig1.get_axes()[0].images[0].set_cmap('inferno')
-            self.fig2.get_axes()[0].images[0].set_cmap('inferno')
-            self.canvas1.draw()
-            self.canvas2.draw()
-        else:
-            # Change the colormap to 'viridis'
-            #self.colormap_switch.configure(text="Colormap: Gray")
-            self.fig1.get_axes()[0].images[0].set_cmap('viridis')
-            self.fig2.get_axes()[0].images[0].set_cmap('viridis')
-            self.canvas1.draw()
-            self.canvas2.draw()
+        self.imagePane1.setColormap(self.colormaps[value])
+        self.imagePane2.setColormap(self.colormaps[value])
 
     def useCustomBeamProfileShow(self, value=None):
         if self.useCustomBeamProfile_var.get() == "on":
@@ -764,6 +1002,7 @@ class WashoutApp(ctk.CTk):
             self.profileLabel.pack_forget()
             # Reset the beam profile to the default
             self.craterProfile = self.craterProfileDefault
+            self.parametersChanged()
 
     def useCustomBeamProfile(self, value=None):
         current_n_value = self.nSlider.get()
@@ -771,6 +1010,7 @@ class WashoutApp(ctk.CTk):
         # Update the beam profile
         self.craterProfile = generateBeamProfile(n=current_n_value)
         self.plotBeamProfile()
+        self.parametersChanged()
 
     def plotBeamProfile(self):
         # Obtain the current craterProfile
@@ -788,46 +1028,27 @@ class WashoutApp(ctk.CTk):
         self.label.configure(text='Fluence = {:.2f} J cm\u207B\u00B2'.format(fluence_value))
         self.currentFluence = index
         self.plot_data(self.currentElement, self.currentFluence)
+        self.parametersChanged()
 
     def comboBox_currentIndexChanged(self, event):
         selected_element = self.comboBox.get()  # Retrieve the selected element from the comboBox
         nuclideNamesList = self.nuclideNames.tolist()  # Convert numpy.ndarray to list
         self.currentElement = nuclideNamesList.index(selected_element)  # Find the index of the selected element in the list
         self.plot_data(self.currentElement, self.currentFluence)
+        self.parametersChanged()
 
     def plot_data(self, currentElement, currentFluence):
-        # Clear the previous plot
-        self.axes.clear()
         # Get the data from the washoutProfilesAll 3D array
         data = self.washoutProfilesAll[:, currentElement, currentFluence]
-        
-        # Set the x-axis values spaced out every 3 ms
-        time = np.arange(0, data.shape[0] * 3, 3)
-
-        # Define a color for the plot that matches customtkinter's theme
-        plot_color = '#0a84ff'  # A shade of blue that complements customtkinter's default theme
-
-        # Plot the data
-        self.axes.plot(time, data, color=plot_color)
-
-        # Set axes background to white
-        self.axes.set_facecolor('#2b2b2b')
-        # Set figure background to dark gray
-        self.figure.patch.set_facecolor('#2b2b2b')
-
-        # Set labels and title
-        self.axes.set_xlabel('Time (ms)', color='#ffffff')
-        self.axes.set_ylabel('Signal (cps)', color='#ffffff')
-        self.axes.set_title('SPR Profiles', color='#ffffff')
-        self.axes.tick_params(axis='x', colors='#ffffff')
-        self.axes.tick_params(axis='y', colors='#ffffff')
-
-        # Change the edge color of the plot area to white if needed
-        for spine in self.axes.spines.values():
-            spine.set_edgecolor('#ffffff')
-
-        # Refresh the canvas
-        self.canvas.draw()
+        self.profileLine.set_ydata(data)
+        # The y axis covers the profiles of all fluences of the nuclide, so moving the fluence slider
+        # only redraws the curve; a new nuclide rescales the axis, which needs a full draw
+        if currentElement != self.profileElement:
+            self.profileElement = currentElement
+            self.axes.set_ylim(*dataLimits(self.washoutProfilesAll[:, currentElement, :]))
+            self.profileBlitter.requestFrame(fullDraw=True)
+        else:
+            self.profileBlitter.requestFrame()
 
 if __name__ == "__main__":
     multiprocessing.freeze_support()
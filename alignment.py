@@ -0,0 +1,129 @@
+import numpy as np
+import scipy.fft
+from scipy.ndimage import uniform_filter
+
+# Alignment of the simulated image with the reference image. The washout delays the signal along
+# the scan direction, so the simulated image is compared with the reference at several column
+# shifts and the shift with the highest SSIM is kept.
+
+def referenceStatistics(referenceImage, winSize=7):
+    # Local statistics of the reference, shared by all candidate shifts
+    NP = winSize ** 2
+    cov_norm = NP / (NP - 1) # sample covariance
+    uy = uniform_filter(referenceImage, size=winSize)
+    uyy = uniform_filter(referenceImage * referenceImage, size=winSize)
+    vy = cov_norm * (uyy - uy * uy)
+    return {"image": referenceImage, "uy": uy, "uy2": uy**2, "vy": vy, "winSize": winSize}
+
+# Number of images filtered together; small batches keep the temporaries in the CPU cache
+_ssimBatchSize = 4
+
+def batchedSSIM(images, referenceImage, dataRange=1.0, winSize=7, statistics=None, divisors=None):
+    # structural_similarity(images[i], referenceImage, data_range=dataRange) for a stack of images.
+    # The arithmetic is the same as in skimage (uniform window, sample covariance, same operation
+    # order), so the values are identical, but the reference statistics are computed only once
+    # and the intermediate arrays are updated in place.
+    # With divisors, images[i] / divisors[i] is compared instead; the division is done one batch
+    # at a time, so the normalized stack never exists in full.
+    if statistics is None:
+        statistics = referenceStatistics(referenceImage, winSize)
+    values = []
+    for i in range(0, len(images), _ssimBatchSize):
+        batch = images[i:i + _ssimBatchSize]
+        if divisors is not None:
+            batch = batch / divisors[i:i + _ssimBatchSize]
+        values.append(_batchedSSIM(batch, statistics, dataRange))
+    return np.concatenate(values)
+
+def _batchedSSIM(images, statistics, dataRange):
+    referenceImage, uy, uy2, vy, winSize = (statistics[key] for key in ("image", "uy", "uy2", "vy", "winSize"))
+    size = (1, winSize, winSize)
+    NP = winSize ** 2
+    cov_norm = NP / (NP - 1)
+    C1 = (0.01 * dataRange) ** 2
+    C2 = (0.03 * dataRange) ** 2
+
+    ux = uniform_filter(images, size=size)
+    vx = uniform_filter(images * images, size=size)
+    vxy = uniform_filter(images * referenceImage, size=size)
+    # vx = cov_norm * (uxx - ux * ux)
+    vx -= ux * ux
+    vx *= cov_norm
+    # vxy = cov_norm * (uxy - ux * uy)
+    vxy -= ux * uy
+    vxy *= cov_norm
+    # A1 = 2 * ux * uy + C1
+    A1 = 2 * ux
+    A1 *= uy
+    A1 += C1
+    # A2 = 2 * vxy + C2
+    A2 = vxy
+    A2 *= 2
+    A2 += C2
+    # B1 = ux**2 + uy**2 + C1
+    B1 = ux
+    B1 *= ux
+    B1 += uy2
+    B1 += C1
+    # B2 = vx + vy + C2
+    B2 = vx
+    B2 += vy
+    B2 += C2
+    # S = (A1 * A2) / (B1 * B2)
+    A1 *= A2
+    B1 *= B2
+    S = A1
+    S /= B1
+
+    # Ignore the filter radius around the edges, mean per image as skimage does
+    pad = (winSize - 1) // 2
+    return np.array([S[i, pad:-pad, pad:-pad].mean(dtype=np.float64) for i in range(len(S))])
+
+def shiftWindows(image, outputShape, numShifts, firstShift=0):
+    # (numShifts, rows, cols) view of image[:rows, s:s+cols] for s = firstShift..firstShift+numShifts-1;
+    # columns past the right edge read as zeros (only the missing columns are padded)
+    rows, cols = outputShape
+    missing = firstShift + cols + numShifts - 1 - image.shape[1]
+    if missing > 0:
+        image = np.hstack([image, np.zeros((image.shape[0], missing), dtype=image.dtype)])
+    windows = np.lib.stride_tricks.sliding_window_view(image[:rows], cols, axis=1)[:, firstShift:firstShift + numShifts]
+    return windows.transpose(1, 0, 2)
+
+def ssimShiftSearch(image, referenceImage, numShifts=20, firstShift=0):
+    # SSIM of every shifted, renormalized window; returns (shifts, ssim values, windows)
+    windows = shiftWindows(image, referenceImage.shape, numShifts, firstShift)
+    # Normalize every shifted window by its own maximum
+    maxima = np.max(windows, axis=(1, 2), keepdims=True)
+    return np.arange(firstShift, firstShift + numShifts), batchedSSIM(windows, referenceImage, dataRange=1.0, divisors=maxima), windows
+
+def estimateShift(image, referenceImage, maxShift):
+    # Column lag (0..maxShift) that maximizes the cross-correlation of the image with the reference.
+    # The row-wise correlations are summed in the frequency domain, so this is one FFT per image
+    # regardless of how large maxShift is.
+    rows, cols = referenceImage.shape
+    image = image[:rows]
+    a = image - np.mean(image)
+    b = referenceImage - np.mean(referenceImage)
+    n = scipy.fft.next_fast_len(a.shape[1] + cols)
+    spectrum = np.sum(scipy.fft.rfft(a, n, axis=1) * np.conj(scipy.fft.rfft(b, n, axis=1)), axis=0)
+    correlation = scipy.fft.irfft(spectrum, n)
+    return int(np.argmax(correlation[:maxShift + 1]))
+
+def alignToReference(image, referenceImage, mode="search", numShifts=20, refineRadius=2):
+    # Returns (shift, maximum SSIM, aligned image).
+    #   "search": SSIM at the shifts 0..numShifts-1 (the washout delay is assumed to stay below the kernel width)
+    #   "xcorr":  lag from the FFT cross-correlation, anywhere in the image, refined by SSIM at the
+    #             shifts within refineRadius of it
+    if mode == "search":
+        shifts, ssimValues, windows = ssimShiftSearch(image, referenceImage, numShifts)
+    elif mode == "xcorr":
+        maxShift = max(image.shape[1] - referenceImage.shape[1], numShifts - 1)
+        lag = estimateShift(image, referenceImage, maxShift)
+        firstShift = max(lag - refineRadius, 0)
+        shifts, ssimValues, windows = ssimShiftSearch(image, referenceImage, min(lag + refineRadius, maxShift) - firstShift + 1, firstShift)
+    else:
+        raise ValueError(f"Unknown alignment mode: {mode}")
+
+    # Determine the shift that maximizes the SSIM
+    I = np.argmax(ssimValues)
+    return shifts[I], np.max(ssimValues), np.array(windows[I])
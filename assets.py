@@ -0,0 +1,124 @@
+import numpy as np
+import glob
+import hashlib
+import os
+import threading
+import time
+from collections.abc import Mapping
+
+from cache import getCacheDir
+
+# Binary cache for CSV assets. Parsing a large CSV image takes seconds, so every CSV is converted
+# once into a .npy file in the user cache directory and loaded from there afterwards. The cache
+# file is keyed on the absolute path, size and modification time of the CSV; editing or replacing
+# the CSV produces a new key and the stale conversion is removed.
+#   csv-<path hash>-<state hash>-v<version>.npy
+
+_csvCacheVersion = 1
+
+def _pathKey(path):
+    return hashlib.blake2b(os.path.abspath(path).encode(), digest_size=8).hexdigest()
+
+def _stateKey(path):
+    stat = os.stat(path)
+    return hashlib.blake2b(f"{stat.st_size}-{stat.st_mtime_ns}".encode(), digest_size=8).hexdigest()
+
+def parseCSV(path):
+    # np.loadtxt uses the C parser; genfromtxt is only needed for files with missing values
+    try:
+        return np.loadtxt(path, delimiter=',', ndmin=2).squeeze()
+    except ValueError:
+        return np.genfromtxt(path, delimiter=',')
+
+def csvCachePath(path, directory=None):
+    # Path of the .npy conversion of the CSV file, converting it first if needed
+    directory = directory or getCacheDir()
+    pathKey = _pathKey(path)
+    cachePath = os.path.join(directory, f"csv-{pathKey}-{_stateKey(path)}-v{_csvCacheVersion}.npy")
+    if os.path.exists(cachePath):
+        return cachePath
+
+    array = parseCSV(path)
+    temporaryPath = cachePath[:-len('.npy')] + f'.tmp{os.getpid()}.npy'
+    np.save(temporaryPath, array)
+    os.replace(temporaryPath, cachePath)
+    # Conversions of earlier versions of the same file
+    for stalePath in glob.glob(os.path.join(directory, f"csv-{pathKey}-*.npy")):
+        if stalePath != cachePath and '.tmp' not in stalePath:
+            try:
+                os.remove(stalePath)
+            except OSError:
+                pass
+    return cachePath
+
+def loadCSV(path, mmapMode=None, directory=None):
+    # Contents of a comma separated numeric file, read from the binary cache when possible
+    try:
+        cachePath = csvCachePath(path, directory)
+    except OSError:
+        # No writable cache directory: parse the file directly
+        return parseCSV(path)
+    return np.load(cachePath, mmap_mode=mmapMode)
+
+class DataBundle(Mapping):
+    # Read-only mapping of asset name -> array whose values are loaded on first access.
+    # The loaders are plain callables; .npy assets are memory-mapped, so processes that open
+    # the same file share its pages through the OS page cache.
+    def __init__(self, loaders):
+        self._loaders = dict(loaders)
+        self._values = {}
+        self._loadTimes = {}
+        self._lock = threading.RLock() # loaders may read other assets
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            loader = self._loaders[key]
+            with self._lock:
+                if key not in self._values:
+                    start = time.perf_counter()
+                    self._values[key] = loader()
+                    self._loadTimes[key] = time.perf_counter() - start
+        return self._values[key]
+
+    def __contains__(self, key):
+        # Membership and get only look at the loader table; the Mapping defaults would load the asset
+        return key in self._loaders
+
+    def get(self, key, default=None):
+        return self[key] if key in self._loaders else default
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
+    @property
+    def touched(self):
+        # Assets loaded so far, in the order they were first accessed
+        return list(self._values)
+
+    def report(self):
+        # One line per asset: load time, size and whether it is memory-mapped, or that it was never used
+        lines = []
+        for key in self._loaders:
+            if key not in self._values:
+                lines.append(f"{key}: not loaded")
+                continue
+            value = self._values[key]
+            milliseconds = 1000 * self._loadTimes[key]
+            if isinstance(value, np.ndarray):
+                kind = "memory-mapped" if isinstance(value, np.memmap) else "in memory"
+                lines.append(f"{key}: {milliseconds:.1f} ms, {value.shape} {value.dtype}, {value.nbytes / 1e6:.1f} MB {kind}")
+            else:
+                lines.append(f"{key}: {milliseconds:.1f} ms")
+        return "\n".join(lines)
+
+def npyLoader(path, mmapMode='r', allowPickle=False):
+    # Object arrays (names, labels) cannot be memory-mapped and are read into memory
+    if allowPickle:
+        return lambda: np.load(path, allow_pickle=True)
+    return lambda: np.load(path, mmap_mode=mmapMode)
+
+def csvLoader(path, mmapMode='r'):
+    return lambda: loadCSV(path, mmapMode=mmapMode)
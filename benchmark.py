@@ -0,0 +1,183 @@
+import numpy as np
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+from cache import getCacheDir
+from util import getBundleDir, generateBeamProfile, normalizeStage, beamStage, smearStage, noiseStage, referenceStage
+from responsebank import resampleResponse
+from alignment import alignToReference
+from phantom import generatePhantom
+
+# Stage benchmarks of the simulation on synthetic inputs (Perlin phantoms and the super-Gaussian
+# crater profile), so they run without the bundled images. Every stage is timed over the
+# parameters it depends on only: normalize and reference per image size, beam per size and
+# dosage, response per repetition rate, smear, noise and alignment per size, dosage and rate.
+# The beam stage includes the subsampling (the decimated backend only evaluates the sampled
+# positions) and the smear stage includes the averaging over dosage shots.
+#
+#   python benchmark.py --output benchmark.json
+#   python benchmark.py --update-baseline        # store the current timings as the baseline
+#   python benchmark.py --threshold 0.25         # exit code 1 if a stage got 25 % slower
+#
+# The baseline is kept in the user cache directory (see cache.getCacheDir) unless --baseline is given.
+
+beamSize = 20 # um
+dwellTime = 3 # ms
+C_washout = 100 # ppm
+allowedDosages = [1, 2, 5, 10, 20]
+benchmarkVersion = 1
+
+def timeStage(function, repeat, setup=None):
+    # Seconds of every call; setup() returns the arguments of each call and is not timed
+    times = []
+    for _ in range(repeat):
+        arguments = setup() if setup is not None else ()
+        start = time.perf_counter()
+        function(*arguments)
+        times.append(time.perf_counter() - start)
+    return times
+
+def sampleRates(RRs, count=3):
+    # count repetition rates spread evenly over the table, including both ends
+    indices = np.unique(np.round(np.linspace(0, len(RRs) - 1, count)).astype(int))
+    return [int(RRs[i]) for i in indices]
+
+def runBenchmarks(sizes, dosages, rates, washoutProfilesAll, repeat=3, seed=0, W=0, fluence=0, C_sample=500, flickerNoise=5):
+    results = []
+    def record(stage, times, size=None, dosage=None, rate=None):
+        results.append({"stage": stage, "size": size, "dosage": dosage, "rate": rate,
+                        "seconds": min(times), "median": float(np.median(times))})
+        where = ", ".join(f"{name} {value}" for name, value in (("size", size), ("dosage", dosage), ("rate", rate)) if value is not None)
+        print(f"{stage:10s} {where:36s} {1000 * min(times):9.2f} ms", flush=True)
+
+    craterProfile = generateBeamProfile()
+    washoutProfile = np.array(washoutProfilesAll[:, W, fluence])
+    responseCurves = {}
+    for rate in rates:
+        record("response", timeStage(lambda: resampleResponse(washoutProfile, rate, dwellTime), repeat), rate=rate)
+        responseCurves[rate] = resampleResponse(washoutProfile, rate, dwellTime)
+
+    # The stages print their progress; it is kept out of the benchmark output
+    quiet = lambda: contextlib.redirect_stdout(io.StringIO())
+    for size in sizes:
+        image = generatePhantom((size, size), seed=seed)
+        record("normalize", timeStage(lambda: normalizeStage(image), repeat), size=size)
+        normalized = normalizeStage(image)
+        record("reference", timeStage(lambda: referenceStage(normalized, beamSize), repeat), size=size)
+        referenceImage = referenceStage(normalized, beamSize)
+
+        for dosage in dosages:
+            k = int(beamSize / dosage)
+            m = int(beamSize)
+            with quiet():
+                record("beam", timeStage(lambda: beamStage(normalized, craterProfile, m, k), repeat), size=size, dosage=dosage)
+                beam = beamStage(normalized, craterProfile, m, k)
+
+            for rate in rates:
+                responseCurve = responseCurves[rate]
+                record("smear", timeStage(lambda: smearStage(beam, responseCurve, dosage), repeat), size=size, dosage=dosage, rate=rate)
+                smearedImage = (C_sample / C_washout) * dosage * smearStage(beam, responseCurve, dosage)
+                smearedImage[smearedImage < 0] = 0
+                smearedImage[np.isnan(smearedImage)] = 0
+
+                np.random.seed(seed)
+                record("noise", timeStage(lambda counts: noiseStage(counts, flickerNoise), repeat, lambda: (smearedImage.copy(),)), size=size, dosage=dosage, rate=rate)
+                noisyImage = noiseStage(smearedImage.copy(), flickerNoise)
+                noisyImage /= np.max(noisyImage)
+                record("alignment", timeStage(lambda: alignToReference(noisyImage, referenceImage, numShifts=20), repeat), size=size, dosage=dosage, rate=rate)
+    return results
+
+def _entryKey(entry):
+    return (entry["stage"], entry["size"], entry["dosage"], entry["rate"])
+
+def compareToBaseline(results, baseline, threshold=0.25, minDelta=0.002):
+    # Entries slower than in the baseline by more than threshold (relative) and minDelta seconds;
+    # returns a list of (entry, baseline seconds). Entries missing from the baseline are skipped.
+    baselineTimes = {_entryKey(entry): entry["seconds"] for entry in baseline["results"]}
+    regressions = []
+    for entry in results:
+        before = baselineTimes.get(_entryKey(entry))
+        if before is None:
+            continue
+        if entry["seconds"] > before * (1 + threshold) and entry["seconds"] - before > minDelta:
+            regressions.append((entry, before))
+    return regressions
+
+def _report(results, sizes, dosages, rates, repeat, seed):
+    return {"version": benchmarkVersion,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "sizes": sizes, "dosages": dosages, "rates": rates, "repeat": repeat, "seed": seed,
+            "results": results}
+
+def _writeJSON(path, report):
+    temporaryPath = path + ".tmp"
+    with open(temporaryPath, "w") as f:
+        json.dump(report, f, indent=1)
+    os.replace(temporaryPath, path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stage benchmarks of the ablation simulation on synthetic inputs")
+    parser.add_argument("--sizes", default="1000,3000", help="input image sizes (square), comma separated")
+    parser.add_argument("--dosages", default="1,2,5,10,20", help="dosages, comma separated")
+    parser.add_argument("--rates", default="sample", help="repetition rates in Hz, comma separated, 'sample' (3 from RRs.npy) or 'all'")
+    parser.add_argument("--repeat", type=int, default=3, help="timed calls per stage; the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the phantoms and the noise")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--baseline", help="baseline JSON file (benchmark_baseline.json in the cache directory by default)")
+    parser.add_argument("--update-baseline", dest="updateBaseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown against the baseline that counts as a regression")
+    parser.add_argument("--min-delta", dest="minDelta", type=float, default=0.002, help="slowdowns below this many seconds are ignored")
+    args = parser.parse_args(argv)
+
+    bundle_dir = getBundleDir()
+    RRs = np.load(os.path.join(bundle_dir, 'RRs.npy'))
+    washoutProfilesAll = np.load(os.path.join(bundle_dir, 'washoutProfilesAll.npy'), mmap_mode='r')
+    sizes = [int(size) for size in args.sizes.split(",")]
+    dosages = [int(dosage) for dosage in args.dosages.split(",")]
+    if args.rates == "sample":
+        rates = sampleRates(RRs)
+    elif args.rates == "all":
+        rates = [int(rate) for rate in RRs]
+    else:
+        rates = [int(rate) for rate in args.rates.split(",")]
+    for dosage in dosages:
+        if dosage not in allowedDosages:
+            parser.error(f"dosage {dosage} is not one of {allowedDosages}")
+
+    results = runBenchmarks(sizes, dosages, rates, washoutProfilesAll, args.repeat, args.seed)
+    report = _report(results, sizes, dosages, rates, args.repeat, args.seed)
+    if args.output:
+        _writeJSON(args.output, report)
+        print(f"Results written to {args.output}")
+
+    baselinePath = args.baseline or os.path.join(getCacheDir(), 'benchmark_baseline.json')
+    if args.updateBaseline:
+        _writeJSON(baselinePath, report)
+        print(f"Baseline written to {baselinePath}")
+        return 0
+    if not os.path.exists(baselinePath):
+        print(f"No baseline at {baselinePath}; run with --update-baseline to create one")
+        return 0
+
+    with open(baselinePath) as f:
+        baseline = json.load(f)
+    regressions = compareToBaseline(results, baseline, args.threshold, args.minDelta)
+    for entry, before in regressions:
+        print("Regression: {} (size {}, dosage {}, rate {}): {:.2f} ms, baseline {:.2f} ms (+{:.0f} %)".format(
+            entry["stage"], entry["size"], entry["dosage"], entry["rate"], 1000 * entry["seconds"], 1000 * before, 100 * (entry["seconds"] / before - 1)))
+    if regressions:
+        return 1
+    print(f"No stage is more than {100 * args.threshold:.0f} % slower than the baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
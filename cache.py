@@ -0,0 +1,112 @@
+import os
+import sys
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+def getCacheDir():
+    # Per-user directory for generated files. The bundle directory of a frozen build
+    # (_MEIPASS/Nuitka) is read-only, so nothing is written next to the executable.
+    path = os.environ.get('ABLATIONSIM_CACHE_DIR')
+    if not path:
+        base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+        path = os.path.join(base, 'AblationSim')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+# Content hashes of arrays, memoized per array object so that a 3000x3000 input image is only
+# hashed once per session. Arrays used as cache keys are assumed not to be modified in place.
+_fingerprints = {}
+
+def arrayFingerprint(array):
+    entry = _fingerprints.get(id(array))
+    if entry is not None and entry[0]() is array:
+        return entry[1]
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((array.shape, array.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(array).data)
+    fingerprint = digest.hexdigest()
+
+    try:
+        arrayId = id(array)
+        _fingerprints[arrayId] = (weakref.ref(array, lambda _: _fingerprints.pop(arrayId, None)), fingerprint)
+    except TypeError:
+        pass
+    return fingerprint
+
+def _sizeOf(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_sizeOf(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_sizeOf(item) for item in value.values())
+    return sys.getsizeof(value)
+
+def _freeze(value):
+    # Cached arrays are shared between runs, so they must not be modified by the caller
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            _freeze(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _freeze(item)
+    return value
+
+class LRUCache:
+    # Least recently used cache bounded by the total size of the stored values in bytes
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        size = _sizeOf(value)
+        with self._lock:
+            if key in self._entries:
+                self.currentBytes -= self._entries.pop(key)[1]
+            if size > self.maxBytes:
+                return value
+            self._entries[key] = (_freeze(value), size)
+            self.currentBytes += size
+            while self.currentBytes > self.maxBytes:
+                _, (_, evictedSize) = self._entries.popitem(last=False)
+                self.currentBytes -= evictedSize
+        return value
+
+    def getOrCompute(self, key, compute):
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = self.put(key, compute())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.currentBytes = 0
+
+_missing = object()
@@ -0,0 +1,368 @@
+import numpy as np
+import scipy.ndimage as ndimage
+import scipy.signal as signal
+import scipy.fft
+from scipy.optimize import nnls
+import json
+import os
+import time
+
+from cache import getCacheDir
+
+# Engines for the beam (crater) stage of the simulation. The reference behaviour is
+#   signal.convolve2d(image, kernel, mode='full')[rowOffset::rowStep, colOffset::colStep]
+# but only the positions that survive the subsampling (one per laser shot) are evaluated.
+
+def _correlateStrided(padded, flippedKernel, rowOffset, rowStep, numRows, colOffset, colStep, numCols):
+    # Strided correlation of an already zero-padded array, one kernel tap at a time.
+    # The work is (number of nonzero taps) x (number of output samples) and the only
+    # temporary is the output itself.
+    out = np.zeros((numRows, numCols), dtype=np.result_type(padded, flippedKernel))
+    rowStop = rowOffset + (numRows - 1) * rowStep + 1
+    colStop = colOffset + (numCols - 1) * colStep + 1
+    for u, v in zip(*np.nonzero(flippedKernel)):
+        out += flippedKernel[u, v] * padded[rowOffset + u:rowStop + u:rowStep, colOffset + v:colStop + v:colStep]
+    return out
+
+def _padFull(image, kernelShape):
+    # Zero padding that turns the 'full' convolution into a 'valid' correlation
+    kh, kw = kernelShape
+    return np.pad(image, ((kh - 1, kh - 1), (kw - 1, kw - 1)))
+
+def _numSamples(length, offset, step):
+    return max(0, (length - offset + step - 1) // step)
+
+def convolveDecimated(image, kernel, rowStep=1, colStep=1, rowOffset=0, colOffset=0):
+    # Equivalent to signal.convolve2d(image, kernel, mode='full')[rowOffset::rowStep, colOffset::colStep]
+    kh, kw = kernel.shape
+    fullRows = image.shape[0] + kh - 1
+    fullCols = image.shape[1] + kw - 1
+    numRows = _numSamples(fullRows, rowOffset, rowStep)
+    numCols = _numSamples(fullCols, colOffset, colStep)
+    if numRows == 0 or numCols == 0:
+        return np.zeros((numRows, numCols), dtype=np.result_type(image, kernel))
+
+    padded = _padFull(image, kernel.shape)
+    return _correlateStrided(padded, kernel[::-1, ::-1], rowOffset, rowStep, numRows, colOffset, colStep, numCols)
+
+# Relative Frobenius error allowed for the low-rank crater profile approximation
+defaultSeparableTolerance = 1e-2
+
+def separableKernel(kernel, tolerance=defaultSeparableTolerance, maxRank=None):
+    # Factors the kernel (SVD) into rank-1 terms columnKernels[t] x rowKernels[t] and keeps the
+    # smallest rank whose relative Frobenius reconstruction error is within tolerance.
+    # Returns (columnKernels, rowKernels, rank, error)
+    U, S, Vt = np.linalg.svd(kernel)
+    # residual[r - 1] is the error of the rank r approximation (energy of the discarded singular values)
+    tailEnergy = np.cumsum((S**2)[::-1])[::-1]
+    residual = np.sqrt(np.append(tailEnergy[1:], 0.0) / tailEnergy[0])
+    rank = int(np.argmax(residual <= tolerance)) + 1 if np.any(residual <= tolerance) else len(S)
+    if maxRank is not None:
+        rank = min(rank, maxRank)
+    columnKernels = U[:, :rank].T * np.sqrt(S[:rank])[:, np.newaxis]
+    rowKernels = Vt[:rank, :] * np.sqrt(S[:rank])[:, np.newaxis]
+    return columnKernels, rowKernels, rank, float(residual[rank - 1])
+
+def _separableWork(fullShape, kernelShape, rank, rowStep, colStep, rowOffset, colOffset):
+    # Multiply-adds of the two pass orders: columns first (vertical pass on the sampled rows,
+    # horizontal pass on the sampled columns) and rows first (the other way round)
+    kh, kw = kernelShape
+    numRows = _numSamples(fullShape[0], rowOffset, rowStep)
+    numCols = _numSamples(fullShape[1], colOffset, colStep)
+    bandRows = min(fullShape[0] + kh - 1, (numRows - 1) * rowStep + kh)
+    bandCols = min(fullShape[1] + kw - 1, (numCols - 1) * colStep + kw)
+    columnsFirst = rank * numRows * (bandCols * kh + numCols * kw)
+    rowsFirst = rank * numCols * (bandRows * kw + numRows * kh)
+    return columnsFirst, rowsFirst
+
+def convolveSeparableDecimated(image, columnKernels, rowKernels, rowStep=1, colStep=1, rowOffset=0, colOffset=0):
+    # Same samples as convolveDecimated for the kernel sum_t outer(columnKernels[t], rowKernels[t]),
+    # computed as r pairs of 1-D passes. The pass order with fewer multiply-adds is used, so only
+    # the sampled rows (or columns) are ever filtered in the second direction.
+    kh, kw = columnKernels.shape[1], rowKernels.shape[1]
+    fullShape = (image.shape[0] + kh - 1, image.shape[1] + kw - 1)
+    numRows = _numSamples(fullShape[0], rowOffset, rowStep)
+    numCols = _numSamples(fullShape[1], colOffset, colStep)
+    if numRows == 0 or numCols == 0:
+        return np.zeros((numRows, numCols), dtype=np.result_type(image, columnKernels))
+
+    padded = _padFull(image, (kh, kw))
+    columnsFirst, rowsFirst = _separableWork(fullShape, (kh, kw), len(columnKernels), rowStep, colStep, rowOffset, colOffset)
+    if rowsFirst < columnsFirst:
+        # Filter the transposed problem so that the code below always runs columns first
+        return convolveSeparableDecimated(image.T, rowKernels, columnKernels, colStep, rowStep, colOffset, rowOffset).T
+
+    bandStop = colOffset + (numCols - 1) * colStep + kw
+    band = padded[:, colOffset:bandStop]
+    out = np.zeros((numRows, numCols), dtype=np.result_type(padded, columnKernels))
+    for columnKernel, rowKernel in zip(columnKernels, rowKernels):
+        # Vertical pass, only on the sampled rows
+        vertical = _correlate1dStrided(band, columnKernel[::-1], 0, rowOffset, rowStep, numRows)
+        # Horizontal pass, only on the sampled columns
+        out += _correlate1dStrided(vertical, rowKernel[::-1], 1, 0, colStep, numCols)
+    return out
+
+def _correlate1dStrided(array, weights, axis, offset, step, count):
+    # out[i] = sum_u weights[u] * array[offset + i*step + u] along axis
+    if step == 1:
+        # Contiguous output: scipy's C implementation, trimmed to the valid part
+        window = [slice(None), slice(None)]
+        window[axis] = slice(offset, offset + count + len(weights) - 1)
+        filtered = ndimage.correlate1d(array[tuple(window)], weights, axis=axis, mode='constant', origin=-(len(weights) // 2))
+        window[axis] = slice(0, count)
+        return filtered[tuple(window)]
+    if axis == 0:
+        return _correlateStrided(array, weights[:, np.newaxis], offset, step, count, 0, 1, array.shape[1])
+    return _correlateStrided(array, weights[np.newaxis, :], 0, 1, array.shape[0], offset, step, count)
+
+# Number of blocks refined exactly before deciding whether the FFT fallback is cheaper
+_refineBeforeFallbackCheck = 4
+
+def convolveFullMax(image, kernel, lowerBound=-np.inf, blockSize=16, rows=None):
+    # Exact maximum of signal.convolve2d(image, kernel, mode='full') without computing
+    # the full convolution. The output is split into blocks, an upper bound for every block
+    # is obtained from a max/min filtered copy of the image, and only blocks whose bound
+    # can still beat the best known value are convolved exactly (bound and refine).
+    # lowerBound is any value known to be attained, e.g. the maximum of the decimated samples.
+    # rows = (start, stop) restricts the maximum to those rows of the full convolution.
+    kh, kw = kernel.shape
+    fullRows = image.shape[0] + kh - 1
+    fullCols = image.shape[1] + kw - 1
+    rowStart, rowStop = (0, fullRows) if rows is None else (max(rows[0], 0), min(rows[1], fullRows))
+    if rowStart >= rowStop:
+        return lowerBound
+    padded = _padFull(image, kernel.shape)
+    flippedKernel = kernel[::-1, ::-1]
+
+    # Upper bound per block: positive taps see the block maximum, negative taps the block minimum
+    origin = -(blockSize // 2)
+    numBlockRows = _numSamples(fullRows, 0, blockSize)
+    numBlockCols = _numSamples(fullCols, 0, blockSize)
+    blockMax = ndimage.maximum_filter(padded, size=blockSize, origin=origin, mode='constant', cval=0.0)
+    bound = _correlateStrided(blockMax, np.clip(flippedKernel, 0, None), 0, blockSize, numBlockRows, 0, blockSize, numBlockCols)
+    if np.any(flippedKernel < 0):
+        blockMin = ndimage.minimum_filter(padded, size=blockSize, origin=origin, mode='constant', cval=0.0)
+        bound += _correlateStrided(blockMin, np.clip(flippedKernel, None, 0), 0, blockSize, numBlockRows, 0, blockSize, numBlockCols)
+    blockRows = np.arange(numBlockRows) * blockSize
+    bound[(blockRows + blockSize <= rowStart) | (blockRows >= rowStop)] = -np.inf
+
+    # Refining a block is a direct convolution of a (blockSize + kernel)^2 window. When too many
+    # blocks stay above the best known value (flat images) one FFT of the whole map is cheaper.
+    coefficients = loadCalibration()
+    blockCost = coefficients["direct"][1] * (blockSize + kh - 1) * (blockSize + kw - 1) * kh * kw
+    fftCost = estimateBeamCost("fft", image.shape, kernel)
+    maxRefinedBlocks = max(1, int(fftCost / blockCost))
+
+    best = lowerBound
+    order = np.argsort(bound, axis=None)[::-1]
+    for refined, flatIndex in enumerate(order):
+        if bound.flat[flatIndex] <= best:
+            break
+        if refined == _refineBeforeFallbackCheck and np.count_nonzero(bound > best) - refined > maxRefinedBlocks:
+            return max(best, np.max(signal.fftconvolve(image, kernel, mode='full')[rowStart:rowStop]))
+        p, q = np.unravel_index(flatIndex, bound.shape)
+        r0, c0 = max(p * blockSize, rowStart), q * blockSize
+        r1, c1 = min(p * blockSize + blockSize, rowStop), min(c0 + blockSize, fullCols)
+        window = padded[r0:r1 + kh - 1, c0:c1 + kw - 1]
+        best = max(best, np.max(signal.convolve2d(window, kernel, mode='valid')))
+    return best
+
+def convolveRows(image, kernels):
+    # Full 1-D convolution of every row of image (rows, columns) with every kernel (count, length):
+    # result[c] == signal.convolve2d(image, kernels[c][np.newaxis, :], mode='full'), as one batched
+    # FFT over all kernels and rows. Returns (count, rows, columns + length - 1) in the image precision.
+    kernels = np.atleast_2d(kernels)
+    outputLength = image.shape[1] + kernels.shape[1] - 1
+    fftLength = scipy.fft.next_fast_len(outputLength, real=True)
+    imageSpectrum = scipy.fft.rfft(image, fftLength, axis=1)
+    kernelSpectra = scipy.fft.rfft(kernels.astype(image.dtype, copy=False), fftLength, axis=1)
+    convolved = scipy.fft.irfft(kernelSpectra[:, np.newaxis, :] * imageSpectrum[np.newaxis], fftLength, axis=2)
+    return convolved[:, :, :outputLength]
+
+# Beam stage backends. Each returns the samples of the full convolution at
+# [rowOffset::rowStep, colOffset::colStep] together with the maximum of the full convolution,
+# which the simulation uses for normalization.
+
+def _beamDirect(image, kernel, rowStep, colStep, rowOffset, colOffset):
+    convolved = signal.convolve2d(image, kernel, mode='full') # Equivalent to MATLAB's conv2
+    return convolved[rowOffset::rowStep, colOffset::colStep], np.max(convolved)
+
+def _beamFFT(image, kernel, rowStep, colStep, rowOffset, colOffset):
+    convolved = signal.fftconvolve(image, kernel, mode='full')
+    return convolved[rowOffset::rowStep, colOffset::colStep], np.max(convolved)
+
+def _beamOverlapAdd(image, kernel, rowStep, colStep, rowOffset, colOffset):
+    convolved = signal.oaconvolve(image, kernel, mode='full')
+    return convolved[rowOffset::rowStep, colOffset::colStep], np.max(convolved)
+
+def _beamDecimated(image, kernel, rowStep, colStep, rowOffset, colOffset):
+    sampled = convolveDecimated(image, kernel, rowStep, colStep, rowOffset, colOffset)
+    lowerBound = np.max(sampled) if sampled.size else -np.inf
+    return sampled, convolveFullMax(image, kernel, lowerBound=lowerBound)
+
+def _beamSeparable(image, kernel, rowStep, colStep, rowOffset, colOffset, tolerance=defaultSeparableTolerance):
+    # Low-rank approximation of the kernel; the maximum is that of the approximated convolution
+    columnKernels, rowKernels, rank, error = separableKernel(kernel, tolerance)
+    sampled = convolveSeparableDecimated(image, columnKernels, rowKernels, rowStep, colStep, rowOffset, colOffset)
+    lowRankKernel = columnKernels.T @ rowKernels
+    lowerBound = np.max(sampled) if sampled.size else -np.inf
+    return sampled, convolveFullMax(image, lowRankKernel, lowerBound=lowerBound), {"rank": rank, "error": error}
+
+beamBackends = {
+    "direct": _beamDirect,
+    "fft": _beamFFT,
+    "oa": _beamOverlapAdd,
+    "decimated": _beamDecimated,
+    "separable": _beamSeparable,
+}
+
+# Backends that only approximate the convolution; "auto" considers them only when a tolerance is given
+approximateBackends = ("separable",)
+
+# Cost model: the run time of every backend is a nonnegative linear combination of a few
+# work terms, fitted per host by calibrateBeamBackends(). The defaults below were measured
+# on a typical desktop and are only used until a calibration file exists.
+_calibrationFileName = 'convolution_calibration.json'
+_defaultCoefficients = {
+    "direct": [8e-3, 2.5e-9],
+    "fft": [0.0, 2.8e-9],
+    "oa": [0.0, 7.9e-9],
+    "decimated": [4e-3, 1.7e-9, 4.2e-8],
+    "separable": [7e-3, 8e-10, 8.3e-8],
+}
+_coefficients = None
+
+def _workTerms(method, imageShape, kernel, rowStep, colStep, rowOffset, colOffset, tolerance=defaultSeparableTolerance):
+    kh, kw = kernel.shape
+    fullRows = imageShape[0] + kh - 1
+    fullCols = imageShape[1] + kw - 1
+    if method == "direct":
+        return [1.0, fullRows * fullCols * kh * kw]
+    if method == "fft":
+        fftSize = scipy.fft.next_fast_len(fullRows) * scipy.fft.next_fast_len(fullCols)
+        return [1.0, fftSize * np.log2(fftSize)]
+    if method == "oa":
+        return [1.0, fullRows * fullCols * np.log2(4 * kh * kw)]
+    if method == "decimated":
+        numSamples = _numSamples(fullRows, rowOffset, rowStep) * _numSamples(fullCols, colOffset, colStep)
+        return [1.0, numSamples * np.count_nonzero(kernel), fullRows * fullCols]
+    if method == "separable":
+        rank = separableKernel(kernel, defaultSeparableTolerance if tolerance is None else tolerance)[2]
+        return [1.0, min(_separableWork((fullRows, fullCols), kernel.shape, rank, rowStep, colStep, rowOffset, colOffset)), fullRows * fullCols]
+    raise ValueError(f"Unknown convolution method: {method}")
+
+def _calibrationPath():
+    return os.path.join(getCacheDir(), _calibrationFileName)
+
+def loadCalibration(path=None):
+    # Coefficients of the cost model, from the calibration file if there is one
+    global _coefficients
+    if path is None and _coefficients is not None:
+        return _coefficients
+    coefficients = dict(_defaultCoefficients)
+    try:
+        with open(path or _calibrationPath()) as f:
+            coefficients.update(json.load(f)["coefficients"])
+    except (OSError, ValueError, KeyError):
+        pass
+    if path is None:
+        _coefficients = coefficients
+    return coefficients
+
+def estimateBeamCost(method, imageShape, kernel, rowStep=1, colStep=1, rowOffset=0, colOffset=0, tolerance=defaultSeparableTolerance):
+    # Predicted run time in seconds
+    coefficients = loadCalibration()[method]
+    return float(np.dot(coefficients, _workTerms(method, imageShape, kernel, rowStep, colStep, rowOffset, colOffset, tolerance)))
+
+def selectBeamBackend(imageShape, kernel, rowStep=1, colStep=1, rowOffset=0, colOffset=0, separableTolerance=None):
+    methods = [method for method in beamBackends if separableTolerance is not None or method not in approximateBackends]
+    costs = {method: estimateBeamCost(method, imageShape, kernel, rowStep, colStep, rowOffset, colOffset, separableTolerance) for method in methods}
+    return min(costs, key=costs.get)
+
+def beamConvolve(image, kernel, rowStep=1, colStep=1, rowOffset=0, colOffset=0, method="auto", separableTolerance=None):
+    # Beam stage entry point: returns (samples, maximum of the full convolution, info), where info
+    # holds the method used and, for the separable backend, the rank and reconstruction error
+    if method == "auto":
+        method = selectBeamBackend(image.shape, kernel, rowStep, colStep, rowOffset, colOffset, separableTolerance)
+    if method not in beamBackends:
+        raise ValueError(f"Unknown convolution method: {method}")
+    info = {"method": method}
+    if method == "separable":
+        tolerance = defaultSeparableTolerance if separableTolerance is None else separableTolerance
+        sampled, convolvedMax, separableInfo = _beamSeparable(image, kernel, rowStep, colStep, rowOffset, colOffset, tolerance)
+        info.update(separableInfo)
+    else:
+        sampled, convolvedMax = beamBackends[method](image, kernel, rowStep, colStep, rowOffset, colOffset)
+    return sampled, convolvedMax, info
+
+def _timeBackend(method, image, kernel, steps, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        beamBackends[method](image, kernel, *steps)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def _findCrossovers(coefficients, kernel, steps, sizes):
+    # Square image sizes at which the cheapest backend changes
+    global _coefficients
+    previousCoefficients, _coefficients = _coefficients, coefficients
+    try:
+        crossovers = []
+        previous = None
+        for size in sizes:
+            method = selectBeamBackend((size, size), kernel, *steps)
+            if previous is not None and method != previous:
+                crossovers.append({"size": int(size), "from": previous, "to": method})
+            previous = method
+        return crossovers
+    finally:
+        _coefficients = previousCoefficients
+
+def _calibrationImage(size, rng):
+    # Smooth structure with some fine texture, closer to a real map than white noise
+    # (the cost of the maximum search in the decimated backend depends on the image)
+    image = ndimage.gaussian_filter(rng.random((size, size)), size / 32) + 0.05 * ndimage.gaussian_filter(rng.random((size, size)), 2)
+    return image / np.max(image)
+
+def calibrateBeamBackends(kernel, sizes=(64, 128, 256, 512, 1024), steps=((20, 2, 19, 1), (20, 20, 19, 19), (1, 1, 0, 0)), repeats=3, save=True, path=None):
+    # Times every backend on synthetic images, fits the cost model by nonnegative least
+    # squares and stores the coefficients and the resulting crossover points.
+    rng = np.random.default_rng(0)
+    coefficients = {}
+    for method in beamBackends:
+        rows, timings = [], []
+        # The FFT and direct paths do not depend on the sampling steps
+        methodSteps = steps if method in ("decimated", "separable") else steps[:1]
+        for size in sizes:
+            image = _calibrationImage(size, rng)
+            for step in methodSteps:
+                if method == "direct" and size * size * kernel.size > 5e8:
+                    continue
+                rows.append(_workTerms(method, image.shape, kernel, *step))
+                timings.append(_timeBackend(method, image, kernel, step, repeats))
+        coefficients[method], _ = nnls(np.array(rows, dtype=float), np.array(timings))
+        coefficients[method] = coefficients[method].tolist()
+
+    scanSizes = np.unique(np.geomspace(32, 8192, 64).astype(int))
+    result = {
+        "coefficients": coefficients,
+        "kernelShape": list(kernel.shape),
+        "crossovers": {f"{s[0]}x{s[1]}": _findCrossovers(coefficients, kernel, s, scanSizes) for s in steps},
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    if save:
+        global _coefficients
+        with open(path or _calibrationPath(), 'w') as f:
+            json.dump(result, f, indent=2)
+        _coefficients = None
+    return result
+
+if __name__ == "__main__":
+    import sys
+    from assets import loadCSV
+    bundle_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
+    craterProfile = loadCSV(os.path.join(bundle_dir, 'BPn.csv'))
+    result = calibrateBeamBackends(craterProfile)
+    print(json.dumps(result, indent=2))
+    print("Saved to", _calibrationPath())
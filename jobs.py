@@ -0,0 +1,55 @@
+import time
+
+# Simulation jobs of the GUI on top of a workers.SimulationPool: which jobs are still wanted,
+# cancelling them, superseding a running job with a newer one, and handing progress and
+# results to the GUI. handleEvents is meant to be called on the Tk thread whenever the pool
+# reports new messages (see SimulationPool.listen).
+
+class SimulationJobs:
+    def __init__(self, pool, onResult, onProgress=None):
+        self.pool = pool
+        self.onResult = onResult # onResult(jobId, result), result as returned by simulateAblation
+        self.onProgress = onProgress # onProgress(jobId, linesDone, numLines), for progressive jobs
+        self.startTimes = {} # jobId: submit time of the jobs that are neither finished nor cancelled
+        self._linesShown = {}
+
+    def submit(self, craterProfile, supersede=True, **parameters):
+        # Queues a job (keyword arguments of SimulationPool.submit); with supersede, the jobs still
+        # in flight are cancelled first
+        if supersede:
+            self.cancelAll()
+        jobId = self.pool.submit(craterProfile, **parameters)
+        self.startTimes[jobId] = time.perf_counter()
+        self._linesShown[jobId] = 0
+        return jobId
+
+    def cancel(self, jobId):
+        if jobId in self.startTimes:
+            del self.startTimes[jobId]
+            del self._linesShown[jobId]
+            self.pool.cancel(jobId)
+
+    def cancelAll(self):
+        for jobId in list(self.startTimes):
+            self.cancel(jobId)
+
+    @property
+    def running(self):
+        return bool(self.startTimes)
+
+    def elapsed(self, jobId):
+        return time.perf_counter() - self.startTimes[jobId]
+
+    def handleEvents(self):
+        for jobId, result in self.pool.poll():
+            if jobId in self.startTimes:
+                del self.startTimes[jobId]
+                del self._linesShown[jobId]
+                self.onResult(jobId, result)
+        if self.onProgress is None:
+            return
+        for jobId in list(self.startTimes):
+            progress = self.pool.progress(jobId)
+            if progress is not None and progress[0] > self._linesShown[jobId]:
+                self._linesShown[jobId] = progress[0]
+                self.onProgress(jobId, *progress)
@@ -0,0 +1,250 @@
+import numpy as np
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+import zlib
+
+from util import getBundleDir, mappingTime
+from workers import SimulationPool
+
+# Acquisition-time optimizer: the fastest scan settings that still reach an SSIM target for one
+# nuclide and fluence. The mapping time only depends on the scanning speed (repetition rate x
+# beamSize / dosage) and the SSIM falls as the scan gets faster, so for every allowed dosage the
+# optimizer brackets the highest repetition rate that meets the target:
+#   1. the lowest and highest repetition rate the GUI allows at that dosage are evaluated;
+#   2. every round evaluates `width` rates spread geometrically over the bracket of every dosage
+#      still in play, all at once on the worker pool, and shrinks each bracket to the highest rate
+#      that met the target and the lowest rate above it that did not;
+#   3. a dosage is done when its bracket is narrower than the tolerance, or dropped when even the
+#      top of its bracket is slower than the best setting found so far.
+# Every evaluation is the mean SSIM over `realizations` noise draws (simulateEnsemble) and is
+# memoized, so the budget only counts simulations that were actually run. All evaluations are
+# also reduced to their Pareto front of mapping time against SSIM.
+#
+#   python optimizer.py --nuclide 23Na --fluence 10 --target 0.8 --processes 4 --output optimum.json
+
+beamSize = 20 # um
+allowedDosages = [1, 2, 5, 10, 20]
+# Limits of the GUI controls (see WashoutApp.changeDosage and changeRepetitionRate)
+minRR, maxRR = 1, 1000 # Hz
+minSS, maxSS = 10, 10000 # um/s
+
+def rateLimits(dosage):
+    # (lowest, highest) whole repetition rate in Hz whose scanning speed is within the GUI limits,
+    # None if there is none
+    low = max(minRR, math.ceil(minSS * dosage / beamSize))
+    high = min(maxRR, math.floor(maxSS * dosage / beamSize))
+    if low > high:
+        return None
+    return low, high
+
+class SSIMEvaluator:
+    # Noise-averaged, memoized SSIM of (dosage, repetition rate) settings for one nuclide and fluence,
+    # evaluated in parallel on a workers.SimulationPool.
+    # seed: the noise of every setting is seeded from it and the setting, so evaluations are reproducible.
+    # timeout: seconds an evaluate call waits for its simulations; the ones still missing then count as
+    # failed (no limit by default). Simulations lost with a worker that exited always count as failed.
+    def __init__(self, pool, craterProfile, imageShape, W, fluence, C_sample=500, flickerNoise=5, realizations=8, seed=0, timeout=None):
+        self.pool = pool
+        self.craterProfile = craterProfile
+        self.imageShape = imageShape
+        self.parameters = dict(W=W, fluence=fluence, C_sample=C_sample, flickerNoise=flickerNoise)
+        self.realizations = realizations
+        self.seed = seed
+        self.timeout = timeout
+        self.memo = {} # (dosage, repetitionRate): evaluation
+        self.simulations = 0
+
+    def evaluate(self, settings):
+        # Evaluations of the (dosage, repetitionRate) settings, in the same order. An evaluation is a dict
+        # with dosage, repetitionRate, scanningSpeed, mapTime, ssim and ssimStd (ssim None if the run failed).
+        # The settings that are not memoized yet are all submitted before waiting for any of them.
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        jobs = {}
+        for dosage, repetitionRate in dict.fromkeys(settings):
+            if (dosage, repetitionRate) in self.memo:
+                continue
+            seed = zlib.crc32(f"{self.seed}-{dosage}-{repetitionRate}".encode())
+            jobId = self.pool.submit(self.craterProfile, ensemble=True, numRealizations=self.realizations, seed=seed,
+                                     repetitionRate=repetitionRate, dosage=dosage, useRR=True, **self.parameters)
+            jobs[jobId] = (dosage, repetitionRate)
+        while jobs:
+            for jobId, result in self.pool.poll(timeout=1):
+                if jobId in jobs:
+                    self._record(jobs.pop(jobId), result[2])
+            # Without this, a worker that died would leave the loop waiting forever
+            lost = [jobId for jobId in self.pool.lostJobs() if jobId in jobs]
+            if deadline is not None and time.perf_counter() > deadline:
+                lost = list(jobs)
+            for jobId in lost:
+                self.pool.cancel(jobId)
+                self._record(jobs.pop(jobId), None)
+        return [self.memo[setting] for setting in settings]
+
+    def _record(self, setting, statistics):
+        # Memoizes the evaluation of a finished simulation; statistics is None if it failed
+        dosage, repetitionRate = setting
+        self.memo[setting] = {
+            "dosage": dosage,
+            "repetitionRate": repetitionRate,
+            "scanningSpeed": round(repetitionRate * beamSize / dosage),
+            "mapTime": mappingTime(self.imageShape, dosage, repetitionRate, beamSize),
+            "ssim": None if statistics is None else statistics["mean"],
+            "ssimStd": None if statistics is None else statistics["std"]}
+        self.simulations += 1
+        print("[{}] {}".format(self.simulations, _formatEvaluation(self.memo[setting])), flush=True)
+
+def _meets(evaluation, target):
+    return evaluation["ssim"] is not None and evaluation["ssim"] >= target
+
+def _speed(evaluation):
+    # Exact scanning speed; mapTime is rounded to seconds
+    return evaluation["repetitionRate"] / evaluation["dosage"]
+
+def paretoFront(evaluations):
+    # Evaluations that no other one beats in both mapping time and SSIM, fastest first
+    candidates = sorted((e for e in evaluations if e["ssim"] is not None), key=lambda e: (-_speed(e), -e["ssim"]))
+    front = []
+    for evaluation in candidates:
+        if not front or evaluation["ssim"] > front[-1]["ssim"]:
+            front.append(evaluation)
+    return front
+
+def _interiorRates(low, high, count):
+    # Up to count whole rates strictly between low and high, spread evenly in their logarithm
+    rates = np.geomspace(low, high, count + 2)[1:-1]
+    return sorted({int(round(rate)) for rate in rates} - {low, high})
+
+def optimizeAcquisition(evaluator, target, dosages=allowedDosages, budget=60, width=3, tolerance=0.02):
+    # Fastest setting with a mean SSIM >= target within budget simulations. Returns a dict with
+    #   best: the evaluation of that setting (None if no setting met the target)
+    #   front: the Pareto front of all evaluations
+    #   evaluations: all evaluations, fastest first
+    #   brackets: dosage -> (highest rate that met the target or None, lowest rate above it that did not or None)
+    # tolerance: a bracket is closed once its rates are within this relative distance (or 1 Hz).
+    startSimulations = evaluator.simulations
+    spent = lambda: evaluator.simulations - startSimulations
+    brackets = {}
+    active = []
+    limits = {dosage: rateLimits(dosage) for dosage in dosages}
+    limits = {dosage: limit for dosage, limit in limits.items() if limit is not None}
+
+    # The fastest setting of every dosage first, then the slowest of those that missed the target
+    fastest = dict(zip(limits, evaluator.evaluate([(dosage, high) for dosage, (low, high) in limits.items()])))
+    missed = [dosage for dosage, evaluation in fastest.items() if not _meets(evaluation, target)]
+    slowest = dict(zip(missed, evaluator.evaluate([(dosage, limits[dosage][0]) for dosage in missed])))
+    for dosage, (low, high) in limits.items():
+        if dosage not in missed:
+            brackets[dosage] = (high, None)
+        elif not _meets(slowest[dosage], target):
+            brackets[dosage] = (None, low)
+        else:
+            brackets[dosage] = (low, high)
+            active.append(dosage)
+
+    def bestEvaluation():
+        passing = [evaluator.memo[(dosage, low)] for dosage, (low, high) in brackets.items() if low is not None]
+        return max(passing, key=lambda e: (_speed(e), e["ssim"])) if passing else None
+
+    while active and spent() < budget:
+        # Dosages that cannot beat the best setting found so far, even at the top of their bracket, are dropped
+        best = bestEvaluation()
+        if best is not None:
+            active = [dosage for dosage in active if brackets[dosage][1] / dosage > _speed(best)]
+        active = [dosage for dosage in active if brackets[dosage][1] - brackets[dosage][0] > max(1, tolerance * brackets[dosage][0])]
+        if not active:
+            break
+        # The most promising brackets get the remaining budget first
+        active.sort(key=lambda dosage: brackets[dosage][1] / dosage, reverse=True)
+        remaining = budget - spent()
+        settings = []
+        for dosage in active:
+            count = min(width, remaining - len(settings))
+            if count <= 0:
+                break
+            settings += [(dosage, rate) for rate in _interiorRates(*brackets[dosage], count)]
+        for evaluation in evaluator.evaluate(settings):
+            dosage, rate = evaluation["dosage"], evaluation["repetitionRate"]
+            low, high = brackets[dosage]
+            if not low < rate < high:
+                continue
+            if _meets(evaluation, target):
+                brackets[dosage] = (rate, high)
+            else:
+                brackets[dosage] = (low, rate)
+
+    evaluations = sorted(evaluator.memo.values(), key=lambda e: (-_speed(e), e["dosage"]))
+    return {"best": bestEvaluation(), "front": paretoFront(evaluations), "evaluations": evaluations,
+            "brackets": brackets, "simulations": spent(), "target": target}
+
+def _formatEvaluation(evaluation):
+    ssim = "failed" if evaluation["ssim"] is None else "{:.3f} ± {:.3f}".format(evaluation["ssim"], evaluation["ssimStd"])
+    return "dosage {:2d}, {:4d} Hz, {:5d} um/s: {:6d} s, SSIM {}".format(
+        evaluation["dosage"], evaluation["repetitionRate"], evaluation["scanningSpeed"], evaluation["mapTime"], ssim)
+
+def main(argv=None):
+    from assets import loadCSV
+    from streaming import openInput
+
+    parser = argparse.ArgumentParser(description="Shortest mapping time that reaches an SSIM target")
+    parser.add_argument("--nuclide", default="0", help="nuclide name or index")
+    parser.add_argument("--fluence", type=int, default=0, help="fluence index")
+    parser.add_argument("--target", type=float, default=0.8, help="minimum mean SSIM")
+    parser.add_argument("--dosages", default=",".join(str(dosage) for dosage in allowedDosages), help="dosages to consider, comma separated")
+    parser.add_argument("--concentration", type=float, default=500, help="sample concentration in ppm")
+    parser.add_argument("--flicker-noise", dest="flickerNoise", type=float, default=5, help="flicker noise in %%")
+    parser.add_argument("--budget", type=int, default=60, help="maximum number of simulations")
+    parser.add_argument("--width", type=int, default=None, help="rates evaluated per dosage and round (the number of processes by default, at least 2)")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="relative width at which a repetition rate bracket is closed")
+    parser.add_argument("--realizations", type=int, default=8, help="noise draws averaged per evaluation")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the noise of every evaluation")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds to wait for the simulations of one round; the missing ones count as failed")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (all cores by default)")
+    parser.add_argument("--input", help="input image (.npy or .csv), Vermeer.csv by default")
+    parser.add_argument("--crater", help="crater profile (.csv), BPn.csv by default")
+    parser.add_argument("--output", help="JSON file for the result")
+    args = parser.parse_args(argv)
+
+    bundle_dir = getBundleDir()
+    nuclideNames = np.load(os.path.join(bundle_dir, 'nuclideNames.npy'), allow_pickle=True)
+    washoutProfilesAll = np.load(os.path.join(bundle_dir, 'washoutProfilesAll.npy'), mmap_mode='r')
+    craterProfile = loadCSV(args.crater or os.path.join(bundle_dir, 'BPn.csv'))
+    inputImage = openInput(args.input or os.path.join(bundle_dir, 'Vermeer.csv'))
+    W = int(args.nuclide) if args.nuclide.isdigit() else list(nuclideNames).index(args.nuclide)
+    dosages = [int(dosage) for dosage in args.dosages.split(",")]
+    for dosage in dosages:
+        if dosage not in allowedDosages:
+            parser.error(f"dosage {dosage} is not one of {allowedDosages}")
+    processes = args.processes or os.cpu_count() or 1
+    width = args.width or max(2, processes)
+
+    pool = SimulationPool(inputImage, washoutProfilesAll, nuclideNames, processes=processes, beamSize=beamSize)
+    try:
+        evaluator = SSIMEvaluator(pool, craterProfile, inputImage.shape, W, args.fluence, args.concentration, args.flickerNoise, args.realizations,
+                                  args.seed, args.timeout)
+        result = optimizeAcquisition(evaluator, args.target, dosages, args.budget, width, args.tolerance)
+    finally:
+        pool.shutdown()
+
+    print(f"{nuclideNames[W]}, fluence {args.fluence}, SSIM target {args.target}, {result['simulations']} simulations")
+    print("Pareto front (mapping time against SSIM):")
+    for evaluation in result["front"]:
+        print("  " + _formatEvaluation(evaluation))
+    if result["best"] is None:
+        print("No allowed setting reaches the target")
+    else:
+        print("Fastest setting: " + _formatEvaluation(result["best"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(result, brackets={str(dosage): bracket for dosage, bracket in result["brackets"].items()},
+                           nuclide=str(nuclideNames[W]), fluence=args.fluence), f, indent=1)
+        print(f"Result written to {args.output}")
+    return 0 if result["best"] is not None else 1
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
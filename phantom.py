@@ -0,0 +1,151 @@
+import numpy as np
+import argparse
+
+# Perlin "improved" gradient noise (fractal Brownian motion over several octaves), vectorized
+# with NumPy. The arithmetic follows noise.pnoise2 in single precision: seeds 0 to 255 are its
+# base offset into Ken Perlin's reference permutation, so the values match pnoise2(x, y, base=seed)
+# (and generateImage gives the same images as when it used the noise package). Where pnoise2 would
+# read past the end of its table (a large base with large coordinates) the table is continued
+# periodically instead. Larger seeds shuffle the permutation. Large phantoms are generated tile by tile and can be written
+# straight into a memory-mapped .npy file.
+#
+#   python phantom.py 6000 6000 --seed 3 --output phantom.npy
+
+_referencePermutation = np.array([
+    151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225,
+    140, 36, 103, 30, 69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6, 148,
+    247, 120, 234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32,
+    57, 177, 33, 88, 237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175,
+    74, 165, 71, 134, 139, 48, 27, 166, 77, 146, 158, 231, 83, 111, 229, 122,
+    60, 211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54,
+    65, 25, 63, 161, 1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169,
+    200, 196, 135, 130, 116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3, 64,
+    52, 217, 226, 250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85, 212,
+    207, 206, 59, 227, 47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170, 213,
+    119, 248, 152, 2, 44, 154, 163, 70, 221, 153, 101, 155, 167, 43, 172, 9,
+    129, 22, 39, 253, 19, 98, 108, 110, 79, 113, 224, 232, 178, 185, 112, 104,
+    218, 246, 97, 228, 251, 34, 242, 193, 238, 210, 144, 12, 191, 179, 162, 241,
+    81, 51, 145, 235, 249, 14, 239, 107, 49, 192, 214, 31, 181, 199, 106, 157,
+    184, 84, 204, 176, 115, 121, 50, 45, 127, 4, 150, 254, 138, 236, 205, 93,
+    222, 114, 67, 29, 24, 72, 243, 141, 128, 195, 78, 66, 215, 61, 156, 180
+], dtype=np.intp)
+
+# Gradient directions of pnoise2 (x and y components of GRAD3), indexed by hash & 15
+_gradientX = np.array([1, -1, 1, -1, 1, -1, 1, -1, 0, 0, 0, 0, 1, -1, 0, 0], dtype=np.float32)
+_gradientY = np.array([1, 1, -1, -1, 0, 0, 0, 0, 1, -1, 1, -1, 0, 0, -1, 1], dtype=np.float32)
+
+def permutationTable(seed=0):
+    # (2, 512) hash tables: the doubled permutation, and the same shifted by the base offset
+    # (pnoise2 adds base to the cell indices of the first two lookups). Seeds below 256 are the
+    # base offset of the reference permutation, larger seeds shuffle it (with no offset).
+    if not 0 <= seed:
+        raise ValueError(f"seed must not be negative: {seed}")
+    if seed < 256:
+        permutation, base = _referencePermutation, seed
+    else:
+        permutation, base = np.random.default_rng(seed).permutation(256).astype(np.intp), 0
+    return np.stack([np.tile(permutation, 2), np.roll(np.tile(permutation, 2), -base)])
+
+def _lattice(coordinates):
+    # Lattice cells covered by the coordinates (wrapped to 0..255), the number of coordinates in
+    # each cell, and the position inside the cell with its fade curve
+    cell = np.floor(coordinates)
+    f = coordinates - cell
+    fade = f * f * f * (f * (f * 6 - 15) + 10)
+    cells, counts = np.unique(cell.astype(np.intp), return_counts=True)
+    return cells & 255, counts, f, fade
+
+def _cornerGradients(table, i, j):
+    # x and y gradient components at the lattice corners (i, j), i and j vectors of cells
+    permutation, shifted = table
+    h = permutation[shifted[shifted[i][:, np.newaxis] + j]] & 15
+    return _gradientX[h], _gradientY[h]
+
+def _expand(values, rowCounts, colCounts):
+    # Per-cell values repeated over the pixels of each cell
+    return np.repeat(np.repeat(values, rowCounts, axis=0), colCounts, axis=1)
+
+def gradientNoise(x, y, table):
+    # One octave on the grid x (rows) by y (columns), float32 coordinate vectors.
+    # The hashing is done once per lattice cell rather than once per pixel.
+    i, rowCounts, fx, u = _lattice(x)
+    j, colCounts, fy, v = _lattice(y)
+    ii, jj = (i + 1) & 255, (j + 1) & 255
+    fx, u = fx[:, np.newaxis], u[:, np.newaxis]
+    one = np.float32(1)
+
+    def corner(ci, cj, dx, dy):
+        gx, gy = _cornerGradients(table, ci, cj)
+        return _expand(gx, rowCounts, colCounts) * dx + _expand(gy, rowCounts, colCounts) * dy
+
+    # lerp(t, a, b) = a + t * (b - a), as in pnoise2
+    g00 = corner(i, j, fx, fy)
+    g10 = corner(ii, j, fx - one, fy)
+    lower = g00 + u * (g10 - g00)
+    g01 = corner(i, jj, fx, fy - one)
+    g11 = corner(ii, jj, fx - one, fy - one)
+    upper = g01 + u * (g11 - g01)
+    return lower + v * (upper - lower)
+
+def perlinNoise(shape, origin=(0, 0), scale=100.0, octaves=6, persistence=0.5, lacunarity=2.0, seed=0, table=None):
+    # Fractal noise in [-1, 1] for the pixels origin[0]:origin[0]+shape[0], origin[1]:origin[1]+shape[1]
+    # of an unbounded phantom; pixel (r, c) is pnoise2(r / scale, c / scale)
+    if table is None:
+        table = permutationTable(seed)
+    x = (np.arange(origin[0], origin[0] + shape[0]) / scale).astype(np.float32)
+    y = (np.arange(origin[1], origin[1] + shape[1]) / scale).astype(np.float32)
+
+    total = np.zeros(shape, dtype=np.float32)
+    frequency, amplitude, maxAmplitude = np.float32(1), np.float32(1), np.float32(0)
+    for _ in range(octaves):
+        octave = gradientNoise(x * frequency, y * frequency, table)
+        octave *= amplitude
+        total += octave
+        maxAmplitude += amplitude
+        frequency *= np.float32(lacunarity)
+        amplitude *= np.float32(persistence)
+    total /= maxAmplitude
+    return total
+
+def phantomTiles(shape, tileSize=1024, scale=100.0, octaves=6, persistence=0.5, lacunarity=2.0, seed=0):
+    # Lazily yields (rowStart, colStart, tile) covering the phantom, tiles scaled to [0, 1]
+    table = permutationTable(seed)
+    for rowStart in range(0, shape[0], tileSize):
+        for colStart in range(0, shape[1], tileSize):
+            tileShape = (min(tileSize, shape[0] - rowStart), min(tileSize, shape[1] - colStart))
+            tile = perlinNoise(tileShape, (rowStart, colStart), scale, octaves, persistence, lacunarity, table=table)
+            tile += 1
+            tile /= 2
+            yield rowStart, colStart, tile
+
+def generatePhantom(shape, seed=0, dtype=np.float32, tileSize=1024, **noiseParameters):
+    # Phantom in [0, 1] as an in-memory array
+    phantom = np.empty(shape, dtype=dtype)
+    for rowStart, colStart, tile in phantomTiles(shape, tileSize, seed=seed, **noiseParameters):
+        phantom[rowStart:rowStart + tile.shape[0], colStart:colStart + tile.shape[1]] = tile
+    return phantom
+
+def writePhantom(path, shape, seed=0, dtype=np.float32, tileSize=1024, **noiseParameters):
+    # Writes the phantom tile by tile into a .npy file, so only one tile is held in memory
+    phantom = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+    for rowStart, colStart, tile in phantomTiles(shape, tileSize, seed=seed, **noiseParameters):
+        phantom[rowStart:rowStart + tile.shape[0], colStart:colStart + tile.shape[1]] = tile
+    phantom.flush()
+    del phantom
+    return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Perlin noise phantom for the ablation simulation")
+    parser.add_argument("rows", type=int)
+    parser.add_argument("cols", type=int)
+    parser.add_argument("--output", required=True, help=".npy file to write")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scale", type=float, default=100.0)
+    parser.add_argument("--octaves", type=int, default=6)
+    parser.add_argument("--persistence", type=float, default=0.5)
+    parser.add_argument("--lacunarity", type=float, default=2.0)
+    parser.add_argument("--tile-size", dest="tileSize", type=int, default=1024)
+    args = parser.parse_args()
+    writePhantom(args.output, (args.rows, args.cols), args.seed, tileSize=args.tileSize, scale=args.scale,
+                 octaves=args.octaves, persistence=args.persistence, lacunarity=args.lacunarity)
+    print(f"{args.rows}x{args.cols} phantom written to {args.output}")
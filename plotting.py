@@ -0,0 +1,91 @@
+import numpy as np
+
+# Redraws of the GUI figures. The figures are built once and their artists updated in place
+# (set_data, set_ydata); the artists that change are marked animated, so a normal draw renders
+# everything else and the result is kept as the background. An update then only restores the
+# background, draws the changed artists and blits the figure, instead of redrawing the axes, the
+# ticks and the labels. Updates are coalesced into at most one frame per frameInterval, so a
+# slider drag that fires many callbacks between two screen refreshes costs one redraw.
+#
+# A full draw is still needed when something outside the animated artists changes: the axis
+# limits, the aspect of an image pane or the size of the canvas (the canvas redraws itself then
+# and the background is captured again).
+#
+# matplotlib is not imported here; the figures and canvases are created by the caller.
+
+frameInterval = 16 # ms, about one frame at 60 Hz
+
+class BlittedFigure:
+    def __init__(self, canvas, schedule=None):
+        # schedule(milliseconds, callback) runs a callback later on the GUI thread (Tk's after by default)
+        self.canvas = canvas
+        self.figure = canvas.figure
+        self.schedule = schedule or canvas.get_tk_widget().after
+        self.artists = []
+        self._background = None
+        self._pending = False
+        self._fullDraw = False
+        canvas.mpl_connect("draw_event", self._onDraw)
+
+    def add(self, artist):
+        artist.set_animated(True)
+        self.artists.append(artist)
+        return artist
+
+    def _onDraw(self, event):
+        # After every full draw (including the ones Tk makes on resize): keep the background, then
+        # draw the animated artists on top of it, which the draw itself leaves out
+        self._background = self.canvas.copy_from_bbox(self.figure.bbox)
+        for artist in self.artists:
+            self.figure.draw_artist(artist)
+
+    def requestFrame(self, fullDraw=False):
+        # Redraws the animated artists (or the whole figure) in the next frame
+        self._fullDraw = self._fullDraw or fullDraw
+        if not self._pending:
+            self._pending = True
+            self.schedule(frameInterval, self._frame)
+
+    def _frame(self):
+        self._pending = False
+        if self._fullDraw or self._background is None:
+            self._fullDraw = False
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self._background)
+        for artist in self.artists:
+            self.figure.draw_artist(artist)
+        self.canvas.blit(self.figure.bbox)
+
+class ImagePane:
+    # One image filling a figure (axes off), shown with imshow once and updated with set_data.
+    # Images with the same shape are blitted; a new shape changes the aspect and needs a full draw.
+    def __init__(self, canvas, image, cmap='gray', schedule=None):
+        figure = canvas.figure
+        self.axes = figure.add_axes([0, 0, 1, 1])
+        self.axes.axis('off')
+        self.blitter = BlittedFigure(canvas, schedule)
+        self.artist = self.blitter.add(self.axes.imshow(image, cmap=cmap))
+
+    def show(self, image):
+        # Scaled to the range of the image, like imshow; NaN pixels (unfinished lines) stay transparent
+        image = np.asarray(image)
+        fullDraw = image.shape != self.artist.get_array().shape
+        self.artist.set_data(image)
+        self.artist.autoscale()
+        if fullDraw:
+            height, width = image.shape[:2]
+            self.artist.set_extent((-0.5, width - 0.5, height - 0.5, -0.5))
+            self.axes.set_xlim(-0.5, width - 0.5)
+            self.axes.set_ylim(height - 0.5, -0.5)
+        self.blitter.requestFrame(fullDraw)
+
+    def setColormap(self, cmap):
+        self.artist.set_cmap(cmap)
+        self.blitter.requestFrame()
+
+def dataLimits(values, margin=0.05):
+    # (low, high) of the values with a margin, as the axes autoscale would set them
+    low, high = float(np.nanmin(values)), float(np.nanmax(values))
+    span = high - low if high > low else max(abs(high), 1.0)
+    return low - margin * span, high + margin * span
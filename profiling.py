@@ -0,0 +1,184 @@
+import json
+import time
+import traceback
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Instrumentation of the simulation stages: wall time, CPU time, peak memory and the shapes of
+# the arrays each stage produced. A Profile is passed to the simulation (profile=...) and keeps
+# one StageRecord per stage, optionally handing each to a callback as the stage ends. Without a
+# profile, profileStage returns a context that does nothing.
+#
+# NumPy reports its array allocations to tracemalloc, so the traced peak inside a stage is the
+# largest amount of array memory the stage held on top of what was allocated before it started.
+# Stages may be nested (a cached stage computing the stage it depends on); the times and the peak
+# of an outer stage include its inner stages.
+
+class StageRecord:
+    def __init__(self, name, depth, start):
+        self.name = name
+        self.depth = depth # number of enclosing stages
+        self.start = start # s since the first stage of the profile
+        self.wall = 0.0 # s
+        self.cpu = 0.0 # s of process CPU time
+        self.peak = None # bytes, None when memory is not traced
+        self.retained = None # bytes still allocated at the end of the stage
+        self.shapes = {}
+        self.error = None
+        self._startBytes = 0
+        self._highest = 0
+
+    def note(self, **arrays):
+        # Records the shapes of the arrays a stage produced, e.g. record.note(image=smearedImage)
+        for key, value in arrays.items():
+            self.shapes[key] = list(getattr(value, "shape", value))
+
+    def toDict(self):
+        return {"name": self.name, "depth": self.depth, "start": self.start, "wall": self.wall, "cpu": self.cpu,
+                "peak": self.peak, "retained": self.retained, "shapes": self.shapes, "error": self.error}
+
+    @classmethod
+    def fromDict(cls, values):
+        record = cls(values["name"], values["depth"], values["start"])
+        for key in ("wall", "cpu", "peak", "retained", "shapes", "error"):
+            setattr(record, key, values[key])
+        return record
+
+class _DisabledRecord:
+    def note(self, **arrays):
+        pass
+
+_disabledRecord = _DisabledRecord()
+
+class Profile:
+    # traceMemory: trace the peak memory (tracemalloc slows allocations down somewhat); tracing
+    # starts with the first stage and stops at finish().
+    # callback: called with every StageRecord when its stage ends.
+    def __init__(self, traceMemory=True, callback=None):
+        self.traceMemory = traceMemory
+        self.callback = callback
+        self.records = [] # StageRecords, in the order the stages finished
+        self.totalPeak = 0 # highest traced memory from the first stage until finish()
+        self.error = None # traceback of the exception that ended the run, if any
+        self._open = []
+        self._origin = None
+        self._startedTracing = False
+
+    @contextmanager
+    def stage(self, name):
+        if self._origin is None:
+            self._origin = time.perf_counter()
+        record = StageRecord(name, len(self._open), time.perf_counter() - self._origin)
+        if self.traceMemory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._startedTracing = True
+            current, peak = tracemalloc.get_traced_memory()
+            self._updateOpen(peak)
+            tracemalloc.reset_peak()
+            record._startBytes = record._highest = current
+        self._open.append(record)
+        cpuStart = time.process_time()
+        wallStart = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record.error = repr(e)
+            raise
+        finally:
+            record.wall = time.perf_counter() - wallStart
+            record.cpu = time.process_time() - cpuStart
+            if self.traceMemory:
+                current, peak = tracemalloc.get_traced_memory()
+                self._updateOpen(peak)
+                record.peak = record._highest - record._startBytes
+                record.retained = current - record._startBytes
+            self._open.pop()
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def _updateOpen(self, peak):
+        self.totalPeak = max(self.totalPeak, peak)
+        for record in self._open:
+            record._highest = max(record._highest, peak)
+
+    def fail(self, exception):
+        self.error = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+
+    def finish(self):
+        if self.traceMemory and tracemalloc.is_tracing():
+            self._updateOpen(tracemalloc.get_traced_memory()[1])
+            if self._startedTracing:
+                tracemalloc.stop()
+        self._startedTracing = False
+
+    def summary(self):
+        # Records combined by stage name, in the order the names first finished:
+        # [(name, depth, calls, wall, cpu, peak or None, shapes of the last call)]
+        combined = {}
+        for record in self.records:
+            if record.name not in combined:
+                combined[record.name] = [record.name, record.depth, 0, 0.0, 0.0, record.peak, record.shapes]
+            entry = combined[record.name]
+            entry[2] += 1
+            entry[3] += record.wall
+            entry[4] += record.cpu
+            if record.peak is not None:
+                entry[5] = max(entry[5] or 0, record.peak)
+            entry[6] = record.shapes
+        return [tuple(entry) for entry in combined.values()]
+
+    def report(self):
+        lines = []
+        for name, depth, calls, wall, cpu, peak, shapes in self.summary():
+            line = "{}{}: {:.1f} ms wall, {:.1f} ms CPU".format("  " * depth, name, 1000 * wall, 1000 * cpu)
+            if calls > 1:
+                line += " ({} calls)".format(calls)
+            if peak is not None:
+                line += ", peak {:.1f} MB".format(peak / 1e6)
+            if shapes:
+                line += ", " + ", ".join("{} {}".format(key, "x".join(str(n) for n in shape)) for key, shape in shapes.items())
+            lines.append(line)
+        if self.traceMemory:
+            lines.append("total: peak {:.1f} MB".format(self.totalPeak / 1e6))
+        if self.error is not None:
+            lines.append("failed:\n" + self.error)
+        return "\n".join(lines)
+
+    def toDict(self):
+        return {"records": [record.toDict() for record in self.records], "totalPeak": self.totalPeak,
+                "traceMemory": self.traceMemory, "error": self.error}
+
+    @classmethod
+    def fromDict(cls, values):
+        profile = cls(traceMemory=values["traceMemory"])
+        profile.records = [StageRecord.fromDict(record) for record in values["records"]]
+        profile.totalPeak = values["totalPeak"]
+        profile.error = values["error"]
+        return profile
+
+    def chromeTrace(self, pid=0, tid=0):
+        # Trace Event Format (chrome://tracing, Perfetto): one complete event per stage, in microseconds
+        events = []
+        for record in self.records:
+            args = {"cpu ms": 1000 * record.cpu}
+            if record.peak is not None:
+                args["peak MB"] = record.peak / 1e6
+            args.update({"shape " + key: shape for key, shape in record.shapes.items()})
+            if record.error is not None:
+                args["error"] = record.error
+            events.append({"name": record.name, "ph": "X", "ts": 1e6 * record.start, "dur": 1e6 * record.wall,
+                           "pid": pid, "tid": tid, "args": args})
+        return {"traceEvents": sorted(events, key=lambda event: event["ts"]), "displayTimeUnit": "ms"}
+
+    def save(self, path, format="json"):
+        # format "json" (toDict) or "chrome" (chromeTrace)
+        with open(path, "w") as f:
+            json.dump(self.chromeTrace() if format == "chrome" else self.toDict(), f, indent=1)
+
+def profileStage(profile, name):
+    # Context for one stage, yielding its StageRecord; does nothing when profiling is off
+    if profile is None:
+        return nullcontext(_disabledRecord)
+    return profile.stage(name)
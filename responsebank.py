@@ -0,0 +1,123 @@
+import numpy as np
+import json
+import os
+import shutil
+import sys
+
+from cache import getCacheDir, arrayFingerprint
+
+# Precomputed response curves for every nuclide x fluence x tabulated repetition rate.
+# The curves of one repetition rate all have the same length, so the bank is stored as one
+# flat (memory-mapped) array with a start offset per curve and a length per repetition rate:
+#   responseBank-<fingerprint>/data.npy     float64, all curves back to back
+#   responseBank-<fingerprint>/offsets.npy  int64 (nuclides, fluences, rates), start of each curve
+#   responseBank-<fingerprint>/lengths.npy  int64 (rates,), length of the curves of each rate
+#   responseBank-<fingerprint>/rates.npy    repetition rates in Hz
+#   responseBank-<fingerprint>/meta.json    source fingerprint, dwell time and format version
+
+_bankVersion = 1
+
+def resampleResponse(washoutProfile, repetitionRate, dwellTime, axis=0):
+    # Response curve of the washout profile(s) at the given repetition rate (curves along axis).
+    # scipy.signal is slow to import and only needed when a curve has to be resampled.
+    import scipy.signal as signal
+    responseCurve0 = (dwellTime / 1000) * washoutProfile
+    numSamples = round(100 * 1000 / repetitionRate) # Number of samples in the response curve
+    return (1000 / repetitionRate) * (1 / dwellTime) * signal.resample_poly(responseCurve0, 300, numSamples, axis=axis) # resample_poly is analogous to resample in MATLAB
+
+def _bankKey(washoutProfilesAll, dwellTime):
+    return f"{arrayFingerprint(washoutProfilesAll)}-{dwellTime:g}ms-v{_bankVersion}"
+
+def _bankPath(washoutProfilesAll, dwellTime, directory=None):
+    return os.path.join(directory or getCacheDir(), 'responseBank-' + _bankKey(washoutProfilesAll, dwellTime))
+
+class ResponseBank:
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.lengths = np.load(os.path.join(path, 'lengths.npy'))
+        self.rates = np.load(os.path.join(path, 'rates.npy'))
+        self.rateIndex = {int(rate): i for i, rate in enumerate(self.rates)}
+
+    def lookup(self, W, fluence, repetitionRate):
+        # Read-only view of the response curve, or None if the repetition rate is not tabulated
+        if repetitionRate != int(repetitionRate) or int(repetitionRate) not in self.rateIndex:
+            return None
+        r = self.rateIndex[int(repetitionRate)]
+        start = self.offsets[W, fluence, r]
+        return self.data[start:start + self.lengths[r]]
+
+def buildResponseBank(washoutProfilesAll, RRs, dwellTime=3, directory=None):
+    # Resamples all curves of one repetition rate in a single call and writes the bank
+    path = _bankPath(washoutProfilesAll, dwellTime, directory)
+    numNuclides, numFluences = washoutProfilesAll.shape[1:]
+    rates = np.asarray(RRs)
+
+    curves = [resampleResponse(washoutProfilesAll, int(rate), dwellTime, axis=0) for rate in rates]
+    lengths = np.array([curve.shape[0] for curve in curves], dtype=np.int64)
+    rateStarts = np.concatenate([[0], np.cumsum(lengths * numNuclides * numFluences)[:-1]])
+
+    # Curves are stored contiguously in (rate, nuclide, fluence) order
+    data = np.concatenate([np.moveaxis(curve, 0, -1).ravel() for curve in curves])
+    curveIndex = np.arange(numNuclides * numFluences).reshape(numNuclides, numFluences)
+    offsets = rateStarts[np.newaxis, np.newaxis, :] + curveIndex[:, :, np.newaxis] * lengths[np.newaxis, np.newaxis, :]
+
+    # Write to a temporary directory first so that a half written bank is never picked up
+    temporaryPath = path + f'.tmp{os.getpid()}'
+    try:
+        os.makedirs(temporaryPath, exist_ok=True)
+        np.save(os.path.join(temporaryPath, 'data.npy'), data)
+        np.save(os.path.join(temporaryPath, 'offsets.npy'), offsets.astype(np.int64))
+        np.save(os.path.join(temporaryPath, 'lengths.npy'), lengths)
+        np.save(os.path.join(temporaryPath, 'rates.npy'), rates)
+        with open(os.path.join(temporaryPath, 'meta.json'), 'w') as f:
+            json.dump({"version": _bankVersion, "source": arrayFingerprint(washoutProfilesAll), "dwellTime": dwellTime,
+                       "shape": [numNuclides, numFluences, len(rates)], "curves": int(offsets.size)}, f, indent=2)
+    except OSError:
+        # E.g. the disk is full: leave no partial bank behind
+        shutil.rmtree(temporaryPath, ignore_errors=True)
+        raise
+    try:
+        os.rename(temporaryPath, path)
+    except OSError:
+        # Another process built the same bank in the meantime
+        shutil.rmtree(temporaryPath, ignore_errors=True)
+    return ResponseBank(path)
+
+_openBanks = {}
+
+def getResponseBank(washoutProfilesAll, dwellTime=3, RRs=None, directory=None):
+    # Opens the bank for these washout profiles, building it first if RRs are given.
+    # Returns None when there is no bank and none can be built (e.g. the cache directory is not
+    # writable); the curves are then resampled on every run.
+    key = _bankKey(washoutProfilesAll, dwellTime)
+    if key in _openBanks:
+        return _openBanks[key]
+    try:
+        path = _bankPath(washoutProfilesAll, dwellTime, directory)
+    except OSError as e:
+        print(f"No response bank: {e}")
+        return None
+    bank = None
+    if os.path.isdir(path):
+        try:
+            bank = ResponseBank(path)
+        except (OSError, ValueError, KeyError):
+            bank = None
+    if bank is None and RRs is not None:
+        try:
+            bank = buildResponseBank(washoutProfilesAll, RRs, dwellTime, directory)
+        except OSError as e:
+            print(f"Response bank not built, the curves are resampled on every run: {e}")
+    if bank is not None:
+        _openBanks[key] = bank
+    return bank
+
+if __name__ == "__main__":
+    bundle_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
+    washoutProfilesAll = np.load(os.path.join(bundle_dir, 'washoutProfilesAll.npy'))
+    RRs = np.load(os.path.join(bundle_dir, 'RRs.npy'))
+    bank = buildResponseBank(washoutProfilesAll, RRs)
+    print("Response bank with {} curves ({:.1f} MB) written to {}".format(bank.meta["curves"], bank.data.nbytes / 1e6, _bankPath(washoutProfilesAll, 3)))
@@ -0,0 +1,51 @@
+import importlib
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Startup timing of the GUI: how long each import and each step took from the start of the
+# process until the window was ready, so that slow imports or assets show up as regressions.
+
+class StartupTimer:
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.entries = [] # (kind, label, seconds, thread name)
+        self._lock = threading.Lock()
+
+    def record(self, kind, label, seconds):
+        with self._lock:
+            self.entries.append((kind, label, seconds, threading.current_thread().name))
+
+    def importModule(self, name):
+        # Imports a module and records the time, unless it was already imported
+        if name in sys.modules:
+            return sys.modules[name]
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        self.record("import", name, time.perf_counter() - start)
+        return module
+
+    @contextmanager
+    def step(self, label):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record("step", label, time.perf_counter() - start)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def report(self, assets=None):
+        # Imports and steps in the order they finished, followed by the asset report of the data bundle
+        lines = [f"Startup: ready after {1000 * self.elapsed():.0f} ms"]
+        with self._lock:
+            entries = list(self.entries)
+        for kind, label, seconds, threadName in entries:
+            where = "" if threadName == "MainThread" else f" [{threadName}]"
+            lines.append(f"  {kind:6s} {label}: {1000 * seconds:.1f} ms{where}")
+        if assets is not None:
+            lines.append("  Assets:")
+            lines.extend("    " + line for line in assets.report().splitlines())
+        return "\n".join(lines)
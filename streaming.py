@@ -0,0 +1,261 @@
+import numpy as np
+import argparse
+import logging
+import os
+import sys
+import time
+
+from skimage.measure import block_reduce
+
+from convolution import convolveDecimated, convolveFullMax
+from alignment import alignToReference
+from assets import loadCSV
+from cache import arrayFingerprint
+from util import responseStage, smearStage, noiseStage, noiselessStages, mappingTime, stageCache, cachedStage, beamCacheKey, referenceCacheKey, responseCacheKey, smearCacheKey
+from profiling import profileStage
+
+logger = logging.getLogger(__name__)
+
+# Streaming simulation for input maps of any size. Every output row is one laser line: beamSize
+# input rows convolved with the crater profile, smeared along the scan direction and averaged
+# over dosage shots, so the input can be read in bands of rows (from a memory-mapped file) and
+# the simulated lines produced band by band. Only one band of the input is in memory at a time;
+# the simulated map itself is beamSize x beamSize times smaller than the input.
+#
+# The normalization needs the maximum of the full beam convolution, which is found in a first
+# pass over the bands (see streamConvolutionMax) unless it is given.
+#
+#   python streaming.py phantom.npy --nuclide 23Na --rate 500 --dosage 10 --output result.npz
+
+beamSize = 20 # um
+dwellTime = 3 # ms
+C_washout = 100 # ppm
+
+def openInput(source):
+    # Arrays are used as they are; .npy files are memory-mapped, CSV files are read through the binary cache
+    if isinstance(source, (str, os.PathLike)):
+        if str(source).endswith('.npy'):
+            return np.load(source, mmap_mode='r')
+        return loadCSV(source, mmapMode='r')
+    return source
+
+def defaultBandLines(imageShape, dtype=np.float64, bandBytes=32 * 1024**2):
+    # Number of laser lines per band so that one band of input rows takes about bandBytes
+    return max(1, int(bandBytes // (beamSize * imageShape[1] * np.dtype(dtype).itemsize)))
+
+def numLaserLines(imageRows, kernelRows):
+    # Number of simulated lines, as in the in-memory pipeline: rows m-1, 2m-1, ... of the full
+    # convolution (imageRows + kernelRows - 1 rows). The last line can lie below the input rows and
+    # then has no reference line; the reference image has ceil(imageRows / beamSize) rows.
+    return len(range(beamSize - 1, imageRows + kernelRows - 1, beamSize))
+
+def _readBand(image, start, stop, dtype):
+    return np.array(image[start:stop], dtype=dtype)
+
+def streamConvolutionMax(image, kernel, bandRows, dtype=np.float64, lowerBound=-np.inf):
+    # Maximum of signal.convolve2d(image, kernel, mode='full'), one band of input rows at a time.
+    # Each band is read with the kernel height - 1 rows above it, so the convolution rows of the
+    # band are exact; the bottom band also covers the rows below the image.
+    H = image.shape[0]
+    kh = kernel.shape[0]
+    best = lowerBound
+    for start in range(0, H, bandRows):
+        stop = min(start + bandRows, H)
+        first = max(0, start - (kh - 1))
+        band = _readBand(image, first, stop, dtype)
+        rowStop = stop if stop < H else H + kh - 1
+        best = convolveFullMax(band, kernel, lowerBound=best, rows=(start - first, rowStop - first))
+    return best
+
+def simulateLines(inputImage, craterProfile, washoutProfilesAll, repetitionRate, W=0, C_sample=500, fluence=0, dosage=10, flickerNoise=5, bandLines=None, convolvedMax=None, dtype=np.float64, addNoise=True, profile=None, onBand=None):
+    # Generator over the laser lines. Yields (lineIndex, line, referenceLine): the simulated counts
+    # of one line (smeared, averaged over dosage shots, with Poisson and flicker noise) and the mean
+    # input over the beamSize x beamSize pixels of that line (not normalized), None for a last line
+    # below the input rows (see numLaserLines).
+    # profile: a profiling.Profile that receives one "band" stage per band of lines.
+    # onBand(sampled, smeared): called with the noise-free stages of every band, the normalized beam
+    # samples and the smeared lines averaged over dosage shots (before the concentration scaling).
+    image = openInput(inputImage)
+    H = image.shape[0]
+    kernel = np.asarray(craterProfile, dtype=dtype)
+    kh = kernel.shape[0]
+
+    # Horizontal and vertical step size
+    k = int(beamSize / dosage)
+    m = int(beamSize)
+    numLines = numLaserLines(H, kh)
+    if bandLines is None:
+        bandLines = defaultBandLines(image.shape, dtype)
+
+    if convolvedMax is None:
+        convolvedMax = streamConvolutionMax(image, kernel, bandLines * m, dtype)
+    responseCurve = responseStage(washoutProfilesAll, W, fluence, repetitionRate, dwellTime)
+
+    for firstLine in range(0, numLines, bandLines):
+        lastLine = min(firstLine + bandLines, numLines)
+        with profileStage(profile, "band") as record:
+            # Line r samples row r*m + m - 1 of the full convolution, which sees input rows down to r*m + m - kh
+            start = max(0, min(firstLine * m, firstLine * m + m - kh))
+            stop = min(H, lastLine * m)
+            band = _readBand(image, start, stop, dtype)
+
+            sampled = convolveDecimated(band, kernel, m, k, firstLine * m + m - 1 - start, k - 1)[:lastLine - firstLine]
+            if sampled.shape[0] < lastLine - firstLine:
+                # Lines below the reach of the kernel see no signal
+                sampled = np.vstack([sampled, np.zeros((lastLine - firstLine - sampled.shape[0], sampled.shape[1]), dtype=sampled.dtype)])
+            sampled /= convolvedMax
+
+            smearedImageAveraged = smearStage(sampled, responseCurve, dosage)
+            if onBand is not None:
+                onBand(sampled, smearedImageAveraged)
+            smearedImage = (C_sample / C_washout) * dosage * smearedImageAveraged
+            # Set negative values and NaNs to zero
+            smearedImage[smearedImage < 0] = 0
+            smearedImage[np.isnan(smearedImage)] = 0
+            if addNoise:
+                noiseStage(smearedImage, flickerNoise)
+
+            referenceRows = band[firstLine * m - start:]
+            reference = block_reduce(referenceRows, (m, m), np.mean) if len(referenceRows) else referenceRows
+            record.note(band=band, lines=smearedImage)
+        for i in range(lastLine - firstLine):
+            yield firstLine + i, smearedImage[i], reference[i] if i < len(reference) else None
+
+def _cachedLines(image, craterProfile, washoutProfilesAll, repetitionRate, W, C_sample, fluence, dosage, flickerNoise, dtype, profile):
+    # The lines of simulateLines from the in-memory stages of simulateAblation, when the beam samples
+    # are in the stage cache: the smear is taken from the cache or computed on the whole map at once,
+    # which is much faster than convolving the map again band by band
+    referenceImage, smearedImage = noiselessStages(image, craterProfile, washoutProfilesAll, repetitionRate, W, C_sample, fluence, dosage, dtype=dtype, profile=profile)
+    with profileStage(profile, "noise"):
+        noiseStage(smearedImage, flickerNoise)
+    for lineIndex in range(smearedImage.shape[0]):
+        yield lineIndex, smearedImage[lineIndex], referenceImage[lineIndex] if lineIndex < referenceImage.shape[0] else None
+
+def simulateStreaming(inputImage, craterProfile, washoutProfilesAll, nuclideNames, repetitionRate, W=0, C_sample=500, fluence=0, dosage=10, scanningSpeed=2000, flickerNoise=5, useRR=False, bandLines=None, dtype=np.float64, alignmentMode="search", useCache=True, progress=None, profile=None):
+    # Same result as simulateAblation, (referenceImage, simulatedImage, max_ssim, nuclide, mapTime),
+    # computed line by line. progress(linesDone, numLines, referenceImage, simulatedImage) is called
+    # after every line with the images filled so far (raw counts, not yet normalized or aligned);
+    # if it returns True the simulation stops and all None is returned.
+    # useCache: the noise-free stages are shared with simulateAblation through its stage cache. If the
+    # beam samples of this map are cached, the lines are made from them (see _cachedLines); otherwise
+    # they are computed band by band and the stages of the finished run are stored, so a following run
+    # or simulateEnsemble of the same map starts from them. The convolution maximum is memoized too.
+    # profile: a profiling.Profile, as for simulateAblation.
+    try:
+        nuclide = nuclideNames[W]
+        if useRR:
+            scanningSpeed = round(repetitionRate * beamSize / dosage) # Scanning speed µm/s
+        else:
+            repetitionRate = round(scanningSpeed * dosage / beamSize) # Repetition rate in Hz
+
+        print("Nuclide:", nuclide)
+        print("Repetition Rate:", repetitionRate)
+        print("Scanning Speed:", scanningSpeed)
+        print("Dosage:", dosage)
+
+        image = openInput(inputImage)
+        kernel = np.asarray(craterProfile, dtype=dtype)
+        numLines = numLaserLines(image.shape[0], kernel.shape[0])
+        numReferenceLines = -(-image.shape[0] // beamSize)
+        if bandLines is None:
+            bandLines = defaultBandLines(image.shape, dtype)
+        # The input is only hashed for the cache: for a map larger than memory it is a full extra read
+        cache = stageCache if useCache else None
+        if cache is not None:
+            # The stages of simulateAblation with the default (exact) beam convolution
+            imageKey, dtypeKey = arrayFingerprint(image), np.dtype(dtype).str
+            beamKey = beamCacheKey(imageKey, np.asarray(craterProfile), beamSize, int(beamSize / dosage), "auto", None, dtypeKey)
+            referenceKey = referenceCacheKey(imageKey, beamSize, dtypeKey)
+        cached = cache is not None and beamKey in cache and referenceKey in cache
+
+        bands = []
+        if cached:
+            lines = _cachedLines(image, craterProfile, washoutProfilesAll, repetitionRate, W, C_sample, fluence, dosage, flickerNoise, dtype, profile)
+        else:
+            with profileStage(profile, "convolution max"):
+                computeMax = lambda: streamConvolutionMax(image, kernel, bandLines * beamSize, dtype)
+                if cache is None:
+                    convolvedMax = computeMax()
+                else:
+                    convolvedMax = cachedStage(cache, ("streamMax", imageKey, arrayFingerprint(kernel), dtypeKey), computeMax)
+            lines = simulateLines(image, kernel, washoutProfilesAll, repetitionRate, W, C_sample, fluence, dosage, flickerNoise, bandLines, convolvedMax, dtype, profile=profile,
+                                  onBand=None if cache is None else lambda *stages: bands.append(stages))
+
+        simulatedImage = referenceImage = None
+        for lineIndex, line, referenceLine in lines:
+            if simulatedImage is None:
+                simulatedImage = np.zeros((numLines, line.shape[0]), dtype=line.dtype)
+                referenceImage = np.zeros((numReferenceLines, referenceLine.shape[0]), dtype=referenceLine.dtype)
+            simulatedImage[lineIndex] = line
+            if referenceLine is not None:
+                referenceImage[lineIndex] = referenceLine
+            if progress is not None and progress(lineIndex + 1, numLines, referenceImage, simulatedImage):
+                logger.info("Cancelled after %d of %d lines", lineIndex + 1, numLines)
+                if profile is not None:
+                    profile.finish()
+                return None, None, None, None, None
+
+        # Normalize the reference and the final noisy image
+        referenceImage /= np.max(referenceImage)
+        simulatedImage /= np.max(simulatedImage)
+
+        if bands:
+            cache.put(beamKey, np.concatenate([sampled for sampled, smeared in bands]))
+            cache.put(referenceKey, referenceImage)
+            responseKey = responseCacheKey(washoutProfilesAll, W, fluence, repetitionRate)
+            cache.put(smearCacheKey(beamKey, responseKey, dosage), np.concatenate([smeared for sampled, smeared in bands]))
+
+        with profileStage(profile, "alignment") as record:
+            shift, max_ssim, alignedImage = alignToReference(simulatedImage, referenceImage, mode=alignmentMode, numShifts=20)
+            record.note(image=alignedImage)
+        logger.info("Shift: %d", shift)
+        if profile is not None:
+            profile.finish()
+
+        mapTime = mappingTime(image.shape, dosage, repetitionRate, beamSize)
+        return referenceImage, alignedImage, max_ssim, nuclide, mapTime
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        if profile is not None:
+            profile.fail(e)
+            profile.finish()
+        return None, None, None, None, None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the ablation of a large map (.npy or .csv) band by band")
+    parser.add_argument("input", help="input image, .npy (memory-mapped) or .csv")
+    parser.add_argument("--output", required=True, help=".npz file for the reference image, the simulated image, SSIM and mapping time")
+    parser.add_argument("--crater", help="crater profile (.csv), BPn.csv by default")
+    parser.add_argument("--nuclide", default="0", help="nuclide name or index")
+    parser.add_argument("--fluence", type=int, default=0, help="fluence index")
+    parser.add_argument("--rate", type=int, default=1000, help="repetition rate in Hz")
+    parser.add_argument("--dosage", type=int, default=10)
+    parser.add_argument("--concentration", type=float, default=500, help="sample concentration in ppm")
+    parser.add_argument("--flicker-noise", dest="flickerNoise", type=float, default=5, help="flicker noise in %%")
+    parser.add_argument("--band-lines", dest="bandLines", type=int, default=None, help="laser lines per band (sized to about 32 MB by default)")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    bundle_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
+    nuclideNames = np.load(os.path.join(bundle_dir, 'nuclideNames.npy'), allow_pickle=True)
+    washoutProfilesAll = np.load(os.path.join(bundle_dir, 'washoutProfilesAll.npy'))
+    craterProfile = loadCSV(args.crater or os.path.join(bundle_dir, 'BPn.csv'))
+    W = int(args.nuclide) if args.nuclide.isdigit() else list(nuclideNames).index(args.nuclide)
+    if args.seed is not None:
+        np.random.seed(args.seed)
+
+    start = time.perf_counter()
+    def progress(linesDone, numLines, referenceImage, simulatedImage):
+        if linesDone == numLines or linesDone % 100 == 0:
+            print(f"{linesDone}/{numLines} lines, {time.perf_counter() - start:.1f} s", flush=True)
+
+    referenceImage, simulatedImage, max_ssim, nuclide, mapTime = simulateStreaming(
+        args.input, craterProfile, washoutProfilesAll, nuclideNames, args.rate, W=W, C_sample=args.concentration,
+        fluence=args.fluence, dosage=args.dosage, flickerNoise=args.flickerNoise, useRR=True, bandLines=args.bandLines,
+        dtype=np.dtype(args.dtype), useCache=False, progress=progress)
+    if max_ssim is None:
+        sys.exit(1)
+    np.savez(args.output, referenceImage=referenceImage, simulatedImage=simulatedImage, ssim=max_ssim, mapTime=mapTime)
+    print(f"SSIM {max_ssim:.3f}, mapping time {mapTime} s, written to {args.output}")
@@ -0,0 +1,295 @@
+import numpy as np
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+
+# Instant SSIM estimates from a precomputed quality surface. The surface holds the SSIM of
+# simulateAblation on a grid of nuclide x fluence x dosage x repetition rate x concentration
+# (noise-averaged over a few realizations per point), and SSIMSurrogate interpolates it:
+# multilinear in the fluence index and in the logarithm of dosage, repetition rate and
+# concentration, clamped to the range of the grid. Nuclides are only looked up, not interpolated.
+#
+# The surface is built with the parallel sweep (sweep.py) on the real engine and stored as
+#   ssimSurface.npz   ssim, ssimStd (nuclides, fluences, dosages, rates, concentrations), NaN where a run failed
+#                     nuclides, fluences, dosages, rates, concentrations: the grid
+#                     meta: JSON with the input image shape, flicker noise, realizations, seed and the errors
+#
+#   python surrogate.py --processes 8                 # default grid, written to ssimSurface.npz in the cache directory
+#   python surrogate.py --nuclides 23Na --validate 50 # one nuclide, checked against 50 runs between the grid points
+#
+# The sweep results are kept in <output>.jsonl, so an interrupted build resumes where it stopped.
+# The interpolation error is reported in two ways: leave-one-out (every interior grid point
+# predicted from its neighbours along each axis, i.e. over twice the grid spacing, so it
+# overestimates the error) and, with --validate, against real runs at random points off the grid.
+#
+# The SSIM depends on the input image; the surface is only exact for the image it was built with.
+# The GUI uses the surface built on this machine (in the per-user cache directory, see
+# cache.getCacheDir), or else one shipped with the program in its bundle directory.
+
+surfaceVersion = 1
+surfaceName = 'ssimSurface.npz'
+allowedDosages = [1, 2, 5, 10, 20]
+defaultRates = [1, 2, 5, 10, 20, 50, 100, 200, 300, 500, 700, 1000]
+# Grid axes after the nuclide axis, with the scale they are interpolated on
+axes = (("fluences", "linear"), ("dosages", "log"), ("rates", "log"), ("concentrations", "log"))
+
+def _bracket(nodes, value, scale):
+    # (lower index, upper index, weight of the upper node) of value on the increasing nodes,
+    # clamped to their range
+    nodes = np.asarray(nodes, dtype=np.float64)
+    if scale == "log":
+        nodes, value = np.log(nodes), np.log(value)
+    if value <= nodes[0]:
+        return 0, 0, 0.0
+    if value >= nodes[-1]:
+        return len(nodes) - 1, len(nodes) - 1, 0.0
+    upper = int(np.searchsorted(nodes, value))
+    lower = upper - 1
+    return lower, upper, float((value - nodes[lower]) / (nodes[upper] - nodes[lower]))
+
+class SSIMSurrogate:
+    def __init__(self, ssim, grid, ssimStd=None, meta=None):
+        # ssim: (nuclides, fluences, dosages, rates, concentrations); grid: dict with the node
+        # values of every axis ("nuclides" holds nuclide indices)
+        self.ssim = np.asarray(ssim, dtype=np.float64)
+        self.ssimStd = None if ssimStd is None else np.asarray(ssimStd, dtype=np.float64)
+        self.grid = {key: np.asarray(values) for key, values in grid.items()}
+        self.meta = dict(meta or {})
+        self._nuclideIndex = {int(W): i for i, W in enumerate(self.grid["nuclides"])}
+
+    def estimate(self, W, fluence, dosage, repetitionRate, C_sample=500):
+        # Interpolated SSIM, or None if the nuclide is not in the surface (or every surrounding run failed)
+        if W not in self._nuclideIndex:
+            return None
+        values = self.ssim[self._nuclideIndex[W]]
+        brackets = [_bracket(self.grid[name], value, scale) for (name, scale), value in zip(axes, (fluence, dosage, repetitionRate, C_sample))]
+        total = weightSum = 0.0
+        for corner in itertools.product((0, 1), repeat=len(brackets)):
+            weight = 1.0
+            index = []
+            for (lower, upper, upperWeight), useUpper in zip(brackets, corner):
+                weight *= upperWeight if useUpper else 1 - upperWeight
+                index.append(upper if useUpper else lower)
+            value = values[tuple(index)]
+            if weight == 0 or np.isnan(value):
+                continue
+            total += weight * value
+            weightSum += weight
+        if weightSum == 0:
+            return None
+        return total / weightSum
+
+    def save(self, path):
+        arrays = {key: values for key, values in self.grid.items()}
+        if self.ssimStd is not None:
+            arrays["ssimStd"] = self.ssimStd
+        with open(path, "wb") as f:
+            np.savez(f, ssim=self.ssim, meta=json.dumps(self.meta), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            grid = {key: data[key] for key in ["nuclides"] + [name for name, scale in axes]}
+            meta = json.loads(str(data["meta"]))
+            if meta.get("version") != surfaceVersion:
+                raise ValueError(f"{path} has surface version {meta.get('version')}, expected {surfaceVersion}")
+            return cls(data["ssim"], grid, data["ssimStd"] if "ssimStd" in data else None, meta)
+
+def loadSurrogate(path):
+    # The surrogate stored at path, or None if the surface has not been built
+    if not os.path.exists(path):
+        return None
+    return SSIMSurrogate.load(path)
+
+def defaultSurfacePath():
+    # Where surrogate.py writes the surface: the bundle directory of a frozen build is read-only
+    from cache import getCacheDir
+    return os.path.join(getCacheDir(), surfaceName)
+
+def findSurrogate(bundleDir):
+    # The surface built on this machine, else the one shipped in bundleDir, else None
+    for path in (defaultSurfacePath(), os.path.join(bundleDir, surfaceName)):
+        surrogate = loadSurrogate(path)
+        if surrogate is not None:
+            return surrogate
+    return None
+
+def assembleSurface(records, grid, meta=None):
+    # SSIMSurrogate from sweep records (dicts with W, fluence, dosage, repetitionRate, C_sample and ssim);
+    # grid points without a successful record are NaN
+    shape = [len(grid["nuclides"])] + [len(grid[name]) for name, scale in axes]
+    ssim = np.full(shape, np.nan)
+    ssimStd = np.full(shape, np.nan)
+    positions = [{float(value): i for i, value in enumerate(grid[key])} for key in ["nuclides"] + [name for name, scale in axes]]
+    for record in records:
+        if record.get("ssim") is None:
+            continue
+        try:
+            index = tuple(position[float(record[key])] for position, key in zip(positions, ("W", "fluence", "dosage", "repetitionRate", "C_sample")))
+        except KeyError:
+            continue
+        ssim[index] = record["ssim"]
+        if record.get("ssimStd") is not None:
+            ssimStd[index] = record["ssimStd"]
+    return SSIMSurrogate(ssim, grid, ssimStd, meta)
+
+def _errorStatistics(errors):
+    errors = np.asarray(errors, dtype=np.float64)
+    errors = errors[~np.isnan(errors)]
+    if errors.size == 0:
+        return {"count": 0}
+    return {"count": int(errors.size), "mae": float(np.mean(np.abs(errors))), "rms": float(np.sqrt(np.mean(errors**2))),
+            "max": float(np.max(np.abs(errors))), "bias": float(np.mean(errors))}
+
+def leaveOneOutErrors(surrogate):
+    # Per axis: every interior grid point predicted by interpolating between its two neighbours
+    # on that axis, against the value in the surface
+    errors = {}
+    for axis, (name, scale) in enumerate(axes, start=1):
+        nodes = np.asarray(surrogate.grid[name], dtype=np.float64)
+        if len(nodes) < 3:
+            continue
+        if scale == "log":
+            nodes = np.log(nodes)
+        differences = []
+        for i in range(1, len(nodes) - 1):
+            weight = (nodes[i] - nodes[i - 1]) / (nodes[i + 1] - nodes[i - 1])
+            predicted = (1 - weight) * np.take(surrogate.ssim, i - 1, axis=axis) + weight * np.take(surrogate.ssim, i + 1, axis=axis)
+            differences.append((predicted - np.take(surrogate.ssim, i, axis=axis)).ravel())
+        errors[name] = _errorStatistics(np.concatenate(differences))
+    return errors
+
+def validationPoints(surrogate, count, seed=0):
+    # Sweep jobs at random points between the grid nodes: fluence indices and rates are drawn over the
+    # range of the grid (rates and concentrations uniformly in their logarithm), nuclides and dosages
+    # from the grid. Returns fewer than count jobs if there are not that many distinct points.
+    rng = np.random.default_rng(seed)
+    grid = surrogate.grid
+    logUniform = lambda low, high: float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    numPoints = (len(grid["nuclides"]) * (grid["fluences"][-1] - grid["fluences"][0] + 1) * (grid["rates"][-1] - grid["rates"][0] + 1)
+                 * len(grid["dosages"]) * (round(grid["concentrations"][-1]) - round(grid["concentrations"][0]) + 1))
+    count = min(count, numPoints)
+    jobs = {}
+    draws = 0
+    # Repeated points are drawn again, up to a limit, since the log-uniform draws rarely hit some points
+    while len(jobs) < count and draws < 100 * count:
+        draws += 1
+        job = {"W": int(rng.choice(grid["nuclides"])),
+               "fluence": int(rng.integers(grid["fluences"][0], grid["fluences"][-1] + 1)),
+               "repetitionRate": int(round(logUniform(grid["rates"][0], grid["rates"][-1]))),
+               "dosage": int(rng.choice(grid["dosages"])),
+               "C_sample": round(logUniform(grid["concentrations"][0], grid["concentrations"][-1])),
+               "flickerNoise": surrogate.meta.get("flickerNoise", 5)}
+        jobs[tuple(job.values())] = job
+    if len(jobs) < count:
+        print(f"Only {len(jobs)} distinct validation points could be drawn")
+    return list(jobs.values())
+
+def validationErrors(surrogate, records):
+    # Surrogate estimate minus the simulated SSIM of every successful record
+    errors = []
+    for record in records:
+        if record.get("ssim") is None:
+            continue
+        estimate = surrogate.estimate(record["W"], record["fluence"], record["dosage"], record["repetitionRate"], record["C_sample"])
+        if estimate is not None:
+            errors.append(estimate - record["ssim"])
+    return _errorStatistics(errors)
+
+def loadRecords(path):
+    # Records of a sweep output file; a truncated last line is ignored
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+def formatErrors(errors):
+    lines = []
+    for name, statistics in errors.items():
+        if statistics["count"] == 0:
+            lines.append(f"{name}: no points")
+            continue
+        lines.append("{}: MAE {:.4f}, RMS {:.4f}, max {:.4f}, bias {:+.4f} ({} points)".format(
+            name, statistics["mae"], statistics["rms"], statistics["max"], statistics["bias"], statistics["count"]))
+    return "\n".join(lines)
+
+def main(argv=None):
+    from util import getBundleDir
+    from assets import loadCSV
+    from sweep import expandGrid, runSweep, prepareInput
+
+    parser = argparse.ArgumentParser(description="Build the SSIM surface of the instant SSIM estimate and report its interpolation error")
+    parser.add_argument("--output", help="surface file, ssimSurface.npz in the cache directory by default")
+    parser.add_argument("--nuclides", default="all", help="nuclide names or indices, comma separated, or 'all'")
+    parser.add_argument("--fluences", help="fluence indices, comma separated (every third and the last by default)")
+    parser.add_argument("--rates", default=",".join(str(rate) for rate in defaultRates), help="repetition rates in Hz, comma separated")
+    parser.add_argument("--dosages", default="all", help="dosages, comma separated, or 'all' (1, 2, 5, 10, 20)")
+    parser.add_argument("--concentrations", default="500", help="sample concentrations in ppm, comma separated")
+    parser.add_argument("--flicker-noise", dest="flickerNoise", type=float, default=5, help="flicker noise in %%")
+    parser.add_argument("--realizations", type=int, default=8, help="noise draws averaged per grid point")
+    parser.add_argument("--validate", type=int, default=0, help="number of extra runs at random points off the grid to measure the error")
+    parser.add_argument("--input", help="input image (.npy or .csv), Vermeer.csv by default")
+    parser.add_argument("--crater", help="crater profile (.csv), BPn.csv by default")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (all cores by default)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the noise of every run")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64", help="working precision")
+    parser.add_argument("--retry-failed", dest="retryFailed", action="store_true", help="run the grid points that failed in a previous build again")
+    args = parser.parse_args(argv)
+
+    bundle_dir = getBundleDir()
+    output = args.output or defaultSurfacePath()
+    nuclideNames = np.load(os.path.join(bundle_dir, 'nuclideNames.npy'), allow_pickle=True)
+    RRs = np.load(os.path.join(bundle_dir, 'RRs.npy'))
+    washoutPath = os.path.join(bundle_dir, 'washoutProfilesAll.npy')
+    numFluences = np.load(washoutPath, mmap_mode='r').shape[2]
+    craterProfile = loadCSV(args.crater or os.path.join(bundle_dir, 'BPn.csv'))
+    inputPath = prepareInput(args.input or os.path.join(bundle_dir, 'Vermeer.csv'))
+    fluences = args.fluences or ",".join(str(fluence) for fluence in sorted(set(range(0, numFluences, 3)) | {numFluences - 1}))
+
+    spec = {"nuclides": args.nuclides, "fluences": fluences, "rates": args.rates, "dosages": args.dosages,
+            "concentrations": args.concentrations, "flickerNoise": [args.flickerNoise]}
+    jobs = expandGrid(spec, nuclideNames, numFluences, RRs)
+    grid = {"nuclides": sorted({job["W"] for job in jobs}),
+            "fluences": sorted({job["fluence"] for job in jobs}),
+            "dosages": sorted({job["dosage"] for job in jobs}),
+            "rates": sorted({job["repetitionRate"] for job in jobs}),
+            "concentrations": sorted({job["C_sample"] for job in jobs})}
+    for dosage in grid["dosages"]:
+        if dosage not in allowedDosages:
+            parser.error(f"dosage {dosage} is not one of {allowedDosages}")
+
+    sweepPath = output + ".jsonl"
+    runSweep(jobs, sweepPath, inputPath, craterProfile, washoutPath, nuclideNames, args.processes, args.seed, args.dtype, args.realizations, args.retryFailed)
+    meta = {"version": surfaceVersion,
+            "inputShape": list(np.load(inputPath, mmap_mode='r').shape),
+            "flickerNoise": args.flickerNoise,
+            "realizations": args.realizations,
+            "seed": args.seed}
+    surrogate = assembleSurface(loadRecords(sweepPath), grid, meta)
+    failed = int(np.sum(np.isnan(surrogate.ssim)))
+    if failed:
+        print(f"{failed} of {surrogate.ssim.size} grid points failed; they are left out of the interpolation")
+
+    errors = {"leave-one-out " + name: statistics for name, statistics in leaveOneOutErrors(surrogate).items()}
+    if args.validate > 0:
+        validationPath = output + ".validation.jsonl"
+        runSweep(validationPoints(surrogate, args.validate, args.seed), validationPath, inputPath, craterProfile, washoutPath, nuclideNames,
+                 args.processes, args.seed + 1, args.dtype, args.realizations, args.retryFailed)
+        errors["off-grid runs"] = validationErrors(surrogate, loadRecords(validationPath))
+    surrogate.meta["errors"] = errors
+    surrogate.save(output)
+    print("Interpolation error (surrogate - simulation):")
+    print(formatErrors(errors))
+    print(f"Surface written to {output}")
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
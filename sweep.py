@@ -0,0 +1,224 @@
+import numpy as np
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import time
+import zlib
+
+from util import getBundleDir, simulateAblation, simulateEnsemble
+from convolution import estimateBeamCost, beamBackends, approximateBackends
+from assets import csvCachePath, loadCSV
+
+# Headless parameter sweeps over nuclide x fluence x repetition rate x dosage x concentration.
+# Every finished job is appended to a JSON lines file, so an interrupted sweep resumes where
+# it stopped when started again with the same output file (failed jobs are only run again with
+# --retry-failed). With --realizations N the SSIM of every job is the mean over N noise draws of
+# the same noise-free image (see simulateEnsemble).
+#
+#   python sweep.py --output sweep.jsonl --nuclides 23Na,27Al --fluences all --rates all --dosages 1,2,5,10,20
+#   python sweep.py --output sweep.jsonl --grid grid.json
+#
+# A grid file holds the same keys as the command line options, e.g.
+#   {"nuclides": ["23Na"], "fluences": [0, 15], "rates": "all", "dosages": [10], "concentrations": [500]}
+
+beamSize = 20 # um
+allowedDosages = [1, 2, 5, 10, 20]
+
+def _parseList(value, convert=str):
+    if isinstance(value, str):
+        if value == "all":
+            return "all"
+        return [convert(item) for item in value.split(",") if item]
+    if isinstance(value, (int, float)):
+        return [convert(value)]
+    return [convert(item) for item in value]
+
+def expandGrid(spec, nuclideNames, numFluences, RRs):
+    # Returns the list of jobs (dicts of simulateAblation keyword arguments). Nuclides given by name
+    # are converted to indices, and values listed twice on any axis give a single job.
+    nuclides = _parseList(spec.get("nuclides", "all"))
+    if nuclides == "all":
+        nuclideIndices = list(range(len(nuclideNames)))
+    else:
+        names = list(nuclideNames)
+        nuclideIndices = [int(n) if n.isdigit() else names.index(n) for n in nuclides]
+
+    fluences = _parseList(spec.get("fluences", "all"), int)
+    fluences = list(range(numFluences)) if fluences == "all" else fluences
+
+    rates = _parseList(spec.get("rates", "all"), int)
+    rates = [int(rate) for rate in RRs] if rates == "all" else rates
+
+    dosages = _parseList(spec.get("dosages", allowedDosages), int)
+    dosages = allowedDosages if dosages == "all" else dosages
+
+    concentrations = _parseList(spec.get("concentrations", [500]), float)
+    flickerNoise = _parseList(spec.get("flickerNoise", [5]), float)
+
+    axes = [list(dict.fromkeys(values)) for values in (nuclideIndices, fluences, rates, dosages, concentrations, flickerNoise)]
+    jobs = []
+    for W, fluence, rate, dosage, C_sample, flicker in itertools.product(*axes):
+        jobs.append({"W": W, "fluence": fluence, "repetitionRate": rate, "dosage": dosage, "C_sample": C_sample, "flickerNoise": flicker})
+    return jobs
+
+def jobKey(job):
+    return "{W}-{fluence}-{repetitionRate}-{dosage}-{C_sample:g}-{flickerNoise:g}".format(**job)
+
+def estimateJobCost(job, imageShape, craterProfile, profileLength, realizations=1):
+    # Rough run time in seconds, used to schedule long jobs first and for the ETA. The smear
+    # grows with the response curve length, which grows linearly with the repetition rate.
+    # Extra noise realizations only repeat the noise and the SSIM, which are cheap next to the smear.
+    dosage, rate = job["dosage"], job["repetitionRate"]
+    k, m = int(beamSize / dosage), int(beamSize)
+    beam = min(estimateBeamCost(method, imageShape, craterProfile, m, k, m - 1, k - 1) for method in beamBackends if method not in approximateBackends)
+    numSamples = round(100 * 1000 / rate)
+    curveLength = math.ceil(profileLength * 300 / numSamples)
+    shots = (imageShape[0] // m) * ((imageShape[1] + craterProfile.shape[1] - 1) // k)
+    smear = 2.5e-9 * shots * curveLength
+    return beam + smear + 0.03 * realizations
+
+_worker = {}
+
+def _initWorker(inputPath, craterProfile, washoutPath, nuclideNames, seed, dtype, realizations=1):
+    # Each worker memory-maps the input image, so the map is shared through the page cache
+    _worker["inputImage"] = np.load(inputPath, mmap_mode='r')
+    _worker["washoutProfilesAll"] = np.load(washoutPath)
+    _worker["craterProfile"] = craterProfile
+    _worker["nuclideNames"] = nuclideNames
+    _worker["seed"] = seed
+    _worker["dtype"] = dtype
+    _worker["realizations"] = realizations
+
+def _runJob(job):
+    # Reproducible noise: the seed depends on the sweep seed and the job parameters only
+    np.random.seed(zlib.crc32(f"{_worker['seed']}-{jobKey(job)}".encode()))
+    start = time.perf_counter()
+    ssimStd = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        if _worker["realizations"] > 1:
+            referenceImage, simulatedImage, statistics, nuclide, mapTime = simulateEnsemble(
+                _worker["inputImage"], _worker["craterProfile"], _worker["washoutProfilesAll"], _worker["nuclideNames"],
+                useRR=True, dtype=_worker["dtype"], numRealizations=_worker["realizations"], **job)
+            max_ssim = None if statistics is None else statistics["mean"]
+            ssimStd = None if statistics is None else statistics["std"]
+        else:
+            referenceImage, simulatedImage, max_ssim, nuclide, mapTime = simulateAblation(
+                _worker["inputImage"], _worker["craterProfile"], _worker["washoutProfilesAll"], _worker["nuclideNames"],
+                useRR=True, dtype=_worker["dtype"], **job)
+    record = dict(job)
+    record.update({
+        "key": jobKey(job),
+        "nuclide": None if nuclide is None else str(nuclide),
+        "scanningSpeed": round(job["repetitionRate"] * beamSize / job["dosage"]),
+        "ssim": None if max_ssim is None else float(max_ssim),
+        "ssimStd": ssimStd,
+        "mapTime": mapTime,
+        "seconds": time.perf_counter() - start,
+    })
+    return record
+
+def loadCheckpoint(outputPath, retryFailed=False):
+    # Finished job keys of a previous (possibly interrupted) run; a truncated last line is ignored.
+    # With retryFailed, jobs whose only records failed (SSIM None) are not counted as finished.
+    done, failed = set(), set()
+    if not os.path.exists(outputPath):
+        return done
+    with open(outputPath) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                key = record["key"]
+            except (ValueError, KeyError):
+                continue
+            if record.get("ssim") is None:
+                failed.add(key)
+            else:
+                done.add(key)
+    failed -= done
+    if failed and not retryFailed:
+        print(f"{len(failed)} failed jobs are not run again (use --retry-failed)")
+        done |= failed
+    return done
+
+def _formatSeconds(seconds):
+    seconds = int(round(seconds))
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def runSweep(jobs, outputPath, inputPath, craterProfile, washoutPath, nuclideNames, processes=None, seed=0, dtype=None, realizations=1, retryFailed=False):
+    done = loadCheckpoint(outputPath, retryFailed)
+    remaining = [job for job in jobs if jobKey(job) not in done]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(remaining)} already done, {len(remaining)} to run")
+    if not remaining:
+        return
+
+    imageShape = np.load(inputPath, mmap_mode='r').shape
+    profileLength = np.load(washoutPath, mmap_mode='r').shape[0]
+    costs = {jobKey(job): estimateJobCost(job, imageShape, craterProfile, profileLength, realizations) for job in remaining}
+    # Longest jobs first, so the pool does not end with one long job running alone
+    remaining.sort(key=lambda job: costs[jobKey(job)], reverse=True)
+    totalCost = sum(costs.values())
+
+    start = time.perf_counter()
+    doneCost = 0.0
+    with multiprocessing.Pool(processes, initializer=_initWorker, initargs=(inputPath, craterProfile, washoutPath, nuclideNames, seed, dtype, realizations)) as pool, open(outputPath, 'a') as output:
+        for count, record in enumerate(pool.imap_unordered(_runJob, remaining), start=1):
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            doneCost += costs[record["key"]]
+            elapsed = time.perf_counter() - start
+            eta = elapsed * (totalCost - doneCost) / doneCost
+            ssim = "failed" if record["ssim"] is None else "{:.3f}".format(record["ssim"])
+            print(f"[{count}/{len(remaining)}] {record['nuclide']} F{record['fluence']} {record['repetitionRate']} Hz D{record['dosage']} SSIM {ssim} | elapsed {_formatSeconds(elapsed)} ETA {_formatSeconds(eta)}", flush=True)
+
+def prepareInput(inputPath):
+    # Workers memory-map a .npy file; CSV images are read from their binary cache
+    if inputPath.endswith('.npy'):
+        return inputPath
+    return csvCachePath(inputPath)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parameter sweep of the ablation simulation (SSIM and mapping time)")
+    parser.add_argument("--output", required=True, help="JSON lines file with one result per job; an existing file is resumed")
+    parser.add_argument("--grid", help="JSON file with the grid (nuclides, fluences, rates, dosages, concentrations, flickerNoise)")
+    parser.add_argument("--nuclides", help="nuclide names or indices, comma separated, or 'all'")
+    parser.add_argument("--fluences", help="fluence indices, comma separated, or 'all'")
+    parser.add_argument("--rates", help="repetition rates in Hz, comma separated, or 'all' (RRs.npy)")
+    parser.add_argument("--dosages", help="dosages, comma separated, or 'all' (1, 2, 5, 10, 20)")
+    parser.add_argument("--concentrations", help="sample concentrations in ppm, comma separated")
+    parser.add_argument("--flicker-noise", dest="flickerNoise", help="flicker noise in %%, comma separated")
+    parser.add_argument("--input", help="input image (.npy or .csv), Vermeer.csv by default")
+    parser.add_argument("--crater", help="crater profile (.csv), BPn.csv by default")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (all cores by default)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the noise of every job")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64", help="working precision; float32 halves the memory per worker")
+    parser.add_argument("--realizations", type=int, default=1, help="noise draws per job; the SSIM is their mean")
+    parser.add_argument("--retry-failed", dest="retryFailed", action="store_true", help="run the jobs that failed in a previous run again")
+    args = parser.parse_args(argv)
+
+    bundle_dir = getBundleDir()
+    spec = {}
+    if args.grid:
+        with open(args.grid) as f:
+            spec.update(json.load(f))
+    for key in ("nuclides", "fluences", "rates", "dosages", "concentrations", "flickerNoise"):
+        if getattr(args, key) is not None:
+            spec[key] = getattr(args, key)
+
+    nuclideNames = np.load(os.path.join(bundle_dir, 'nuclideNames.npy'), allow_pickle=True)
+    RRs = np.load(os.path.join(bundle_dir, 'RRs.npy'))
+    washoutPath = os.path.join(bundle_dir, 'washoutProfilesAll.npy')
+    numFluences = np.load(washoutPath, mmap_mode='r').shape[2]
+    craterProfile = loadCSV(args.crater or os.path.join(bundle_dir, 'BPn.csv'))
+    inputPath = prepareInput(args.input or os.path.join(bundle_dir, 'Vermeer.csv'))
+
+    jobs = expandGrid(spec, nuclideNames, numFluences, RRs)
+    runSweep(jobs, args.output, inputPath, craterProfile, washoutPath, nuclideNames, args.processes, args.seed, args.dtype, args.realizations, args.retryFailed)
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
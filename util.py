@@ -2,69 +2,68 @@ import numpy as np
 import sys
 import os
 
-from PIL import Image
-import noise
 import random
-import scipy.signal as signal
-from skimage.measure import block_reduce
-from skimage.metrics import structural_similarity as ssim
-import time
+import logging
 
-def load_data():
-    #global nuclideNames, reshaped_array, RRs, numericArray, mappingVector, mappingVectorRR, washoutProfilesAll
+from cache import LRUCache, arrayFingerprint
+from assets import DataBundle, npyLoader, csvLoader
+from profiling import profileStage
 
-    bundle_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
-    
-    # Load .npy files
-    RRs = np.load(os.path.join(bundle_dir, 'RRs.npy'))
-    nuclideNames = np.load(os.path.join(bundle_dir, 'nuclideNames.npy'), allow_pickle=True)
-    fluenceLabels = np.load(os.path.join(bundle_dir, 'fluenceLabels.npy'), allow_pickle=True)
-    numericArray = np.load(os.path.join(bundle_dir, 'numericArray.npy'))
-
-    washoutProfilesAll = np.load(os.path.join(bundle_dir, 'washoutProfilesAll.npy'))
-    reshaped_array = np.load(os.path.join(bundle_dir, 'reshaped_array.npy'))
-
-    inputImage = np.genfromtxt(os.path.join(bundle_dir, 'Vermeer.csv'), delimiter=',')
-    craterProfile = np.genfromtxt(os.path.join(bundle_dir, 'BPn.csv'), delimiter=',')
-
-    # Mapping vectors
-    mappingVector = list(range(len(numericArray)))
-    mappingVectorRR = list(range(len(RRs)))
-
-    return {
-        "RRs": RRs,
-        "nuclideNames": nuclideNames,
-        "fluenceLabels": fluenceLabels,
-        "numericArray": numericArray,
-        "washoutProfilesAll": washoutProfilesAll,
-        "reshaped_array": reshaped_array,
-        "mappingVector": mappingVector,
-        "mappingVectorRR": mappingVectorRR,
-        "inputImage": inputImage,
-        "craterProfile": craterProfile
-        }
-
-def generateImage():
-    # Generate 2D perlin noise
-    size = 256
-    scale = 100.0
-    octaves = 6
-    persistence = 0.5
-    lacunarity = 2.0
-    seed = random.randint(0, 100)
-    world = np.zeros((size, size))
-    for i in range(size):
-        for j in range(size):
-            world[i][j] = noise.pnoise2(i/scale, 
-                                        j/scale,
-                                        octaves=octaves, 
-                                        persistence=persistence, 
-                                        lacunarity=lacunarity, 
-                                        repeatx=size, 
-                                        repeaty=size, 
-                                        base=seed)
-    # Normalize the noise
-    world = (world + 1) / 2
+# Diagnostics of the simulation stages (convolution backend, shift, preview geometry); not shown unless
+# logging is configured, e.g. logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# scipy (through convolution, responsebank and alignment), skimage and PIL are imported in the
+# functions that use them: the GUI process imports this module for load_data but never runs a
+# simulation, and scipy.signal alone takes about a second to import.
+
+def getBundleDir():
+    # Directory holding the data files (the bundle directory in a frozen build)
+    return getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
+
+def load_data():
+    # Returns a DataBundle: every asset is loaded on first access, the numeric .npy files and the
+    # (cached) CSV image are memory-mapped read-only. bundle.report() lists what was used.
+    bundle_dir = getBundleDir()
+    path = lambda name: os.path.join(bundle_dir, name)
+
+    data = DataBundle({
+        "RRs": npyLoader(path('RRs.npy'), mmapMode=None),
+        "nuclideNames": npyLoader(path('nuclideNames.npy'), allowPickle=True),
+        "fluenceLabels": npyLoader(path('fluenceLabels.npy'), allowPickle=True),
+        "numericArray": npyLoader(path('numericArray.npy'), mmapMode=None),
+        "washoutProfilesAll": npyLoader(path('washoutProfilesAll.npy')),
+        # Mapping vectors
+        "mappingVector": lambda: list(range(len(data["numericArray"]))),
+        "mappingVectorRR": lambda: list(range(len(data["RRs"]))),
+        "inputImage": csvLoader(path('Vermeer.csv')),
+        "craterProfile": csvLoader(path('BPn.csv'), mmapMode=None),
+        # Make sure the precomputed response curves exist (built once per user)
+        "responseBank": lambda: _buildResponseBank(data),
+        # Interpolated SSIM surface for instant estimates (see surrogate.py), None until it is built
+        "ssimSurrogate": lambda: _loadSurrogate(bundle_dir),
+        })
+    return data
+
+def _buildResponseBank(data):
+    from responsebank import getResponseBank
+    return getResponseBank(data["washoutProfilesAll"], RRs=data["RRs"])
+
+def _loadSurrogate(bundle_dir):
+    from surrogate import findSurrogate
+    try:
+        return findSurrogate(bundle_dir)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"SSIM surface not used: {e}")
+        return None
+
+def generateImage(size=256, seed=None):
+    # Generate 2D perlin noise (scale 100, 6 octaves, persistence 0.5, lacunarity 2)
+    from PIL import Image
+    from phantom import generatePhantom
+    if seed is None:
+        seed = random.randint(0, 100)
+    world = generatePhantom((size, size), seed=seed)
     world = (world * 255).astype(np.uint8)
     # Apply a colormap
     img = Image.fromarray(world, 'L')
@@ -93,7 +92,260 @@ def generateBeamProfile(n=10, beam=20):
     BPn[BPn < 0] = 0
     return BPn
 
-def simulateAblation(inputImage, craterProfile, washoutProfilesAll, nuclideNames, repetitionRate, W=0, C_sample = 500, fluence = 0, dosage = 10, scanningSpeed = 2000, flickerNoise = 5, useRR=False):
+# Memoized intermediate results of simulateAblation, shared by all runs in this process
+stageCache = LRUCache(maxBytes=256 * 1024**2)
+
+def cachedStage(cache, key, compute):
+    if cache is None:
+        return compute()
+    return cache.getOrCompute(key, compute)
+
+# Cache keys of the stages, shared with the streaming simulation, which stores the stages it
+# computes line by line under the same keys
+def beamCacheKey(imageKey, craterProfile, m, k, convolutionMethod, separableTolerance, dtypeKey):
+    return ("beam", imageKey, arrayFingerprint(craterProfile), m, k, convolutionMethod, separableTolerance, dtypeKey)
+
+def referenceCacheKey(imageKey, m, dtypeKey):
+    return ("reference", imageKey, m, dtypeKey)
+
+def responseCacheKey(washoutProfilesAll, W, fluence, repetitionRate):
+    return ("response", arrayFingerprint(washoutProfilesAll), W, fluence, repetitionRate)
+
+def smearCacheKey(beamKey, responseKey, shotsPerPixel):
+    return ("smear", beamKey, responseKey, shotsPerPixel)
+
+def normalizeStage(inputImage, dtype=np.float64):
+    # A single copy in the working precision (float32 inputs are not first expanded to float64)
+    normalizedInputImage = np.array(inputImage, dtype=dtype)
+    normalizedInputImage /= np.max(normalizedInputImage)
+    return normalizedInputImage
+
+def beamStage(normalizedInputImage, craterProfile, m, k, convolutionMethod="auto", separableTolerance=None):
+    # The beam stage is equivalent to signal.convolve2d(normalizedInputImage, craterProfile, mode='full')[m-1::m, k-1::k],
+    # computed by the backend (direct, FFT, overlap-add, decimated) the cost model predicts to be fastest
+    from convolution import beamConvolve
+    # The kernel is cast to the precision of the image, so the backends keep that precision
+    craterProfile = np.asarray(craterProfile, dtype=normalizedInputImage.dtype)
+    convolvedSampled, convolvedMax, convolutionInfo = beamConvolve(normalizedInputImage, craterProfile, m, k, m-1, k-1, method=convolutionMethod, separableTolerance=separableTolerance)
+    logger.info("Convolution method: %s", convolutionInfo["method"])
+    if "rank" in convolutionInfo:
+        logger.info("Crater profile rank: %d (relative error %.2e)", convolutionInfo["rank"], convolutionInfo["error"])
+    # Normalize with the maximum of the full convolution
+    return convolvedSampled / convolvedMax
+
+def responseStage(washoutProfilesAll, W, fluence, repetitionRate, dwellTime):
+    # Look the response curve up in the precomputed bank, resample it for repetition rates outside the table
+    from responsebank import getResponseBank, resampleResponse
+    responseBank = getResponseBank(washoutProfilesAll, dwellTime)
+    if responseBank is not None:
+        responseCurve = responseBank.lookup(W, fluence, repetitionRate)
+        if responseCurve is not None:
+            return np.array(responseCurve)
+    return resampleResponse(washoutProfilesAll[:,W,fluence], repetitionRate, dwellTime)
+
+def smearStage(normalizedConvolvedNoNoise, responseCurve, dosage):
+    import scipy.signal as signal
+    from skimage.measure import block_reduce
+    # Convert to 2-D by adding a new axis
+    responseCurve2D = responseCurve[np.newaxis,:].astype(normalizedConvolvedNoNoise.dtype, copy=False)
+    # Smear the image
+    smearedImageRaw = signal.convolve2d(normalizedConvolvedNoNoise, responseCurve2D, mode='full') # Equivalent to MATLAB's conv2
+    # Average every dosage shots into a single pixel (the concentration scaling is applied by the caller)
+    blockSize = (1, dosage)
+    return block_reduce(smearedImageRaw, blockSize, np.mean) # Equivalent to MATLAB's blockproc
+
+def responseStackStage(washoutProfilesAll, nuclides, fluence, repetitionRate, dwellTime):
+    # Response curves of several nuclides as one (count, length) array: all curves of one
+    # repetition rate have the same length, so they are stacked rows of the bank or resampled in one call
+    from responsebank import getResponseBank, resampleResponse
+    responseBank = getResponseBank(washoutProfilesAll, dwellTime)
+    if responseBank is not None:
+        curves = [responseBank.lookup(W, fluence, repetitionRate) for W in nuclides]
+        if all(curve is not None for curve in curves):
+            return np.array(curves)
+    return resampleResponse(washoutProfilesAll[:, nuclides, fluence], repetitionRate, dwellTime, axis=0).T
+
+def smearStackStage(normalizedConvolvedNoNoise, responseCurves, dosage, channelBatch=8):
+    # smearStage for every response curve (count, length), as batched FFT convolutions of
+    # channelBatch curves at a time. Returns (count, rows, averaged columns).
+    from convolution import convolveRows
+    from skimage.measure import block_reduce
+    channels = []
+    for start in range(0, len(responseCurves), channelBatch):
+        smearedImageRaw = convolveRows(normalizedConvolvedNoNoise, responseCurves[start:start + channelBatch])
+        channels.append(block_reduce(smearedImageRaw, (1, 1, dosage), np.mean))
+    return np.concatenate(channels)
+
+def noiseEnsembleStage(smearedImage, flickerNoise, count):
+    # count independent draws of noiseStage(smearedImage, flickerNoise), as one (count, rows, cols) array
+    realizations = np.random.poisson(np.broadcast_to(smearedImage, (count,) + smearedImage.shape)).astype(smearedImage.dtype)
+    flicker = np.multiply(realizations, flickerNoise)
+    flicker /= 100
+    flicker *= np.random.randn(*realizations.shape)
+    realizations += flicker
+    return realizations
+
+def noiseStage(smearedImage, flickerNoise, chunkRows=16):
+    # Poisson and flicker noise, written over smearedImage:
+    #   poisson(smearedImage) + randn * (poisson(smearedImage) * flickerNoise / 100)
+    # The draws are made in chunks of rows into the image itself, so the only temporaries are
+    # chunk-sized. All Poisson draws come before all normal draws, so the random stream (and the
+    # result, for float64) is the same as drawing both full arrays at once.
+    rows = smearedImage.shape[0]
+    for start in range(0, rows, chunkRows):
+        chunk = smearedImage[start:start + chunkRows]
+        chunk[...] = np.random.poisson(chunk)
+    for start in range(0, rows, chunkRows):
+        chunk = smearedImage[start:start + chunkRows]
+        flicker = np.multiply(chunk, flickerNoise)
+        flicker /= 100
+        flicker *= np.random.randn(*chunk.shape)
+        chunk += flicker
+    return smearedImage
+
+def referenceStage(normalizedInputImage, beamSize):
+    from skimage.measure import block_reduce
+    referenceImage = block_reduce(normalizedInputImage, (beamSize, beamSize), np.mean)
+    return referenceImage / np.max(referenceImage)
+
+def downsampleStage(image, factor):
+    from skimage.measure import block_reduce
+    return block_reduce(np.asarray(image), (factor, factor), np.mean)
+
+def previewGeometry(beamSize, dosage, repetitionRate, previewFactor):
+    # Sampling of a preview run on an image downsampled by at most previewFactor (a divisor of
+    # beamSize). The largest factor that keeps the shots on the downsampled pixel grid is used;
+    # if only 1 does (high dosages), previewFactor is used with the shots one pixel apart. Fewer
+    # shots at the same scanning speed means a lower shot rate for the response curve and
+    # proportionally more signal per shot (smearScale).
+    # Returns (factor, m, k, shotsPerPixel, shotRate, smearScale).
+    if beamSize % previewFactor:
+        raise ValueError(f"The preview factor must divide the beam size ({beamSize})")
+    step = beamSize // dosage
+    factor = max(f for f in range(1, previewFactor + 1) if beamSize % f == 0 and step % f == 0)
+    if factor == 1:
+        factor = previewFactor
+    m = beamSize // factor
+    k = max(d for d in range(1, m + 1) if m % d == 0 and d <= max(1, step / factor))
+    shotRate = max(1, round(repetitionRate * step / (k * factor)))
+    return factor, m, k, m // k, shotRate, repetitionRate / shotRate
+
+def previewDeviation(previewImage, fullImage):
+    # Root-mean-square difference of two normalized images over their common area
+    rows = min(previewImage.shape[0], fullImage.shape[0])
+    columns = min(previewImage.shape[1], fullImage.shape[1])
+    difference = previewImage[:rows, :columns] - fullImage[:rows, :columns]
+    return float(np.sqrt(np.mean(difference ** 2)))
+
+def mappingTime(imageShape, dosage, repetitionRate, beamSize=20):
+    # Seconds to map the image: one line per beamSize rows, each line as long as the image is wide
+    # (1 pixel = 1 um) at a scanning speed of repetitionRate * beamSize / dosage um/s
+    numLines = -(-imageShape[0] // beamSize)
+    return round(numLines * imageShape[1] * dosage / (beamSize * repetitionRate))
+
+def estimateSimulationMemory(imageShape, kernelShape, dtype=np.float64):
+    # Rough peak of the image stages in bytes: the normalized copy of the input and the padded
+    # copy the beam convolution works on
+    itemsize = np.dtype(dtype).itemsize
+    padded = (imageShape[0] + kernelShape[0] - 1) * (imageShape[1] + kernelShape[1] - 1)
+    return itemsize * (imageShape[0] * imageShape[1] + padded)
+
+def resolveDtype(dtype, memoryBudget, imageShape, kernelShape):
+    if dtype is not None:
+        return np.dtype(dtype)
+    if memoryBudget is not None and estimateSimulationMemory(imageShape, kernelShape, np.float64) > memoryBudget:
+        if estimateSimulationMemory(imageShape, kernelShape, np.float32) > memoryBudget:
+            print("Warning: the simulation is expected to exceed the memory budget even in float32")
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+def sampledStages(inputImage, craterProfile, repetitionRate, dosage=10, convolutionMethod="auto", separableTolerance=None, useCache=True, dtype=None, memoryBudget=None, profile=None, previewFactor=None):
+    # The stages that do not depend on the nuclide: the normalized reference image and the
+    # beam-convolved image sampled at the shot positions. Returns (referenceImage, sampledImage,
+    # beamKey, (shotsPerPixel, shotRate, smearScale)), the last being the sampling of the smear.
+    # Stages are memoized on the inputs they depend on.
+    beamSize = 20 # um
+    cache = stageCache if useCache else None
+    imageKey = arrayFingerprint(inputImage)
+    dtype = resolveDtype(dtype, memoryBudget, inputImage.shape, craterProfile.shape)
+    dtypeKey = np.dtype(dtype).str
+    stage = lambda name: profileStage(profile, name)
+
+    # Horizontal and vertical step size
+    k = int(beamSize / dosage)
+    m = int(beamSize)
+    shotsPerPixel, shotRate, smearScale = dosage, repetitionRate, 1
+
+    if previewFactor:
+        factor, m, k, shotsPerPixel, shotRate, smearScale = previewGeometry(beamSize, dosage, repetitionRate, previewFactor)
+        logger.info("Preview: factor %d, %d shots per pixel at %s Hz", factor, shotsPerPixel, shotRate)
+        fullImage = inputImage
+        with stage("downsample") as record:
+            inputImage = cachedStage(cache, ("downsample", imageKey, factor), lambda: downsampleStage(fullImage, factor))
+            record.note(image=inputImage)
+        craterProfile = downsampleStage(craterProfile, factor)
+        imageKey = ("downsample", imageKey, factor)
+
+    # Normalize image (only needed when the beam or reference stage is not cached, and at most once per run)
+    normalized = []
+    def getNormalizedInputImage():
+        if not normalized:
+            with stage("normalize"):
+                normalized.append(cachedStage(cache, ("normalize", imageKey, dtypeKey), lambda: normalizeStage(inputImage, dtype)))
+        return normalized[0]
+
+    # Double convolution (sampling blur and smear)
+    beamKey = beamCacheKey(imageKey, craterProfile, m, k, convolutionMethod, separableTolerance, dtypeKey)
+    with stage("beam") as record:
+        normalizedConvolvedNoNoise = cachedStage(cache, beamKey, lambda: beamStage(getNormalizedInputImage(), craterProfile, m, k, convolutionMethod, separableTolerance))
+        record.note(input=inputImage, kernel=craterProfile, sampled=normalizedConvolvedNoNoise)
+
+    # Create a normalized reference image for SSIM calculation
+    with stage("reference") as record:
+        referenceImage = cachedStage(cache, referenceCacheKey(imageKey, m, dtypeKey), lambda: referenceStage(getNormalizedInputImage(), m))
+        record.note(image=referenceImage)
+
+    return referenceImage, normalizedConvolvedNoNoise, beamKey, (shotsPerPixel, shotRate, smearScale)
+
+def noiselessStages(inputImage, craterProfile, washoutProfilesAll, repetitionRate, W=0, C_sample=500, fluence=0, dosage=10, convolutionMethod="auto", separableTolerance=None, useCache=True, dtype=None, memoryBudget=None, profile=None, previewFactor=None):
+    # Normalized reference image and noise-free counts (smeared, averaged over dosage shots and
+    # scaled to the concentration) of a simulation; the counts are a new array the caller may modify.
+    # Stages are memoized on the inputs they depend on, so e.g. a concentration or noise
+    # change reuses the beam-convolved and smeared image of the previous run.
+    dwellTime = 3 # ms
+    C_washout = 100 # ppm
+    cache = stageCache if useCache else None
+    stage = lambda name: profileStage(profile, name)
+    referenceImage, normalizedConvolvedNoNoise, beamKey, (shotsPerPixel, shotRate, smearScale) = sampledStages(
+        inputImage, craterProfile, repetitionRate, dosage, convolutionMethod, separableTolerance, useCache, dtype, memoryBudget, profile, previewFactor)
+
+    # Obtain washout profile based on selected nuclide and fluence and resample it
+    responseKey = responseCacheKey(washoutProfilesAll, W, fluence, shotRate)
+    with stage("response") as record:
+        responseCurve = cachedStage(cache, responseKey, lambda: responseStage(washoutProfilesAll, W, fluence, shotRate, dwellTime))
+        record.note(curve=responseCurve)
+
+    # Smear the image and average every dosage shots into a single pixel
+    smearKey = smearCacheKey(beamKey, responseKey, shotsPerPixel)
+    with stage("smear") as record:
+        smearedImageAveraged = cachedStage(cache, smearKey, lambda: smearStage(normalizedConvolvedNoNoise, responseCurve, shotsPerPixel))
+        smearedImage = (C_sample / C_washout) * dosage * smearScale * smearedImageAveraged
+
+        # Set negative values and NaNs to zero
+        smearedImage[smearedImage < 0] = 0
+        smearedImage[np.isnan(smearedImage)] = 0
+        record.note(image=smearedImage)
+
+    return referenceImage, smearedImage
+
+def simulateAblation(inputImage, craterProfile, washoutProfilesAll, nuclideNames, repetitionRate, W=0, C_sample = 500, fluence = 0, dosage = 10, scanningSpeed = 2000, flickerNoise = 5, useRR=False, convolutionMethod="auto", separableTolerance=None, useCache=True, alignmentMode="search", dtype=None, memoryBudget=None, profile=None, previewFactor=None):
+    # dtype: working precision of the image stages (np.float64 by default, np.float32 halves the memory).
+    # memoryBudget: bytes; with dtype=None, float32 is used when the float64 pipeline would exceed it.
+    # profile: a profiling.Profile that receives the wall and CPU time, peak memory and array shapes
+    # of every stage, and the traceback if the simulation fails.
+    # previewFactor: runs a quick approximation on the input image and crater profile downsampled
+    # by this factor (a divisor of the beam size, e.g. 4), see previewGeometry and previewDeviation.
+    from alignment import alignToReference
     try:
         #bundle_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
 
@@ -139,192 +391,177 @@ def simulateAblation(inputImage, craterProfile, washoutProfilesAll, nuclideNames
         print("Scanning Speed:", scanningSpeed)
         print("Dosage:", dosage)
 
-        # Obtain washout profile based on selected nuclide and fluence
-        washoutProfile = washoutProfilesAll[:,W,fluence]
-        responseCurve0 = (dwellTime / 1000) * washoutProfile
-
-        # Normalize image
-        normalizedInputImage = inputImage / np.max(inputImage)
-
-        # Horizontal and vertical step size
-        k = int(beamSize / dosage)
-        m = int(beamSize)
-
-        # Double convolution (sampling blur and smear)
-        convolved = signal.convolve2d(normalizedInputImage, craterProfile, mode='full') # Equivalent to MATLAB's conv2
-        # Normalize convolved image
-        normalizedConvolved = convolved / np.max(convolved)
-        # Subsample convolved image
-        normalizedConvolvedNoNoise = normalizedConvolved[m-1::m, k-1::k]
-
-        # Resample response curve
-        numSamples = round(100 * 1000 / repetitionRate) # Number of samples in the response curve
-        responseCurve = (1000 / repetitionRate) * (1 / dwellTime) * signal.resample_poly(responseCurve0, 300, numSamples) # resample_poly is analogous to resample in MATLAB
+        imageShape = inputImage.shape
+        stage = lambda name: profileStage(profile, name)
+        referenceImage, smearedImage = noiselessStages(inputImage, craterProfile, washoutProfilesAll, repetitionRate, W, C_sample, fluence, dosage, convolutionMethod, separableTolerance, useCache, dtype, memoryBudget, profile, previewFactor)
 
-        # Convert to 2-D by adding a new axis
-        responseCurve2D = responseCurve[np.newaxis,:] 
-
-        # Smear the image
-        smearedImageRaw = signal.convolve2d(normalizedConvolvedNoNoise, responseCurve2D, mode='full') # Equivalent to MATLAB's conv2
-
-        # Average every dosage shots into a single pixel
-        blockSize = (1, dosage)
-        smearedImage = (C_sample / C_washout) * dosage * block_reduce(smearedImageRaw, blockSize, np.mean) # Equivalent to MATLAB's blockproc
-
-        # Set negative values and NaNs to zero
-        smearedImage[smearedImage < 0] = 0
-        smearedImage[np.isnan(smearedImage)] = 0
-
-        # Simulate applying Poisson noise to an image
-        smearedImagePNoise = np.random.poisson(smearedImage)
-
-        #smearedImagePNoise = np.random.poisson(smearedImage / 1e12) * 1e12
-        # Apply additional noise, which is a combination of Poisson noise and Gaussian noise
-        SmearedImagePFNoise = smearedImagePNoise + np.random.randn(*smearedImagePNoise.shape) * (smearedImagePNoise * flickerNoise / 100)
-        # Normalize the final noisy image
-        SmearedImagePFNoiseNorm = SmearedImagePFNoise / np.max(SmearedImagePFNoise)
-
-        # Create a normalized reference image for SSIM calculation
-        referenceImage = block_reduce(normalizedInputImage, (beamSize, beamSize), np.mean)
-        referenceImage = referenceImage / np.max(referenceImage)
+        with stage("noise"):
+            # Apply Poisson noise and flicker noise (Gaussian, proportional to the signal) in place
+            SmearedImagePFNoiseNorm = noiseStage(smearedImage, flickerNoise)
+            # Normalize the final noisy image
+            SmearedImagePFNoiseNorm /= np.max(SmearedImagePFNoiseNorm)
 
         # Image shifting
-        add = np.zeros((SmearedImagePFNoiseNorm.shape[0], 200))
-        SmearedImagePFNoiseNorm = np.hstack([SmearedImagePFNoiseNorm, add])
-        shift = []
-        # 21 is the size of the convolution kernel (beamSize)
-        for peakShift in range(20):
-            # Shift the smeared image and normalize it
-            SmearedImagePFNoiseNormTmp = SmearedImagePFNoiseNorm[:150, peakShift:150+peakShift]
-            SmearedImagePFNoiseNormTmp = SmearedImagePFNoiseNormTmp / np.max(SmearedImagePFNoiseNormTmp)
-            # Calculate SSIM and store it
-            ssimval = ssim(SmearedImagePFNoiseNormTmp, referenceImage,data_range=1.0)
-            shift.append((peakShift, ssimval))
-
-        # Determine the shift that maximizes the SSIM
-        shift = np.array(shift)
-        I = np.argmax(shift[:, 1])
-
-        # Obtain the maximum SSIM
-        max_ssim = np.max(shift[:, 1])
-
-        # Shift the smeared image
-        SmearedImagePFNoiseNormFinal = SmearedImagePFNoiseNorm[:150, I:150+I]
+        # 21 is the size of the convolution kernel (beamSize): "search" evaluates the 20 shifts below it in one batch,
+        # "xcorr" estimates the delay by cross-correlation and only evaluates the SSIM around it
+        with stage("alignment") as record:
+            shift, max_ssim, SmearedImagePFNoiseNormFinal = alignToReference(SmearedImagePFNoiseNorm, referenceImage, mode=alignmentMode, numShifts=20)
+            record.note(image=SmearedImagePFNoiseNormFinal)
+        logger.info("Shift: %d", shift)
+        if profile is not None:
+            profile.finish()
 
         # Calculate mapping time [s]
-        mapTime = round(150*3000*dosage/(beamSize*repetitionRate))
+        mapTime = mappingTime(imageShape, dosage, repetitionRate, beamSize)
 
         return referenceImage, SmearedImagePFNoiseNormFinal, max_ssim, nuclide, mapTime
     
     except Exception as e:
         print(f"An error occurred: {e}")
+        if profile is not None:
+            profile.fail(e)
+            profile.finish()
         return None, None, None, None, None
 
 
-import time  # Ensure time is imported at the beginning of your script
-
-def simulateAblationTimed(inputImage, craterProfile, washoutProfilesAll, nuclideNames, repetitionRate, W=0, C_sample = 500, fluence = 0, dosage = 10, scanningSpeed = 2000, flickerNoise = 5, useRR=False):
+def simulateEnsemble(inputImage, craterProfile, washoutProfilesAll, nuclideNames, repetitionRate, W=0, C_sample = 500, fluence = 0, dosage = 10, scanningSpeed = 2000, flickerNoise = 5, useRR=False, numRealizations=32, percentiles=(2.5, 50, 97.5), batchSize=16, alignmentMode="search", refineRadius=1, cancelled=None, **stageOptions):
+    # SSIM statistics over numRealizations noise draws. The noise-free image is computed once (stageOptions
+    # are passed to noiselessStages) and the shift is found on it. The draws are made batchSize at a time,
+    # and the SSIM of each is the highest at the shifts within refineRadius of that shift, like the
+    # shift search of a single run.
+    # cancelled: called before every batch; if it returns True the ensemble stops and all None is returned.
+    # Returns (referenceImage, first noisy image (aligned), statistics, nuclide, mapTime) where statistics
+    # holds the mean, standard deviation and percentiles of the SSIM, all values and the shift.
+    from alignment import alignToReference, batchedSSIM, referenceStatistics, shiftWindows
     try:
         beamSize = 20 # um
-        dwellTime = 3 # ms
-        C_washout = 100 # ppm
-
         nuclide = nuclideNames[W]
-
         if useRR:
             scanningSpeed = round(repetitionRate * beamSize / dosage) # Scanning speed µm/s
         else:
             repetitionRate = round(scanningSpeed * dosage / beamSize) # Repetition rate in Hz
 
         print("Nuclide:", nuclide)
-        print("Use Repetition Rate:", useRR)
         print("Repetition Rate:", repetitionRate)
         print("Scanning Speed:", scanningSpeed)
         print("Dosage:", dosage)
+        print("Noise realizations:", numRealizations)
+
+        profile = stageOptions.get("profile")
+        stage = lambda name: profileStage(profile, name)
+        referenceImage, smearedImage = noiselessStages(inputImage, craterProfile, washoutProfilesAll, repetitionRate, W, C_sample, fluence, dosage, **stageOptions)
+        with stage("alignment"):
+            shift, noiselessSSIM, _ = alignToReference(smearedImage / np.max(smearedImage), referenceImage, mode=alignmentMode, numShifts=20)
+        logger.info("Shift: %d", shift)
+
+        statistics = referenceStatistics(referenceImage)
+        values = []
+        firstImage = None
+        firstShift = max(shift - refineRadius, 0)
+        numShifts = shift + refineRadius + 1 - firstShift
+        for start in range(0, numRealizations, batchSize):
+            if cancelled is not None and cancelled():
+                logger.info("Cancelled after %d of %d noise realizations", start, numRealizations)
+                if profile is not None:
+                    profile.finish()
+                return None, None, None, None, None
+            with stage("ensemble batch") as record:
+                realizations = noiseEnsembleStage(smearedImage, flickerNoise, min(batchSize, numRealizations - start))
+                windows = np.concatenate([shiftWindows(image, referenceImage.shape, numShifts, firstShift) for image in realizations])
+                # Every window is normalized by its own maximum, as in the single run
+                maxima = np.max(windows, axis=(1, 2), keepdims=True)
+                batchValues = batchedSSIM(windows, referenceImage, dataRange=1.0, statistics=statistics, divisors=maxima).reshape(len(realizations), numShifts)
+                values.append(np.max(batchValues, axis=1))
+                if firstImage is None:
+                    best = np.argmax(batchValues[0])
+                    firstImage = windows[best] / maxima[best]
+                record.note(windows=windows)
+        values = np.concatenate(values)
+
+        ssimStatistics = {"mean": float(np.mean(values)),
+                          "std": float(np.std(values, ddof=1)) if len(values) > 1 else 0.0,
+                          "percentiles": {p: float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))},
+                          "values": values,
+                          "shift": int(shift), # of the noise-free image
+                          "noiseless": float(noiselessSSIM)}
+        print("SSIM: {:.4f} +- {:.4f}".format(ssimStatistics["mean"], ssimStatistics["std"]))
+
+        mapTime = mappingTime(inputImage.shape, dosage, repetitionRate, beamSize)
+        if profile is not None:
+            profile.finish()
+        return referenceImage, firstImage, ssimStatistics, nuclide, mapTime
 
-        # Obtain washout profile based on selected nuclide and fluence
-        washoutProfile = washoutProfilesAll[:,W,fluence]
-        responseCurve0 = (dwellTime / 1000) * washoutProfile
-
-        # Normalize image
-        normalizedInputImage = inputImage / np.max(inputImage)
-
-        # Horizontal and vertical step size
-        k = int(beamSize / dosage)
-        m = int(beamSize)
-
-        conT = time.time()
-        # Double convolution (sampling blur and smear)
-        convolved = signal.fftconvolve(normalizedInputImage, craterProfile, mode='full')
-        convolved = signal.convolve2d(normalizedInputImage, craterProfile, mode='full') 
-        print(f"Convolution duration (normal): {time.time() - conT:.3f}")
-        # Normalize convolved image
-        normalizedConvolved = convolved / np.max(convolved)
-        # Subsample convolved image
-        normalizedConvolvedNoNoise = normalizedConvolved[m-1::m, k-1::k]
-
-        # Resample response curve
-        numSamples = round(100 * 1000 / repetitionRate) # Number of samples in the response curve
-        responseCurve = (1000 / repetitionRate) * (1 / dwellTime) * signal.resample_poly(responseCurve0, 300, numSamples) # resample_poly is analogous to resample in MATLAB
-
-        # Convert to 2-D by adding a new axis
-        responseCurve2D = responseCurve[np.newaxis,:] 
-
-        # Smear the image
-        smearedImageRaw = signal.convolve2d(normalizedConvolvedNoNoise, responseCurve2D, mode='full') # Equivalent to MATLAB's conv2
-
-        # Average every dosage shots into a single pixel
-        blockSize = (1, dosage)
-        smearedImage = (C_sample / C_washout) * dosage * block_reduce(smearedImageRaw, blockSize, np.mean) # Equivalent to MATLAB's blockproc
-
-        # Set negative values and NaNs to zero
-        smearedImage[smearedImage < 0] = 0
-        smearedImage[np.isnan(smearedImage)] = 0
-
-        # Simulate applying Poisson noise to an image
-        smearedImagePNoise = np.random.poisson(smearedImage)
-
-        #smearedImagePNoise = np.random.poisson(smearedImage / 1e12) * 1e12
-        # Apply additional noise, which is a combination of Poisson noise and Gaussian noise
-        SmearedImagePFNoise = smearedImagePNoise + np.random.randn(*smearedImagePNoise.shape) * (smearedImagePNoise * flickerNoise / 100)
-        # Normalize the final noisy image
-        SmearedImagePFNoiseNorm = SmearedImagePFNoise / np.max(SmearedImagePFNoise)
-
-        # Create a normalized reference image for SSIM calculation
-        referenceImage = block_reduce(normalizedInputImage, (beamSize, beamSize), np.mean)
-        referenceImage = referenceImage / np.max(referenceImage)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        profile = stageOptions.get("profile")
+        if profile is not None:
+            profile.fail(e)
+            profile.finish()
+        return None, None, None, None, None
 
-        # Image shifting
-        add = np.zeros((SmearedImagePFNoiseNorm.shape[0], 200))
-        SmearedImagePFNoiseNorm = np.hstack([SmearedImagePFNoiseNorm, add])
-        shift = []
-        # 21 is the size of the convolution kernel (beamSize)
-        for peakShift in range(1, 21):
-            # Shift the smeared image and normalize it
-            SmearedImagePFNoiseNormTmp = SmearedImagePFNoiseNorm[:150, peakShift:150+peakShift]
-            SmearedImagePFNoiseNormTmp = SmearedImagePFNoiseNormTmp / np.max(SmearedImagePFNoiseNormTmp)
-            # Calculate SSIM and store it
-            ssimval = ssim(SmearedImagePFNoiseNormTmp, referenceImage,data_range=1.0)
-            shift.append((peakShift, ssimval))
-
-        # Determine the shift that maximizes the SSIM
-        shift = np.array(shift)
-        I = np.argmax(shift[:, 1])
-
-        # Obtain the maximum SSIM
-        max_ssim = np.max(shift[:, 1])
-
-        # Shift the smeared image
-        SmearedImagePFNoiseNormFinal = SmearedImagePFNoiseNorm[:150, I:150+I]
+def simulateMultiNuclide(inputImage, craterProfile, washoutProfilesAll, nuclideNames, repetitionRate, nuclides="all", C_sample = 500, fluence = 0, dosage = 10, scanningSpeed = 2000, flickerNoise = 5, useRR=False, alignmentMode="search", channelBatch=8, **stageOptions):
+    # All selected nuclides (a list of indices or "all") measured in the same scan. The beam-convolved
+    # image and the reference are computed once (stageOptions are passed to sampledStages) and the smear
+    # of every nuclide is one batched FFT convolution with the stacked response curves; each channel then
+    # gets its own noise, normalization and shift search, as in simulateAblation.
+    # Returns (referenceImage, images (nuclides, rows, columns), SSIM per nuclide, nuclide names, mapTime).
+    from alignment import alignToReference
+    try:
+        beamSize = 20 # um
+        dwellTime = 3 # ms
+        C_washout = 100 # ppm
+        nuclides = list(range(len(nuclideNames))) if isinstance(nuclides, str) and nuclides == "all" else [int(W) for W in nuclides]
+        names = [nuclideNames[W] for W in nuclides]
+        if useRR:
+            scanningSpeed = round(repetitionRate * beamSize / dosage) # Scanning speed µm/s
+        else:
+            repetitionRate = round(scanningSpeed * dosage / beamSize) # Repetition rate in Hz
 
-        # Calculate mapping time [s]
-        mapTime = round(150*3000*dosage/(beamSize*repetitionRate))
+        print("Nuclides:", len(nuclides))
+        print("Repetition Rate:", repetitionRate)
+        print("Scanning Speed:", scanningSpeed)
+        print("Dosage:", dosage)
 
-        # Final time print
-        endTime = time.time()
+        profile = stageOptions.get("profile")
+        stage = lambda name: profileStage(profile, name)
+        cache = stageCache if stageOptions.get("useCache", True) else None
+        referenceImage, normalizedConvolvedNoNoise, beamKey, (shotsPerPixel, shotRate, smearScale) = sampledStages(
+            inputImage, craterProfile, repetitionRate, dosage, **stageOptions)
+
+        with stage("response") as record:
+            responseKey = ("responses", arrayFingerprint(washoutProfilesAll), tuple(nuclides), fluence, shotRate)
+            responseCurves = cachedStage(cache, responseKey, lambda: responseStackStage(washoutProfilesAll, nuclides, fluence, shotRate, dwellTime))
+            record.note(curves=responseCurves)
+
+        # The smeared stack is not cached: it is as large as all channel images together
+        with stage("smear") as record:
+            smearedImages = smearStackStage(normalizedConvolvedNoNoise, responseCurves, shotsPerPixel, channelBatch)
+            smearedImages *= (C_sample / C_washout) * dosage * smearScale
+            # Set negative values and NaNs to zero
+            smearedImages[smearedImages < 0] = 0
+            smearedImages[np.isnan(smearedImages)] = 0
+            record.note(images=smearedImages)
+
+        images = []
+        ssims = np.zeros(len(nuclides))
+        for i, smearedImage in enumerate(smearedImages):
+            with stage("noise"):
+                noisyImage = noiseStage(smearedImage, flickerNoise)
+                noisyImage /= np.max(noisyImage)
+            with stage("alignment"):
+                shift, ssims[i], alignedImage = alignToReference(noisyImage, referenceImage, mode=alignmentMode, numShifts=20)
+            images.append(alignedImage)
+            print("{}: shift {}, SSIM {:.4f}".format(names[i], shift, ssims[i]))
+
+        mapTime = mappingTime(inputImage.shape, dosage, repetitionRate, beamSize)
+        if profile is not None:
+            profile.finish()
+        return referenceImage, np.stack(images), ssims, names, mapTime
 
-        return referenceImage, SmearedImagePFNoiseNormFinal, max_ssim, nuclide, mapTime
-    
     except Exception as e:
         print(f"An error occurred: {e}")
+        profile = stageOptions.get("profile")
+        if profile is not None:
+            profile.fail(e)
+            profile.finish()
         return None, None, None, None, None
@@ -0,0 +1,340 @@
+import numpy as np
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+from profiling import Profile
+
+# Long-lived simulation workers for the GUI. The large read-only inputs are memory-mapped from
+# their files (or placed once in shared memory if they are not backed by a file) at startup,
+# every worker keeps its interpreter (and the simulation stage cache) warm between runs, and
+# the result images are written into per-worker shared output buffers, so only a few scalars
+# travel through the queues.
+#
+# Progressive jobs run the line-by-line simulation (streaming.py): the lines finished so far are
+# copied into the output buffers and announced with a progress message, at most every
+# progressInterval seconds, so the GUI can draw the map while it is being built. They can also
+# be cancelled: every worker has a shared cancel flag holding the id of the job to stop, which
+# is checked after every line. Ensemble jobs check it before every batch of noise draws. Other
+# jobs run to the end and their result is dropped.
+#
+# Every job seeds the global NumPy random state before it runs, with the seed it was submitted with
+# or else its job id, so forked workers never draw the same noise for different jobs.
+#
+# Jobs submitted with profile=True are run with a profiling.Profile; its records are sent back
+# just before the result and kept until they are collected with SimulationPool.profile.
+
+progressInterval = 0.05 # s
+
+def _fileBacking(array):
+    # (file name, offset) of an array that is a whole read-only memory-mapped file, otherwise None
+    if not isinstance(array, np.memmap) or array.filename is None or array.mode != 'r' or not array.flags.c_contiguous:
+        return None
+    try:
+        if array.offset + array.nbytes != os.path.getsize(array.filename):
+            return None
+    except OSError:
+        return None
+    return array.filename, array.offset
+
+def _shareArray(array):
+    # Memory-mapped files are opened again by the workers (the OS shares the pages),
+    # everything else is copied into a shared memory block
+    backing = _fileBacking(array)
+    if backing is not None:
+        return None, ("file", backing, array.shape, array.dtype.str)
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared[...] = array
+    return block, ("shm", block.name, array.shape, array.dtype.str)
+
+def _attachArray(descriptor):
+    kind, name, shape, dtype = descriptor
+    if kind == "file":
+        filename, offset = name
+        return None, np.memmap(filename, dtype=np.dtype(dtype), mode='r', offset=offset, shape=shape)
+    if sys.version_info >= (3, 13):
+        block = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        # Only the creating process may track (and unlink) the block
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            block = shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+    return block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+def _workerMain(workerIndex, inputDescriptors, outputDescriptors, nuclideNames, taskQueue, resultQueue, cancelFlag):
+    # The simulation modules are only needed in the worker, not in the GUI process. They are
+    # imported at start so that the worker is warm by the time the first job arrives.
+    from util import simulateAblation, simulateEnsemble
+    from streaming import simulateStreaming
+    import scipy.signal, convolution, alignment, responsebank
+    from skimage.measure import block_reduce
+    blocks = []
+    inputs = {}
+    for key, descriptor in inputDescriptors.items():
+        block, inputs[key] = _attachArray(descriptor)
+        inputs[key].setflags(write=False)
+        if block is not None:
+            blocks.append(block)
+    outputs = []
+    for descriptor in outputDescriptors:
+        block, output = _attachArray(descriptor)
+        outputs.append(output)
+        blocks.append(block)
+
+    while True:
+        task = taskQueue.get()
+        if task is None:
+            break
+        jobId, parameters = task
+        parameters = dict(parameters)
+        craterProfile = parameters.pop("craterProfile")
+        progressive = parameters.pop("progressive", False)
+        ensemble = parameters.pop("ensemble", False)
+        profile = Profile() if parameters.pop("profile", False) else None
+        seed = parameters.pop("seed", None)
+        np.random.seed(jobId if seed is None else seed)
+        parameters["profile"] = profile
+        if progressive:
+            reportLines = _progressReporter(jobId, workerIndex, outputs, resultQueue, cancelFlag)
+            result = simulateStreaming(inputs["inputImage"], craterProfile, inputs["washoutProfilesAll"], nuclideNames, progress=reportLines, **parameters)
+        elif ensemble:
+            result = simulateEnsemble(inputs["inputImage"], craterProfile, inputs["washoutProfilesAll"], nuclideNames,
+                                      cancelled=lambda: cancelFlag.value == jobId, **parameters)
+        else:
+            result = simulateAblation(inputs["inputImage"], craterProfile, inputs["washoutProfilesAll"], nuclideNames, **parameters)
+        if profile is not None:
+            resultQueue.put((jobId, workerIndex, "profile", profile.toDict()))
+        if any(item is None for item in result):
+            resultQueue.put((jobId, workerIndex, "done", None))
+            continue
+        referenceImage, simulatedImage, max_ssim, nuclide, mapTime = result
+        tooLarge = [image.shape for output, image in zip(outputs, (referenceImage, simulatedImage)) if image.size > output.size]
+        if tooLarge:
+            print(f"An error occurred: job {jobId} result {tooLarge[0]} does not fit the output buffer {outputs[0].shape}")
+            resultQueue.put((jobId, workerIndex, "done", None))
+            continue
+        # Write the images into this worker's output buffers
+        shapes = []
+        for output, image in zip(outputs, (referenceImage, simulatedImage)):
+            output.flat[:image.size] = image.ravel()
+            shapes.append(image.shape)
+        resultQueue.put((jobId, workerIndex, "done", (shapes, max_ssim, nuclide, mapTime)))
+
+    del inputs, outputs
+    for block in blocks:
+        block.close()
+
+def _progressReporter(jobId, workerIndex, outputs, resultQueue, cancelFlag):
+    # progress callback of simulateStreaming: copies the new lines into the output buffers and
+    # sends (linesDone, numLines, shapes). The simulated lines are cut to the width of the reference;
+    # the columns beyond it only hold the tail of the smear. Returns True once the job is cancelled.
+    state = {"sent": 0, "time": 0.0}
+    def reportLines(linesDone, numLines, referenceImage, simulatedImage):
+        if cancelFlag.value == jobId:
+            return True
+        now = time.perf_counter()
+        if linesDone < numLines and now - state["time"] < progressInterval:
+            return
+        shapes = []
+        for output, image in zip(outputs, (referenceImage, simulatedImage[:, :referenceImage.shape[1]])):
+            if image.size > output.size:
+                raise ValueError(f"image {image.shape} does not fit the output buffer {output.shape}")
+            view = output.ravel()[:image.size].reshape(image.shape)
+            view[state["sent"]:linesDone] = image[state["sent"]:linesDone]
+            shapes.append(image.shape)
+        state["sent"], state["time"] = linesDone, now
+        resultQueue.put((jobId, workerIndex, "progress", (linesDone, numLines, shapes)))
+    return reportLines
+
+class SimulationPool:
+    def __init__(self, inputImage, washoutProfilesAll, nuclideNames, processes=1, beamSize=20):
+        self.nuclideNames = nuclideNames
+        self._blocks = []
+        self._nextJobId = 0
+        self._pending = []
+        self._busy = {}
+        self._progress = {} # jobId: (linesDone, numLines, shapes, workerIndex) of running progressive jobs
+        self._cancelled = set() # running jobs whose result is dropped
+        self._profiles = {} # jobId: profiling.Profile of finished jobs submitted with profile=True
+        self._resultQueue = multiprocessing.Queue()
+        self._inbox = self._resultQueue # a local queue.Queue fed by the listener thread once listen() is called
+
+        inputDescriptors = {}
+        for key, array in (("inputImage", inputImage), ("washoutProfilesAll", washoutProfilesAll)):
+            block, inputDescriptors[key] = _shareArray(array)
+            if block is not None:
+                self._blocks.append(block)
+
+        # One reference and one simulated image per worker, sized for the output of this input image
+        # (the smeared image can be one pixel wider than the reference)
+        outputShape = (-(-inputImage.shape[0] // beamSize) + 1, -(-inputImage.shape[1] // beamSize) + 1)
+        self._outputs = []
+        self._workers = []
+        self._taskQueues = []
+        self._cancelFlags = []
+        for workerIndex in range(processes):
+            outputs, outputDescriptors = [], []
+            for _ in range(2):
+                block, descriptor = _shareArray(np.zeros(outputShape))
+                self._blocks.append(block)
+                outputs.append(np.ndarray(outputShape, dtype=np.float64, buffer=block.buf))
+                outputDescriptors.append(descriptor)
+            self._outputs.append(outputs)
+
+            taskQueue = multiprocessing.Queue()
+            cancelFlag = multiprocessing.Value('q', -1, lock=False)
+            worker = multiprocessing.Process(target=_workerMain, args=(workerIndex, inputDescriptors, outputDescriptors, nuclideNames, taskQueue, self._resultQueue, cancelFlag), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+            self._taskQueues.append(taskQueue)
+            self._cancelFlags.append(cancelFlag)
+
+    def submit(self, craterProfile, progressive=False, ensemble=False, profile=False, seed=None, **parameters):
+        # Queues a simulation (keyword arguments of simulateAblation, of streaming.simulateStreaming
+        # for a progressive job or of simulateEnsemble for an ensemble job) and returns its job id.
+        # profile: record the stages of the job (see SimulationPool.profile).
+        # seed: seed of the noise (an int below 2**32), the job id by default.
+        jobId = self._nextJobId
+        self._nextJobId += 1
+        self._pending.append((jobId, dict(parameters, craterProfile=np.asarray(craterProfile), progressive=progressive, ensemble=ensemble, profile=profile, seed=seed)))
+        self._dispatch()
+        return jobId
+
+    def _dispatch(self):
+        # The lowest idle worker gets the next job, so that consecutive runs tend to hit the
+        # same worker and reuse its stage cache
+        for workerIndex in range(len(self._workers)):
+            if not self._pending:
+                return
+            if workerIndex not in self._busy:
+                jobId, parameters = self._pending.pop(0)
+                self._busy[workerIndex] = jobId
+                self._taskQueues[workerIndex].put((jobId, parameters))
+
+    def cancel(self, jobId):
+        # Drops a queued job, stops a running progressive job after its current line and a running
+        # ensemble job after its current batch, and drops the result of any other running job. Cancelled jobs are not returned by poll.
+        for index, (pendingId, parameters) in enumerate(self._pending):
+            if pendingId == jobId:
+                del self._pending[index]
+                return
+        for workerIndex, busyId in self._busy.items():
+            if busyId == jobId:
+                self._cancelFlags[workerIndex].value = jobId
+                self._cancelled.add(jobId)
+                self._progress.pop(jobId, None)
+
+    def lostJobs(self):
+        # Jobs that will never finish: those running on a worker that has exited (e.g. killed by the
+        # OS when it ran out of memory), and the queued ones once no worker is left
+        lost = [jobId for workerIndex, jobId in self._busy.items() if not self._workers[workerIndex].is_alive()]
+        if not any(worker.is_alive() for worker in self._workers):
+            lost += [jobId for jobId, parameters in self._pending]
+        return lost
+
+    def listen(self, wake):
+        # Event-driven completion: a thread waits for the workers' messages and calls wake()
+        # (from that thread) after each one, so the caller can poll right away instead of on a timer.
+        # The messages are kept for poll even if wake() fails, so a caller that cannot be woken
+        # can still poll on a timer.
+        self._inbox = queue.Queue()
+        threading.Thread(target=self._listen, args=(self._inbox, wake), name="simulation listener", daemon=True).start()
+
+    def _listen(self, inbox, wake):
+        while True:
+            message = self._resultQueue.get()
+            if message is None:
+                break
+            inbox.put(message)
+            try:
+                wake()
+            except Exception as e:
+                print(f"Simulation wake-up failed: {e}")
+
+    def poll(self, timeout=None):
+        # Returns a list of (jobId, result) for finished jobs, where result is the tuple returned
+        # by simulateAblation (all None on failure); for ensemble jobs the SSIM is replaced by the
+        # statistics dictionary of simulateEnsemble. Non-blocking unless a timeout is given, in
+        # which case it waits up to timeout seconds for the first message.
+        finished = []
+        wait = timeout is not None
+        while True:
+            try:
+                jobId, workerIndex, kind, message = self._inbox.get(timeout=timeout) if wait else self._inbox.get_nowait()
+            except queue.Empty:
+                break
+            wait = False
+            if kind == "progress":
+                linesDone, numLines, shapes = message
+                if jobId not in self._cancelled:
+                    self._progress[jobId] = (linesDone, numLines, shapes, workerIndex)
+                continue
+            if kind == "profile":
+                if jobId not in self._cancelled:
+                    self._profiles[jobId] = Profile.fromDict(message)
+                continue
+            self._progress.pop(jobId, None)
+            if jobId in self._cancelled:
+                self._cancelled.discard(jobId)
+                del self._busy[workerIndex]
+                continue
+            if message is None:
+                result = (None, None, None, None, None)
+            else:
+                shapes, max_ssim, nuclide, mapTime = message
+                # Copy the images out before the worker can be given another job
+                referenceImage, simulatedImage = [output.ravel()[:np.prod(shape)].reshape(shape).copy() for output, shape in zip(self._outputs[workerIndex], shapes)]
+                result = (referenceImage, simulatedImage, max_ssim, nuclide, mapTime)
+            del self._busy[workerIndex]
+            finished.append((jobId, result))
+        self._dispatch()
+        return finished
+
+    def progress(self, jobId):
+        # (linesDone, numLines) of a running progressive job as of the last poll, None before the first line
+        if jobId not in self._progress:
+            return None
+        return self._progress[jobId][:2]
+
+    def profile(self, jobId):
+        # The profiling.Profile of a finished job submitted with profile=True, None otherwise.
+        # It is handed out once.
+        return self._profiles.pop(jobId, None)
+
+    def preview(self, jobId):
+        # Copies of the reference and simulated images of a running progressive job, raw counts with
+        # the lines that are not finished yet set to NaN; None before the first line
+        if jobId not in self._progress:
+            return None
+        linesDone, numLines, shapes, workerIndex = self._progress[jobId]
+        images = []
+        for output, shape in zip(self._outputs[workerIndex], shapes):
+            image = np.full(shape, np.nan)
+            image[:linesDone] = output.ravel()[:np.prod(shape)].reshape(shape)[:linesDone]
+            images.append(image)
+        return images
+
+    def shutdown(self):
+        # The listener thread (a daemon) is stopped but not joined, since it may be waiting in wake()
+        self._resultQueue.put(None)
+        for taskQueue in self._taskQueues:
+            taskQueue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=2)
+            if worker.is_alive():
+                worker.terminate()
+        self._outputs = []
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []